@@ -7,6 +7,8 @@ from sqlalchemy.ext.asyncio import async_engine_from_config
 
 from alembic import context
 from backend.database import Base
+# Таблицы попадают в Base.metadata при импорте моделей
+from backend import models  # noqa: F401
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -23,7 +25,8 @@ if config.config_file_name is not None:
 target_metadata = Base.metadata
 from config import settings
 config = context.config
-config.set_main_option("sqlalchemy.url", settings.DATABASE_URL)
+# % в пароле configparser принял бы за подстановку
+config.set_main_option("sqlalchemy.url", settings.DATABASE_URL.replace("%", "%%"))
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -42,7 +45,6 @@ def run_migrations_offline() -> None:
     script output.
 
     """
-    config.set_main_option("sqlalchemy.url", DB_URL)
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
         url=url,
@@ -82,7 +84,6 @@ async def run_async_migrations() -> None:
 
 def run_migrations_online() -> None:
     """Run migrations in 'online' mode."""
-    config.set_main_option("sqlalchemy.url", DB_URL)
     asyncio.run(run_async_migrations())
 
 
@@ -0,0 +1,37 @@
+"""project edits journal
+
+Revision ID: 9e4c1a7b2d58
+Revises: 3b8d2f6a9c41
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e4c1a7b2d58'
+down_revision: Union[str, Sequence[str], None] = '3b8d2f6a9c41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('project_edits',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('changes', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_project_edits_project_id'), 'project_edits', ['project_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_project_edits_project_id'), table_name='project_edits')
+    op.drop_table('project_edits')
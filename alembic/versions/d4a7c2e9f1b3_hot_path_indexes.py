@@ -0,0 +1,44 @@
+"""indexes for hot lookups
+
+Revision ID: d4a7c2e9f1b3
+Revises: 9e4c1a7b2d58
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4a7c2e9f1b3'
+down_revision: Union[str, Sequence[str], None] = '9e4c1a7b2d58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY не блокирует запись в таблицы на время построения, но не работает внутри транзакции
+    with op.get_context().autocommit_block():
+        # Участники проекта: рассылка по комнате, сброс кэша ролей, удаление проекта
+        op.create_index('ix_user_projects_project_id', 'user_projects', ['project_id'], unique=False,
+                        postgresql_concurrently=True)
+        # Журнал проекта по порядку и его max(id) для ETag
+        op.create_index('ix_project_edits_project_id_id', 'project_edits', ['project_id', 'id'], unique=False,
+                        postgresql_concurrently=True)
+        op.drop_index('ix_project_edits_project_id', table_name='project_edits', postgresql_concurrently=True)
+        # Дублировали первичные ключи и только замедляли вставки
+        op.drop_index('ix_projects_id', table_name='projects', postgresql_concurrently=True)
+        op.drop_index('ix_users_id', table_name='users', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_id', 'users', ['id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_projects_id', 'projects', ['id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_project_edits_project_id', 'project_edits', ['project_id'], unique=False,
+                        postgresql_concurrently=True)
+        op.drop_index('ix_project_edits_project_id_id', table_name='project_edits', postgresql_concurrently=True)
+        op.drop_index('ix_user_projects_project_id', table_name='user_projects', postgresql_concurrently=True)
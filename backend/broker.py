@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Callable
+
+import asyncpg
+import orjson
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY ограничен 8000 байтами, поэтому крупные кадры режем на куски по NOTIFY_CHUNK_SIZE байт UTF-8.
+# Кусок идёт в payload как есть, после короткого заголовка, так что остатка хватает на заголовок.
+# Все кадры, скопившиеся в очереди (не больше NOTIFY_BATCH), уходят одним запросом
+NOTIFY_CHUNK_SIZE = 7900
+NOTIFY_BATCH = 100
+# Недособранный кадр забываем через PARTIAL_TTL секунд или когда их копится больше PARTIAL_LIMIT:
+# кусок мог потеряться, а отправитель - упасть посреди сообщения
+PARTIAL_TTL = 30.0
+PARTIAL_LIMIT = 1000
+# Соединение для LISTEN проверяется раз в BROKER_CHECK_INTERVAL секунд, упавшее переоткрывается
+# с паузой RECONNECT_DELAY. При остановке неотправленные кадры ждём не дольше STOP_TIMEOUT
+BROKER_CHECK_INTERVAL = 5.0
+RECONNECT_DELAY = 1.0
+STOP_TIMEOUT = 5.0
+
+Deliver = Callable[[int, dict], None]
+
+# Канал для сообщений всем воркерам сразу, а не участникам одной комнаты.
+# Id проектов начинаются с 1, поэтому 0 с комнатой не совпадёт
+ALL_WORKERS = 0
+
+# После переподключения брокер доставляет его в каждый свой канал: сообщения за время разрыва могли потеряться
+RESYNC = {"type": "resync"}
+
+
+# Шина между воркерами: ConnectionManager публикует в неё каждый broadcast и служебные
+# сообщения комнаты, а сообщения от других воркеров доставляет своим сокетам.
+# LocalBroker - вариант для одного процесса, где доставлять некуда
+class LocalBroker():
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self.deliver: Deliver | None = None
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def stop(self):
+        self.deliver = None
+
+    async def subscribe(self, project_id: int):
+        pass
+
+    def unsubscribe(self, project_id: int):
+        pass
+
+    def publish(self, project_id: int, message: dict):
+        pass
+
+
+def _channel(project_id: int) -> str:
+    return f"editor_{project_id}"
+
+
+def _split(frame: bytes) -> list[str]:
+    # Режем по байтам, но не посреди символа: продолжения UTF-8 имеют вид 10xxxxxx
+    chunks = []
+    start = 0
+    while start < len(frame):
+        end = min(start + NOTIFY_CHUNK_SIZE, len(frame))
+        while end < len(frame) and frame[end] & 0xC0 == 0x80:
+            end -= 1
+        chunks.append(frame[start:end].decode())
+        start = end
+    return chunks or [""]
+
+
+class PostgresBroker(LocalBroker):
+    def __init__(self, dsn: str, check_interval: float = BROKER_CHECK_INTERVAL):
+        super().__init__()
+        self.dsn = dsn
+        self.check_interval = check_interval
+        self._listen_conn: asyncpg.Connection | None = None
+        self._publish_conn: asyncpg.Connection | None = None
+        self._outgoing: asyncio.Queue = asyncio.Queue()
+        self._publisher: asyncio.Task | None = None
+        self._watcher: asyncio.Task | None = None
+        self._listen_lost = asyncio.Event()
+        self._subscriptions: set[int] = set()
+        self._listen_lock = asyncio.Lock()
+        # Недособранные кадры: (воркер, id сообщения) -> (когда пришёл первый кусок, куски)
+        self._partial: dict[tuple[str, str], tuple[float, list[str | None]]] = {}
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self._listen_conn = await asyncpg.connect(self.dsn)
+        self._listen_conn.add_termination_listener(self._on_listen_lost)
+        self._publish_conn = await asyncpg.connect(self.dsn)
+        self._publisher = asyncio.create_task(self._publish_loop())
+        self._watcher = asyncio.create_task(self._watch_loop())
+        await self.subscribe(ALL_WORKERS)
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+        if self._publisher is not None:
+            # Кадры, уже отданные в publish, - последние правки и сообщения комнат: дожидаемся их отправки
+            try:
+                await asyncio.wait_for(self._outgoing.join(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Dropped %s unsent broker frames on shutdown", self._outgoing.qsize())
+            self._publisher.cancel()
+            try:
+                await self._publisher
+            except asyncio.CancelledError:
+                pass
+            self._publisher = None
+            self._outgoing = asyncio.Queue()
+        if self._listen_conn is not None:
+            self._listen_conn.remove_termination_listener(self._on_listen_lost)
+        for conn in (self._listen_conn, self._publish_conn):
+            if conn is not None:
+                await conn.close()
+        self._listen_conn = self._publish_conn = None
+        self._listen_lost.clear()
+        self._subscriptions.clear()
+        await super().stop()
+
+    async def subscribe(self, project_id: int):
+        # Ждём LISTEN, чтобы не пропустить ответы на первые же запросы комнаты
+        if project_id not in self._subscriptions:
+            self._subscriptions.add(project_id)
+            await self._listen(project_id, True)
+
+    def unsubscribe(self, project_id: int):
+        if project_id in self._subscriptions:
+            self._subscriptions.discard(project_id)
+            asyncio.create_task(self._listen(project_id, False))
+
+    def publish(self, project_id: int, message: dict):
+        # Broadcast не ждёт базу: NOTIFY уходит из отдельной задачи
+        if self._publisher is not None:
+            self._outgoing.put_nowait((project_id, orjson.dumps(message)))
+
+    async def _listen(self, project_id: int, enable: bool):
+        # Без соединения подписка остаётся только в _subscriptions - LISTEN повторит переподключение
+        async with self._listen_lock:
+            if self._listen_conn is None:
+                return
+            try:
+                if enable:
+                    await self._listen_conn.add_listener(_channel(project_id), self._on_notify)
+                else:
+                    await self._listen_conn.remove_listener(_channel(project_id), self._on_notify)
+            except Exception:
+                logger.exception("Failed to change subscription for project %s", project_id)
+
+    async def _connect(self) -> asyncpg.Connection:
+        while True:
+            try:
+                return await asyncpg.connect(self.dsn)
+            except Exception:
+                logger.warning("Failed to connect the broker to PostgreSQL, retrying", exc_info=True)
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def _on_listen_lost(self, connection):
+        self._listen_lost.set()
+
+    async def _watch_loop(self):
+        # Закрытое соединение видно сразу по termination listener, а зависшее - по SELECT 1
+        while True:
+            try:
+                await asyncio.wait_for(self._listen_lost.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                if await self._listen_alive():
+                    continue
+            logger.warning("Broker lost its LISTEN connection, reconnecting")
+            await self._relisten()
+
+    async def _listen_alive(self) -> bool:
+        try:
+            async with self._listen_lock:
+                await asyncio.wait_for(self._listen_conn.fetchval("SELECT 1"), self.check_interval)
+            return True
+        except Exception:
+            return False
+
+    async def _relisten(self):
+        async with self._listen_lock:
+            old, self._listen_conn = self._listen_conn, None
+        if old is not None:
+            old.remove_termination_listener(self._on_listen_lost)
+            old.terminate()
+        conn = await self._connect()
+        async with self._listen_lock:
+            for project_id in self._subscriptions:
+                await conn.add_listener(_channel(project_id), self._on_notify)
+            conn.add_termination_listener(self._on_listen_lost)
+            self._listen_conn = conn
+            self._listen_lost.clear()
+            # Куски, начатые до разрыва, уже не соберутся
+            self._partial.clear()
+        if self.deliver is not None:
+            for project_id in list(self._subscriptions):
+                self.deliver(project_id, RESYNC)
+
+    async def _publish_loop(self):
+        while True:
+            batch = [await self._outgoing.get()]
+            while len(batch) < NOTIFY_BATCH and not self._outgoing.empty():
+                batch.append(self._outgoing.get_nowait())
+            try:
+                await self._send(batch)
+            finally:
+                for _ in batch:
+                    self._outgoing.task_done()
+
+    async def _send(self, batch: list[tuple[int, bytes]]):
+        # Payload куска - "воркер id_сообщения номер всего данные". Одинаковые payload в одной транзакции
+        # PostgreSQL склеил бы, но id сообщения делает каждый кусок уникальным
+        channels, payloads = [], []
+        for project_id, frame in batch:
+            message_id = uuid.uuid4().hex[:8]
+            chunks = _split(frame)
+            for index, chunk in enumerate(chunks):
+                channels.append(_channel(project_id))
+                payloads.append(f"{self.worker_id} {message_id} {index} {len(chunks)} {chunk}")
+        while True:
+            try:
+                await self._publish_conn.execute(
+                    "SELECT pg_notify(channel, payload) FROM unnest($1::text[], $2::text[]) AS t(channel, payload)",
+                    channels, payloads)
+                return
+            except Exception:
+                if not self._publish_conn.is_closed():
+                    logger.exception("Failed to publish %s broker frames", len(batch))
+                    return
+            # Соединение потеряно посреди отправки - переоткрываем и шлём пачку заново.
+            # Повторно пришедшие куски с тем же id сообщения получатель просто перезапишет
+            logger.warning("Broker lost its NOTIFY connection, reconnecting")
+            self._publish_conn = await self._connect()
+
+    def _on_notify(self, connection, pid, channel: str, payload: str):
+        worker, message_id, index, count, data = payload.split(" ", 4)
+        if worker == self.worker_id:
+            return
+
+        if count == "1":
+            frame = data
+        else:
+            key = (worker, message_id)
+            entry = self._partial.get(key)
+            if entry is None:
+                self._expire_partial(time.monotonic())
+                entry = self._partial[key] = (time.monotonic(), [None] * int(count))
+            parts = entry[1]
+            parts[int(index)] = data
+            if any(part is None for part in parts):
+                return
+            del self._partial[key]
+            frame = "".join(parts)
+
+        if self.deliver is not None:
+            self.deliver(int(channel.removeprefix("editor_")), orjson.loads(frame))
+
+    def _expire_partial(self, now: float):
+        # Словарь хранит порядок вставки, так что самые старые кадры - первые
+        while self._partial:
+            key, (started, _) = next(iter(self._partial.items()))
+            if now - started < PARTIAL_TTL and len(self._partial) < PARTIAL_LIMIT:
+                break
+            del self._partial[key]
+            logger.warning("Dropped incomplete frame %s from worker %s", key[1], key[0])
+
+
+def create_broker() -> LocalBroker:
+    if settings.BROKER == "postgres":
+        return PostgresBroker(settings.DATABASE_URL.replace("+asyncpg", ""))
+    return LocalBroker()
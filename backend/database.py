@@ -1,14 +1,57 @@
+import time
+
+from sqlalchemy import event, exc
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from backend import metrics
 from config import settings
 # 1. Твой URL без лишних параметров
 URL = settings.DATABASE_URL
 
-# 2. Создаем асинхронный движок
+pool_checkout_wait = metrics.registry.histogram(
+    "db_pool_checkout_wait_seconds", "Time to get a connection from the pool, including connect and pre-ping")
+pool_timeouts = metrics.registry.counter(
+    "db_pool_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT")
+pool_checked_out = metrics.registry.gauge(
+    "db_pool_checked_out", "Connections currently checked out of the pool")
+pool_utilization = metrics.registry.gauge(
+    "db_pool_utilization", "Checked out connections relative to pool size plus max overflow")
+
+
+# Пул, который замеряет, сколько запрос ждал соединение
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def connect(self):
+        started = time.monotonic()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            pool_timeouts.inc()
+            raise
+        finally:
+            pool_checkout_wait.observe(time.monotonic() - started)
+
+
+# 2. Создаем асинхронный движок, размеры пула берём из настроек
 engine = create_async_engine(URL,
-                             pool_pre_ping=True
+                             poolclass=InstrumentedPool,
+                             pool_size=settings.DB_POOL_SIZE,
+                             max_overflow=settings.DB_MAX_OVERFLOW,
+                             pool_timeout=settings.DB_POOL_TIMEOUT,
+                             pool_recycle=settings.DB_POOL_RECYCLE,
+                             pool_pre_ping=settings.DB_POOL_PRE_PING
                              )
 
+
+def _update_pool_gauges(*args):
+    pool = engine.sync_engine.pool
+    pool_checked_out.set(pool.checkedout())
+    pool_utilization.set(pool.checkedout() / (settings.DB_POOL_SIZE + max(settings.DB_MAX_OVERFLOW, 0)))
+
+event.listen(engine.sync_engine, "checkout", _update_pool_gauges)
+event.listen(engine.sync_engine, "checkin", _update_pool_gauges)
+
 # 3. Переименовал в AsyncSessionLocal, чтобы main.py его увидел
 # Используем async_sessionmaker — это стандарт для асинхронности
 AsyncSessionLocal = async_sessionmaker(
@@ -18,4 +61,4 @@ AsyncSessionLocal = async_sessionmaker(
 )
 
 # 4. Базовый класс для моделей
-class Base(DeclarativeBase): pass
\ No newline at end of file
+class Base(DeclarativeBase): pass
@@ -1,9 +1,10 @@
 from fastapi import Request, Depends, HTTPException, status, Cookie, Header
 from jose import JWTError, jwt
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy import select
 
-from backend import database, models, security
+from backend import database, models, schemas, security
+from backend.principals import principals
 
 async def get_db():
     async with database.AsyncSessionLocal() as db:
@@ -12,7 +13,11 @@ async def get_db():
         finally:
             await db.close()
 
-async def _verify_token_and_get_user(access_token: str | None, db: AsyncSession):
+# Для долгих соединений (WebSocket): сессию открываем на короткую единицу работы, а не на всё соединение
+def get_session_factory() -> async_sessionmaker[AsyncSession]:
+    return database.AsyncSessionLocal
+
+async def _verify_token_and_get_user(access_token: str | None, db: AsyncSession) -> schemas.Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -29,14 +34,22 @@ async def _verify_token_and_get_user(access_token: str | None, db: AsyncSession)
     except JWTError:
         raise credentials_exception
 
-    query = select(models.User).where(models.User.id == int(user_id))
-    result = await db.execute(query)
-    user = result.scalar_one_or_none()
+    # В базу идём только при промахе кэша
+    principal = principals.get(int(user_id))
+    if principal is None:
+        query = select(models.User).where(models.User.id == int(user_id))
+        result = await db.execute(query)
+        user = result.scalar_one_or_none()
+
+        if user is None:
+            raise credentials_exception
+        principal = schemas.Principal.model_validate(user)
+        principals.put(principal)
 
-    if user is None:
+    if not principal.is_active:
         raise credentials_exception
 
-    return user
+    return principal
 
 # Зависимость для HTTP (проверяет CSRF)
 async def get_current_user(
@@ -52,9 +65,11 @@ async def get_current_user(
 
     return await _verify_token_and_get_user(access_token, db)
 
-# Зависимость для WebSockets (без Request и CSRF)
+# Зависимость для WebSockets (без Request и CSRF). Сессия закрывается сразу после проверки,
+# иначе соединение с БД держалось бы, пока открыт сокет
 async def get_current_user_ws(
         access_token: str | None = Cookie(default=None),
-        db: AsyncSession = Depends(get_db)
+        session_factory: async_sessionmaker[AsyncSession] = Depends(get_session_factory)
 ):
-    return await _verify_token_and_get_user(access_token, db)
\ No newline at end of file
+    async with session_factory() as db:
+        return await _verify_token_and_get_user(access_token, db)
\ No newline at end of file
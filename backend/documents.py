@@ -0,0 +1,325 @@
+import asyncio
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import islice
+
+import orjson
+from sqlalchemy import case, delete, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import metrics, models, ot, schemas
+from backend.rope import Rope
+
+# Сколько последних правок помним для преобразования запоздавших сообщений
+HISTORY_SIZE = 1000
+# Правки копятся в журнале project_edits, а полный текст переписывается в projects.content
+# (и журнал проекта очищается) раз в SNAPSHOT_EVERY_OPS пачек или после SNAPSHOT_IDLE секунд тишины
+SNAPSHOT_EVERY_OPS = 500
+SNAPSHOT_IDLE = 30.0
+
+flush_batch_size = metrics.registry.histogram(
+    "editor_flush_batch_size", "Documents written by one flush",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+flush_lag = metrics.registry.histogram(
+    "editor_flush_lag_seconds", "Time between the first unsaved edit and its flush")
+flush_duration = metrics.registry.histogram(
+    "editor_flush_duration_seconds", "Duration of the batched UPDATE")
+flush_errors = metrics.registry.counter(
+    "editor_flush_errors_total", "Failed flushes")
+persisted_bytes = metrics.registry.counter(
+    "editor_persisted_bytes_total", "Bytes written for documents by kind of write", ("kind",))
+
+
+class Document:
+    def __init__(self, project_id: int, content: str):
+        self.project_id = project_id
+        self.text = Rope(content)
+        self._content: str | None = content
+        self.connections = 0
+        # Момент первой несохранённой правки, None - буфер совпадает с БД
+        self.dirty_since: float | None = None
+        # Пачки правок, ещё не дописанные в журнал
+        self.journal: list[list[schemas.SingleChange]] = []
+        # Пачки в журнале БД и в self.journal поверх последнего снимка
+        self.ops_since_snapshot = 0
+        self.last_edit_at = time.monotonic()
+        # Журнал в БД мог разойтись с буфером (замена текста, восстановление) - нужен снимок
+        self.snapshot_due = False
+        self.revision = 0
+        # Ревизии считаются заново при каждой загрузке документа, epoch отличает одну загрузку от другой
+        self.epoch = uuid.uuid4().hex[:8]
+        # Ревизии по порядку: (применённые правки, id соединения автора, правки в том виде, как их прислал автор)
+        self.history: deque[tuple[list[schemas.SingleChange], str | None, list[schemas.SingleChange]]] = \
+            deque(maxlen=HISTORY_SIZE)
+
+    @property
+    def dirty(self) -> bool:
+        return self.dirty_since is not None
+
+    # Плоская строка собирается только для сохранения и отдачи через REST
+    @property
+    def content(self) -> str:
+        if self._content is None:
+            self._content = str(self.text)
+        return self._content
+
+    def apply(self, changes: list[schemas.SingleChange]):
+        for change in changes:
+            self.text.replace(change.rangeOffset, change.rangeLength, change.text)
+        self._content = None
+        self.journal.append(changes)
+        self.ops_since_snapshot += 1
+        self.last_edit_at = time.monotonic()
+        if self.dirty_since is None:
+            self.dirty_since = self.last_edit_at
+
+    def needs_snapshot(self, now: float) -> bool:
+        return (self.snapshot_due or self.ops_since_snapshot >= SNAPSHOT_EVERY_OPS
+                or (self.ops_since_snapshot > 0 and now - self.last_edit_at >= SNAPSHOT_IDLE))
+
+    @property
+    def version(self) -> str:
+        return f"{self.epoch}.{self.revision}"
+
+    def snapshot(self) -> dict:
+        return {"type": "snapshot", "revision": self.revision, "content": self.content}
+
+    def _history_since(self, revision: int):
+        missing = self.revision - revision
+        if missing < 0 or missing > len(self.history):
+            return None
+        return list(islice(self.history, len(self.history) - missing, None))
+
+    def changes_since(self, revision: int) -> list[list[schemas.SingleChange]] | None:
+        # Правки после revision по порядку; None - их уже нет в истории
+        entries = self._history_since(revision)
+        if entries is None:
+            return None
+        return [changes for changes, _, _ in entries]
+
+    def commit(self, changes: list[schemas.SingleChange], base_revision: int | None = None,
+               author: str | None = None) -> list[schemas.SingleChange] | None:
+        # Преобразуем правку против всего, что клиент ещё не видел, и применяем как новую ревизию.
+        # None - ревизия клиента уже выпала из истории, ему нужен свежий снимок
+        original = changes
+        if base_revision is not None:
+            entries = self._history_since(base_revision)
+            if entries is None:
+                return None
+            # Клиент может слать правки, не дожидаясь ack: его прошлые правки после base_revision
+            # уже есть у него в тексте. Чужие правки проводим через них (в исходном виде автора),
+            # и только потом преобразуем новую правку против получившегося
+            others = []
+            for past, past_author, past_original in entries:
+                if author is not None and past_author == author:
+                    _, others = ot.transform(past_original, others)
+                else:
+                    others = others + past
+            changes, _ = ot.transform(changes, others)
+
+        self.apply(changes)
+        self.revision += 1
+        self.history.append((changes, author, original))
+        return changes
+
+    def replace(self, content: str):
+        # Текст заменён целиком, старые смещения больше ничего не значат
+        self.text = Rope(content)
+        self._content = content
+        self.dirty_since = None
+        self.revision += 1
+        self.history.clear()
+        # Текст уже записан целиком, но в журнал могли успеть попасть старые правки - их сотрёт снимок
+        self.journal.clear()
+        self.ops_since_snapshot = 0
+        self.snapshot_due = True
+
+
+def _journal_row(project_id: int, changes: list[schemas.SingleChange]) -> dict:
+    return {"project_id": project_id, "changes": [change.model_dump() for change in changes]}
+
+
+async def load_content(project_id: int, db: AsyncSession) -> tuple[str, int] | None:
+    # Текст проекта из последнего снимка и хвоста журнала; второе значение - число пачек в хвосте
+    content = await db.scalar(select(models.Project.content).where(models.Project.id == project_id))
+    if content is None and await db.get(models.Project, project_id) is None:
+        return None
+    edits = (await db.scalars(select(models.ProjectEdit.changes)
+                              .where(models.ProjectEdit.project_id == project_id)
+                              .order_by(models.ProjectEdit.id))).all()
+    if not edits:
+        return content or "", 0
+
+    text = Rope(content or "")
+    for changes in edits:
+        for change in changes:
+            text.replace(change["rangeOffset"], change["rangeLength"], change["text"])
+    return str(text), len(edits)
+
+
+# Один общий буфер на открытый проект: все соединения пишут и читают отсюда,
+# а в БД ходим только при загрузке и сохранении
+class DocumentRegistry():
+    def __init__(self):
+        self.documents: dict[int, Document] = {}
+        # Загрузка и выгрузка одного проекта идут по очереди, а разные проекты друг друга не ждут:
+        # проект -> [лок, сколько корутин его держат или ждут]
+        self._locks: dict[int, list] = {}
+        # Сохранения идут строго по очереди, чтобы старый снимок не перезаписал новый
+        self._persist_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def _project_lock(self, project_id: int):
+        entry = self._locks.get(project_id)
+        if entry is None:
+            entry = self._locks[project_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[project_id]
+
+    def get(self, project_id: int) -> Document | None:
+        return self.documents.get(project_id)
+
+    def dirty_documents(self) -> list[Document]:
+        now = time.monotonic()
+        return [document for document in self.documents.values()
+                if document.dirty or document.needs_snapshot(now)]
+
+    async def acquire(self, project_id: int, db: AsyncSession) -> Document | None:
+        async with self._project_lock(project_id):
+            document = self.documents.get(project_id)
+            if document is None:
+                loaded = await load_content(project_id, db)
+                if loaded is None:
+                    return None
+                content, tail = loaded
+                document = Document(project_id, content)
+                if tail:
+                    # Прошлый владелец не успел сделать снимок - свернём журнал при следующей записи
+                    document.ops_since_snapshot = tail
+                    document.snapshot_due = True
+                self.documents[project_id] = document
+            document.connections += 1
+            return document
+
+    async def release(self, project_id: int, db: AsyncSession):
+        async with self._project_lock(project_id):
+            document = self.documents.get(project_id)
+            if document is None:
+                return
+            document.connections -= 1
+            if document.connections > 0:
+                return
+            # Выгружаем только записанный буфер. Если запись упала, документ остаётся в памяти
+            # с несохранёнными правками: его допишет flusher и выгрузит evict_idle
+            await self.persist([document], db, snapshot=True)
+            del self.documents[project_id]
+
+    async def evict_idle(self) -> list[int]:
+        # Документы без соединений, которые удалось записать после неудачной выгрузки.
+        # Проекты, которые сейчас загружают или выгружают, не трогаем: ими занят владелец лока
+        idle = [project_id for project_id, document in self.documents.items()
+                if document.connections == 0 and not document.dirty and project_id not in self._locks]
+        for project_id in idle:
+            del self.documents[project_id]
+        return idle
+
+    async def rewrite(self, project_id: int, content: str, db: AsyncSession, **values) -> bool:
+        # Текст проекта заменяют целиком (PUT). Под локом записи: начатая раньше запись flusher'а успеет
+        # закончиться и будет стёрта, а следующая увидит уже новый буфер - хвост журнала или снимок
+        # старого текста поверх нового не ляжет. False - проекта нет
+        async with self._persist_lock:
+            result = await db.execute(update(models.Project).where(models.Project.id == project_id)
+                                      .values(content=content, **values))
+            if result.rowcount == 0:
+                await db.rollback()
+                return False
+            await db.execute(delete(models.ProjectEdit).where(models.ProjectEdit.project_id == project_id))
+            await db.commit()
+            document = self.documents.get(project_id)
+            if document is not None:
+                document.replace(content)
+            return True
+
+    async def replace(self, project_id: int, content: str) -> Document | None:
+        # Текст заменили на другом воркере. Тоже под локом записи: запись старого буфера, начатая до этого,
+        # могла лечь поверх нового текста - снимок после replace её перезапишет
+        async with self._persist_lock:
+            document = self.documents.get(project_id)
+            if document is not None:
+                document.replace(content)
+            return document
+
+    async def drop(self, project_id: int) -> Document | None:
+        # Лок владельца потерян: буфер выбрасываем несохранённым, запись поверх нового владельца хуже потери
+        # последних правок. Возвращаемся, когда закончится уже начатая запись
+        document = self.documents.pop(project_id, None)
+        async with self._persist_lock:
+            return document
+
+    async def persist(self, documents: list[Document], db: AsyncSession, snapshot: bool = False):
+        # Обычная запись дописывает накопленные пачки в журнал - это килобайты вместо всего текста.
+        # Снимок переписывает projects.content и очищает журнал проекта в той же транзакции
+        async with self._persist_lock:
+            now = time.monotonic()
+            # Документ, выброшенный через drop, пока ждали лок, не пишем
+            documents = [document for document in documents if self.documents.get(document.project_id) is document
+                         and (document.dirty or document.needs_snapshot(now) or (snapshot and document.ops_since_snapshot))]
+            if not documents:
+                return
+
+            # Снимаем состояние и сбрасываем флаги до await: правки во время записи снова пометят документ
+            saved = {document.project_id: (document.dirty_since, document.journal, document.ops_since_snapshot,
+                                           document.snapshot_due)
+                     for document in documents}
+            snapshots = {}
+            journal_rows = []
+            for document in documents:
+                if snapshot or document.needs_snapshot(now):
+                    snapshots[document.project_id] = document.content
+                    document.ops_since_snapshot = 0
+                    document.snapshot_due = False
+                else:
+                    journal_rows.extend(_journal_row(document.project_id, changes) for changes in document.journal)
+                document.journal = []
+                document.dirty_since = None
+
+            try:
+                if journal_rows:
+                    await db.execute(insert(models.ProjectEdit), journal_rows)
+                if snapshots:
+                    # Один UPDATE на всю пачку: content = CASE id WHEN ... END
+                    await db.execute(update(models.Project)
+                                     .where(models.Project.id.in_(snapshots))
+                                     .values(content=case(snapshots, value=models.Project.id))
+                                     .execution_options(synchronize_session=False))
+                    await db.execute(delete(models.ProjectEdit)
+                                     .where(models.ProjectEdit.project_id.in_(snapshots))
+                                     .execution_options(synchronize_session=False))
+                await db.commit()
+            except Exception:
+                flush_errors.inc()
+                for document in documents:
+                    dirty_since, journal, ops, snapshot_due = saved[document.project_id]
+                    document.dirty_since = dirty_since
+                    document.journal = journal + document.journal
+                    document.ops_since_snapshot += ops if document.project_id in snapshots else 0
+                    document.snapshot_due = snapshot_due or document.project_id in snapshots
+                raise
+
+            flush_duration.observe(time.monotonic() - now)
+            flush_batch_size.observe(len(documents))
+            for dirty_since, *_ in saved.values():
+                if dirty_since is not None:
+                    flush_lag.observe(now - dirty_since)
+            persisted_bytes.inc(sum(len(orjson.dumps(row["changes"])) for row in journal_rows), kind="journal")
+            persisted_bytes.inc(sum(len(content.encode()) for content in snapshots.values()), kind="snapshot")
+
+registry = DocumentRegistry()
@@ -0,0 +1,74 @@
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from backend import metrics
+
+http_duration = metrics.registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route", "status"))
+http_db_queries = metrics.registry.histogram(
+    "http_request_db_queries", "SQL statements executed while serving one HTTP request", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+http_db_duration = metrics.registry.histogram(
+    "http_request_db_seconds", "Total SQL time spent while serving one HTTP request", ("route",))
+db_query_duration = metrics.registry.histogram(
+    "db_query_duration_seconds", "Duration of a single SQL statement")
+
+# Счётчик запросов к БД текущего HTTP-запроса: [число запросов, суммарное время]
+_request_queries: ContextVar[list | None] = ContextVar("request_queries", default=None)
+
+
+# Чистый ASGI-middleware без BaseHTTPMiddleware: не буферизует тело и не создаёт лишних задач.
+# Маршрут берём шаблоном (/api/projects/{project_id}), чтобы число рядов метрики не росло с id
+class MetricsMiddleware():
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        status = 500
+        queries = [0, 0.0]
+        token = _request_queries.set(queries)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_queries.reset(token)
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            http_duration.observe(time.monotonic() - started, method=scope["method"], route=route, status=status)
+            http_db_queries.observe(queries[0], route=route)
+            http_db_duration.observe(queries[1], route=route)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.monotonic())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.monotonic() - conn.info["query_started"].pop()
+    db_query_duration.observe(elapsed)
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+        queries[1] += elapsed
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
@@ -3,12 +3,19 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 
 from .routers.projects import router as projects_router
-from .routers.editor import router as ws_router
+from .routers.editor import router as ws_router, on_owner_left, on_ownership_lost
 from .routers.auth import router as auth_router
+from .routers.metrics import router as metrics_router
 
-from backend import models, database
+from backend import models, database, security
+from backend.instrumentation import MetricsMiddleware
+from config import settings
+from backend.ownership import ownership
+from backend.persistence import flusher
+from backend.socket_manager import manager
 
 # инициализация БД через lifespan
 async def init_db():
@@ -18,12 +25,31 @@ async def init_db():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    await manager.broker.start(manager.deliver)
+    await ownership.start(on_orphaned=on_owner_left, on_lost=on_ownership_lost)
+    flusher.start()
     yield
+    # Досохраняем всё, что не успел записать фоновый flusher, и только потом отдаём проекты
+    await flusher.stop()
+    owned = ownership.owned_projects()
+    await ownership.stop()
+    # Локи отпущены: прокси на других воркерах сразу переподключают клиентов к новому владельцу,
+    # не дожидаясь, пока заметят пропажу лока. Брокер при остановке дошлёт эти сообщения
+    for project_id in owned:
+        manager.publish(project_id, {"type": "owner_left"})
+    await manager.broker.stop()
+    security.hasher.shutdown()
     await database.engine.dispose()
 
 
 app = FastAPI(lifespan=lifespan)
 
+# Тексты проектов хорошо сжимаются; мелкие ответы не трогаем, а уровень 6 вместо 9
+# почти не уступает в размере, но заметно дешевле на документах в несколько МБ
+app.add_middleware(GZipMiddleware, minimum_size=settings.GZIP_MINIMUM_SIZE, compresslevel=6)
+# Снаружи GZip: в задержку попадает и сжатие ответа
+app.add_middleware(MetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -35,8 +61,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Курсор следующей страницы списка проектов и версия документа
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 app.include_router(projects_router)
 app.include_router(ws_router)
 app.include_router(auth_router)
+app.include_router(metrics_router)
@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend import metrics, models
+from backend.broker import ALL_WORKERS
+from backend.models import RoleEnum
+from backend.socket_manager import manager
+from config import settings
+
+cache_requests = metrics.registry.counter(
+    "membership_cache_requests_total", "Project membership lookups by cache result", ("result",))
+
+
+# Роль пользователя в проекте по (user_id, project_id); None - не участник, это тоже кэшируется.
+# Запись живёт не дольше ttl, а любая запись в user_projects сбрасывает затронутые ключи
+# на всех воркерах через брокер
+class MembershipCache():
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # (user_id, project_id) -> (истекает в, роль)
+        self.entries: OrderedDict[tuple[int, int], tuple[float, RoleEnum | None]] = OrderedDict()
+        # Растёт при каждом сбросе: результат запроса, начатого до сброса, в кэш не кладём
+        self.generation = 0
+
+    def get(self, user_id: int, project_id: int) -> tuple[bool, RoleEnum | None]:
+        key = (user_id, project_id)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            cache_requests.inc(result="miss")
+            return False, None
+        self.entries.move_to_end(key)
+        cache_requests.inc(result="hit")
+        return True, entry[1]
+
+    def put(self, user_id: int, project_id: int, role: RoleEnum | None, generation: int):
+        if generation != self.generation:
+            return
+        key = (user_id, project_id)
+        self.entries[key] = (time.monotonic() + self.ttl, role)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    async def lookup(self, user_id: int, project_id: int, db: AsyncSession) -> RoleEnum | None:
+        found, role = self.get(user_id, project_id)
+        if found:
+            return role
+        generation = self.generation
+        role = await db.scalar(select(models.UserProject.role)
+                               .where(models.UserProject.user_id == user_id,
+                                      models.UserProject.project_id == project_id))
+        self.put(user_id, project_id, role, generation)
+        return role
+
+    def discard(self, project_id: int, user_ids: list[int]):
+        self.generation += 1
+        for user_id in user_ids:
+            self.entries.pop((user_id, project_id), None)
+
+    def invalidate(self, project_id: int, user_ids: list[int]):
+        # Вызывается после commit: здесь сразу, на остальных воркерах - когда дойдёт сообщение
+        self.discard(project_id, user_ids)
+        manager.publish(ALL_WORKERS, {"type": "membership", "project": project_id, "users": user_ids})
+
+    def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+memberships = MembershipCache(settings.MEMBERSHIP_CACHE_SIZE, settings.MEMBERSHIP_CACHE_TTL)
+
+
+def on_membership_changed(_: int, message: dict):
+    memberships.discard(message["project"], message["users"])
+
+manager.handlers["membership"] = on_membership_changed
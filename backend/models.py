@@ -1,11 +1,15 @@
 from enum import Enum as PyEnum
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import List, Optional
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Table, Enum, func
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Boolean, DateTime, ForeignKey, Table, Enum, JSON, Index, func
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 
 from backend.database import Base
 
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class RoleEnum(PyEnum):
     EDITOR = 'editor'
     VIEWER = 'viewer'
@@ -13,6 +17,8 @@ class RoleEnum(PyEnum):
 
 class UserProject(Base):
     __tablename__ = 'user_projects'
+    # Первичный ключ (user_id, project_id) ищет проекты пользователя, а участников проекта - этот индекс
+    __table_args__ = (Index('ix_user_projects_project_id', 'project_id'),)
 
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
     project_id: Mapped[int] = mapped_column(ForeignKey('projects.id'), primary_key=True)
@@ -25,16 +31,36 @@ class UserProject(Base):
 class Project(Base):
     __tablename__ = "projects"
 
-    id: Mapped[int] = mapped_column(primary_key=True, index=True)  # Column(Integer, primary_key=True, index=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str] = mapped_column()
     content: Mapped[str] = mapped_column()
+    # onupdate срабатывает и на bulk UPDATE из flusher'а, так что это время последней записи текста.
+    # Время ставим на стороне Python и при вставке: оно служит версией для ETag и сравнивается
+    # при отдаче текста кусками, а now() в SQLite - с точностью до секунды и в другом формате
+    updated_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime(timezone=True), default=_utcnow, server_default=func.now(), onupdate=_utcnow, nullable=True
+    )
 
     users_link: Mapped[List["UserProject"]] = relationship(back_populates='project')
 
+# Журнал правок: пачки SingleChange, дописанные после последнего снимка в projects.content.
+# Текст проекта = content + все записи журнала по возрастанию id
+class ProjectEdit(Base):
+    __tablename__ = "project_edits"
+    # Журнал проекта читается по порядку id, а для ETag нужен его max(id) - оба берутся из одного индекса
+    __table_args__ = (Index('ix_project_edits_project_id_id', 'project_id', 'id'),)
+
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    project_id: Mapped[int] = mapped_column(ForeignKey('projects.id', ondelete='CASCADE'))
+    changes: Mapped[list] = mapped_column(JSON)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
 class User(Base):
     __tablename__ = "users"
 
-    id: Mapped[int] = mapped_column(primary_key=True, index=True) #Column(Integer, primary_key=True, index=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
     login:Mapped[str] = mapped_column(index=True, unique=True, nullable=False) #= Column(String, unique=True, nullable=False, index=True)
     hashed_password:Mapped[str] = mapped_column(nullable=False)#Column(String, nullable=False)
     is_active:Mapped[bool] = mapped_column(default=True)#Column(Boolean, default=True)
@@ -0,0 +1,64 @@
+from backend import schemas
+
+# Операционное преобразование для правок вида "заменить rangeLength символов с rangeOffset на text".
+# transform_change перестраивает правку так, чтобы её можно было применить после against,
+# сохранив намерение автора: чужой вставленный текст не удаляется, порядок вставок
+# в одну точку решает change_first
+
+
+def _change(offset: int, length: int, text: str) -> schemas.SingleChange:
+    return schemas.SingleChange(rangeOffset=offset, rangeLength=length, text=text)
+
+
+def transform_change(change: schemas.SingleChange, against: schemas.SingleChange,
+                     change_first: bool) -> list[schemas.SingleChange]:
+    start, end = change.rangeOffset, change.rangeOffset + change.rangeLength
+    against_start, against_end = against.rangeOffset, against.rangeOffset + against.rangeLength
+    delta = len(against.text) - against.rangeLength
+
+    # Чужая правка целиком левее - просто сдвигаемся
+    if start >= against_end and start > against_start:
+        return [_change(start + delta, change.rangeLength, change.text)]
+
+    result = []
+    tail = None
+    # Кусок нашего диапазона правее чужой правки удаляем отдельно
+    if end > against_end:
+        tail_start = max(start, against_end) + delta
+        tail = _change(tail_start, end + delta - tail_start, "")
+
+    if start < against_start:
+        head = _change(start, min(end, against_start) - start, change.text)
+    elif start == against_start and change_first:
+        head = _change(against_start, 0, change.text)
+    else:
+        head = _change(against_start + len(against.text), 0, change.text)
+
+    if tail is not None and head.rangeLength == 0 and head.rangeOffset == tail.rangeOffset:
+        return [_change(tail.rangeOffset, tail.rangeLength, change.text)]
+    if tail is not None:
+        result.append(tail)
+    if head.rangeLength or head.text:
+        result.append(head)
+    return result
+
+
+def transform(changes: list[schemas.SingleChange], against: list[schemas.SingleChange],
+              changes_first: bool = False) -> tuple[list[schemas.SingleChange], list[schemas.SingleChange]]:
+    # Обе последовательности применяются к одному и тому же тексту.
+    # Возвращает (changes после against, against после changes)
+    if not changes or not against:
+        return changes, against
+
+    if len(changes) == 1 and len(against) == 1:
+        return (transform_change(changes[0], against[0], changes_first),
+                transform_change(against[0], changes[0], not changes_first))
+
+    if len(changes) > 1:
+        first, against = transform(changes[:1], against, changes_first)
+        rest, against = transform(changes[1:], against, changes_first)
+        return first + rest, against
+
+    changes, first = transform(changes, against[:1], changes_first)
+    changes, rest = transform(changes, against[1:], changes_first)
+    return changes, first + rest
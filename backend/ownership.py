@@ -0,0 +1,219 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+import asyncpg
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Пространство ключей advisory-локов редактора, чтобы не пересекаться с другими локами в базе
+LOCK_NAMESPACE = 4242
+# Раз в OWNER_CHECK_INTERVAL секунд проверяем своё соединение и владельцев проектов, где мы прокси.
+# Упавшее соединение переоткрываем с паузой RECONNECT_DELAY
+OWNER_CHECK_INTERVAL = 5.0
+RECONNECT_DELAY = 1.0
+
+
+# Владелец проекта - единственный воркер, который держит буфер документа и пишет его в БД.
+# Остальные воркеры только проксируют правки своих клиентов владельцу через брокер.
+# LocalOwnership - вариант для одного процесса, где владелец всегда мы
+class LocalOwnership():
+    def __init__(self):
+        self.on_orphaned: Callable[[int], None] | None = None
+        self.on_lost: Callable[[int], Awaitable[None]] | None = None
+
+    async def start(self, on_orphaned: Callable[[int], None], on_lost: Callable[[int], Awaitable[None]] | None = None):
+        # on_orphaned - владелец проекта, где мы прокси, пропал; on_lost - мы сами потеряли лок проекта
+        self.on_orphaned = on_orphaned
+        self.on_lost = on_lost
+
+    async def stop(self):
+        self.on_orphaned = None
+        self.on_lost = None
+
+    async def acquire(self, project_id: int) -> bool:
+        return True
+
+    async def release(self, project_id: int, keep: bool = False) -> bool:
+        return not keep
+
+    async def release_idle(self, project_id: int) -> bool:
+        return True
+
+    def owns(self, project_id: int) -> bool:
+        return True
+
+    def owned_projects(self) -> list[int]:
+        # Одному процессу некого предупреждать об уходе
+        return []
+
+    def watch(self, project_id: int):
+        pass
+
+    def unwatch(self, project_id: int):
+        pass
+
+
+class PostgresOwnership(LocalOwnership):
+    def __init__(self, dsn: str, check_interval: float = OWNER_CHECK_INTERVAL):
+        super().__init__()
+        self.dsn = dsn
+        self.check_interval = check_interval
+        # Сессионные advisory-локи живут, пока жив коннект: упавший воркер отдаёт проекты сам
+        self._conn: asyncpg.Connection | None = None
+        self._lock = asyncio.Lock()
+        # project_id -> число наших соединений, которым нужен этот лок
+        self.owned: dict[int, int] = {}
+        # Проекты, где мы прокси и следим, жив ли владелец
+        self.watched: set[int] = set()
+        self._task: asyncio.Task | None = None
+        self._conn_lost = asyncio.Event()
+
+    async def start(self, on_orphaned: Callable[[int], None], on_lost: Callable[[int], Awaitable[None]] | None = None):
+        await super().start(on_orphaned, on_lost)
+        self._conn = await asyncpg.connect(self.dsn)
+        self._conn.add_termination_listener(self._on_conn_lost)
+        self._task = asyncio.create_task(self._watch_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            self._conn.remove_termination_listener(self._on_conn_lost)
+            await self._conn.close()
+            self._conn = None
+        self._conn_lost.clear()
+        self.owned.clear()
+        self.watched.clear()
+        await super().stop()
+
+    async def acquire(self, project_id: int) -> bool:
+        async with self._lock:
+            if project_id in self.owned:
+                self.owned[project_id] += 1
+                return True
+            if not await self._try_lock(project_id):
+                return False
+            self.owned[project_id] = 1
+            return True
+
+    async def release(self, project_id: int, keep: bool = False) -> bool:
+        # True - лок отпущен и другие воркеры могут забрать проект.
+        # keep - документ ещё в памяти (не удалось сохранить), лок держим до release_idle
+        async with self._lock:
+            if project_id not in self.owned:
+                return False
+            self.owned[project_id] -= 1
+            if self.owned[project_id] > 0 or keep:
+                return False
+            del self.owned[project_id]
+            await self._conn.fetchval("SELECT pg_advisory_unlock($1, $2)", LOCK_NAMESPACE, project_id)
+            return True
+
+    async def release_idle(self, project_id: int) -> bool:
+        # Документ без соединений наконец записан и выгружен - отпускаем оставленный лок
+        async with self._lock:
+            if self.owned.get(project_id) != 0:
+                return False
+            del self.owned[project_id]
+            await self._conn.fetchval("SELECT pg_advisory_unlock($1, $2)", LOCK_NAMESPACE, project_id)
+            return True
+
+    def owns(self, project_id: int) -> bool:
+        return project_id in self.owned
+
+    def owned_projects(self) -> list[int]:
+        return list(self.owned)
+
+    def watch(self, project_id: int):
+        self.watched.add(project_id)
+
+    def unwatch(self, project_id: int):
+        self.watched.discard(project_id)
+
+    async def _try_lock(self, project_id: int) -> bool:
+        if self._conn is None:
+            raise ConnectionError("Ownership connection is lost")
+        return await self._conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", LOCK_NAMESPACE, project_id)
+
+    def _on_conn_lost(self, connection):
+        self._conn_lost.set()
+
+    async def _watch_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._conn_lost.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._conn_lost.is_set() or not await self._alive():
+                await self._recover()
+                continue
+            for project_id in list(self.watched):
+                try:
+                    orphaned = await self._probe(project_id)
+                except Exception:
+                    logger.exception("Failed to check owner of project %s", project_id)
+                    continue
+                if orphaned and self.on_orphaned is not None:
+                    self.on_orphaned(project_id)
+
+    async def _alive(self) -> bool:
+        # Закрытый сокет видно сразу по termination listener, а зависшее соединение - только по запросу
+        try:
+            async with self._lock:
+                await asyncio.wait_for(self._conn.fetchval("SELECT 1"), self.check_interval)
+            return True
+        except Exception:
+            return False
+
+    async def _recover(self):
+        # Вместе с соединением пропали и все наши локи: проекты мог уже забрать другой воркер.
+        # Сначала перестаём быть владельцем, потом переподключаемся
+        async with self._lock:
+            lost = list(self.owned)
+            self.owned.clear()
+            old, self._conn = self._conn, None
+        if old is not None:
+            old.remove_termination_listener(self._on_conn_lost)
+            old.terminate()
+        logger.error("Lost the ownership connection, giving up projects %s", lost)
+        if self.on_lost is not None:
+            for project_id in lost:
+                try:
+                    await self.on_lost(project_id)
+                except Exception:
+                    logger.exception("Failed to give up project %s", project_id)
+        while True:
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                break
+            except Exception:
+                logger.warning("Failed to reconnect the ownership connection, retrying", exc_info=True)
+                await asyncio.sleep(RECONNECT_DELAY)
+        conn.add_termination_listener(self._on_conn_lost)
+        self._conn = conn
+        self._conn_lost.clear()
+
+    async def _probe(self, project_id: int) -> bool:
+        # Лок свободен - значит владелец умер, не попрощавшись. Сразу отпускаем его обратно:
+        # нового владельца выберут переподключившиеся клиенты
+        async with self._lock:
+            if project_id in self.owned or not await self._try_lock(project_id):
+                return False
+            await self._conn.fetchval("SELECT pg_advisory_unlock($1, $2)", LOCK_NAMESPACE, project_id)
+            return True
+
+
+def create_ownership() -> LocalOwnership:
+    if settings.BROKER == "postgres":
+        return PostgresOwnership(settings.DATABASE_URL.replace("+asyncpg", ""))
+    return LocalOwnership()
+
+ownership = create_ownership()
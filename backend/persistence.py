@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from backend import database
+from backend.documents import DocumentRegistry, registry
+from backend.ownership import ownership
+from backend.socket_manager import manager
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 2.0
+
+
+# Фоновая запись изменённых документов: раз в FLUSH_INTERVAL все грязные буферы
+# уходят в БД одним UPDATE, приём сообщений в редакторе больше не ждёт commit
+class FlushWorker():
+    def __init__(self, documents: DocumentRegistry, interval: float = FLUSH_INTERVAL):
+        self.documents = documents
+        self.interval = interval
+        self.session_factory = database.AsyncSessionLocal
+        self._task: asyncio.Task | None = None
+
+    async def flush(self):
+        documents = self.documents.dirty_documents()
+        if documents:
+            async with self.session_factory() as db:
+                await self.documents.persist(documents, db)
+        for project_id in await self.documents.evict_idle():
+            # Выгрузка при отключении не удалась, и лок оставался за документом до этой записи
+            if await ownership.release_idle(project_id):
+                manager.publish(project_id, {"type": "owner_left"})
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush documents")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+flusher = FlushWorker(registry)
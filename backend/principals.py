@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from backend import metrics, models, schemas
+from backend.broker import ALL_WORKERS
+from backend.socket_manager import manager
+from config import settings
+
+cache_requests = metrics.registry.counter(
+    "principal_cache_requests_total", "Principal lookups by cache result", ("result",))
+
+
+# Кэш авторизованных пользователей: строка users почти не меняется, а читается на каждом запросе.
+# Запись живёт не дольше ttl, при переполнении вытесняется давно не использованная.
+# Изменение пользователя сбрасывает его запись на всех воркерах через брокер
+class PrincipalCache():
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # user_id -> (истекает в, пользователь)
+        self.entries: OrderedDict[int, tuple[float, schemas.Principal]] = OrderedDict()
+
+    def get(self, user_id: int) -> schemas.Principal | None:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            cache_requests.inc(result="miss")
+            return None
+        self.entries.move_to_end(user_id)
+        cache_requests.inc(result="hit")
+        return entry[1]
+
+    def put(self, principal: schemas.Principal):
+        self.entries[principal.id] = (time.monotonic() + self.ttl, principal)
+        self.entries.move_to_end(principal.id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self.entries.pop(user_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+principals = PrincipalCache(settings.PRINCIPAL_CACHE_SIZE, settings.PRINCIPAL_CACHE_TTL)
+
+
+# Изменённый или удалённый через ORM пользователь сразу выпадает из кэша этого воркера,
+# а после commit - и из кэшей остальных: раньше они перечитали бы из базы старую строку
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_user(mapper, connection, target: models.User):
+    principals.invalidate(target.id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_users", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_changed_users(session: Session):
+    for user_id in session.info.pop("changed_users", ()):
+        principals.invalidate(user_id)
+        manager.publish(ALL_WORKERS, {"type": "principal", "user": user_id})
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_changed_users(session: Session, previous_transaction):
+    session.info.pop("changed_users", None)
+
+
+def on_principal_changed(_: int, message: dict):
+    principals.invalidate(message["user"])
+
+manager.handlers["principal"] = on_principal_changed
@@ -0,0 +1,54 @@
+import time
+
+from backend import metrics
+from config import settings
+
+throttled_frames = metrics.registry.counter(
+    "ws_throttled_frames_total", "Editor frames delayed by a rate limit", ("scope",))
+
+
+# Ведро токенов: rate токенов в секунду, не больше burst про запас.
+# reserve забирает токены даже в долг и возвращает, сколько подождать, пока долг не погасится,
+# поэтому ожидающие обслуживаются по очереди и никто не голодает
+class TokenBucket():
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, count: int = 1) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+# Общие вёдра проектов на этом воркере. Предел считается по воркеру, который держит сокет,
+# так что при нескольких воркерах комната может получить до rate на каждый из них
+class ProjectLimits():
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: dict[int, TokenBucket] = {}
+
+    def reserve(self, project_id: int, count: int = 1) -> float:
+        bucket = self.buckets.get(project_id)
+        if bucket is None:
+            bucket = self.buckets[project_id] = TokenBucket(self.rate, self.burst)
+        return bucket.reserve(count)
+
+    def discard(self, project_id: int):
+        self.buckets.pop(project_id, None)
+
+    def clear(self):
+        self.buckets.clear()
+
+project_limits = ProjectLimits(settings.EDIT_RATE_PER_PROJECT, settings.EDIT_BURST_PER_PROJECT)
+
+
+def connection_bucket() -> TokenBucket:
+    return TokenBucket(settings.EDIT_RATE_PER_CONNECTION, settings.EDIT_BURST_PER_CONNECTION)
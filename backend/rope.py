@@ -0,0 +1,148 @@
+import random
+
+# Декартово дерево по неявному ключу: в узлах лежат куски текста, ключ - позиция в документе.
+# Вставка и удаление стоят O(log n), строка целиком собирается только по запросу
+CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 2 * CHUNK_SIZE
+
+
+class _Node:
+    __slots__ = ('text', 'priority', 'left', 'right', 'size')
+
+    def __init__(self, text: str, priority: float | None = None):
+        self.text = text
+        self.priority = random.random() if priority is None else priority
+        self.left: _Node | None = None
+        self.right: _Node | None = None
+        self.size = len(text)
+
+
+def _size(node: _Node | None) -> int:
+    return node.size if node is not None else 0
+
+
+def _update(node: _Node):
+    node.size = _size(node.left) + len(node.text) + _size(node.right)
+
+
+def _merge(left: _Node | None, right: _Node | None) -> _Node | None:
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _split(node: _Node | None, pos: int) -> tuple[_Node | None, _Node | None]:
+    if node is None:
+        return None, None
+
+    left_size = _size(node.left)
+    if pos <= left_size:
+        left, right = _split(node.left, pos)
+        node.left = right
+        _update(node)
+        return left, node
+
+    pos -= left_size
+    if pos < len(node.text):
+        # Режем кусок текста пополам; правая половина наследует приоритет, чтобы не сломать кучу
+        tail = _Node(node.text[pos:], node.priority)
+        tail.right = node.right
+        _update(tail)
+        node.text = node.text[:pos]
+        node.right = None
+        _update(node)
+        return node, tail
+
+    left, right = _split(node.right, pos - len(node.text))
+    node.right = left
+    _update(node)
+    return node, right
+
+
+def _build(text: str) -> _Node | None:
+    # Строим дерево за O(n) стеком по правой ветке
+    stack: list[_Node] = []
+    for start in range(0, len(text), CHUNK_SIZE):
+        node = _Node(text[start:start + CHUNK_SIZE])
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+            _update(last)
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    while len(stack) > 1:
+        _update(stack.pop())
+    if not stack:
+        return None
+    _update(stack[0])
+    return stack[0]
+
+
+class Rope():
+    def __init__(self, text: str = ""):
+        self._root = _build(text)
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __str__(self) -> str:
+        parts = []
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            parts.append(node.text)
+            node = node.right
+        return "".join(parts)
+
+    def replace(self, offset: int, length: int, text: str):
+        # Те же границы, что и у срезов строки: выход за пределы документа обрезается
+        size = len(self)
+        offset = min(max(offset, 0), size)
+        length = min(max(length, 0), size - offset)
+
+        if self._replace_in_chunk(offset, length, text):
+            return
+
+        left, rest = _split(self._root, offset)
+        _, right = _split(rest, length)
+        self._root = _merge(_merge(left, _build(text)), right)
+
+    def _replace_in_chunk(self, offset: int, length: int, text: str) -> bool:
+        # Быстрый путь для набора текста: правка целиком внутри одного куска меняет его на месте
+        path = []
+        node = self._root
+        while node is not None:
+            left_size = _size(node.left)
+            if offset < left_size:
+                path.append(node)
+                node = node.left
+                continue
+            offset -= left_size
+            if offset + length <= len(node.text):
+                if len(node.text) - length + len(text) > MAX_CHUNK_SIZE:
+                    return False
+                node.text = node.text[:offset] + text + node.text[offset + length:]
+                path.append(node)
+                for parent in reversed(path):
+                    _update(parent)
+                return True
+            if offset < len(node.text):
+                return False
+            offset -= len(node.text)
+            path.append(node)
+            node = node.right
+        return False
@@ -21,12 +21,11 @@ async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_db))
 
     new_user = models.User(
         login = user.login,
-        hashed_password = security.get_password_hash(user.password)
+        hashed_password = await security.hasher.hash(user.password)
     )
 
     db.add(new_user)
     await db.commit()
-    await db.refresh(new_user)
 
     return {'message':'User successfully created'}
 
@@ -37,8 +36,15 @@ async def login(response: Response, user: schemas.UserCreate, db: AsyncSession =
     result = await db.execute(stmt)
     db_user = result.scalar_one_or_none()  #данные из БД
 
-    if not db_user or not security.verify_password(user.password, db_user.hashed_password):
+    if not db_user:
         raise HTTPException(status_code=401, detail="Incorrect login or password")
+    verified, new_hash = await security.hasher.verify_and_update(user.password, db_user.hashed_password)
+    if not verified:
+        raise HTTPException(status_code=401, detail="Incorrect login or password")
+    if new_hash is not None:
+        # Поменялась стоимость bcrypt - тихо перехэшируем пароль, пока он у нас в руках
+        db_user.hashed_password = new_hash
+        await db.commit()
 
     access_token = security.create_access_token(data={"sub": str(db_user.id)})
     csrf_token = str(uuid.uuid4())
@@ -1,70 +1,337 @@
+import asyncio
+import logging
 import time
 
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+import orjson
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-from backend.dependencies import get_current_user, get_db, get_current_user_ws
+from backend.dependencies import get_current_user, get_current_user_ws, get_session_factory
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from backend import models, schemas, database
+from backend import metrics, schemas, database, wire
+from backend.broker import ALL_WORKERS
+from backend.documents import Document, registry
+from backend.memberships import memberships
+from backend.models import RoleEnum
+from backend.ownership import ownership
+from backend.principals import principals
+from backend.ratelimit import connection_bucket, project_limits, throttled_frames
 from backend.socket_manager import manager
+from config import settings
 
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix='/ws'
 )
 
-updates = {}
-INTERVAL = 2.0
+messages_received = metrics.registry.counter(
+    "ws_messages_received_total", "Frames received from editor sockets", ("kind",))
+edit_apply_duration = metrics.registry.histogram(
+    "editor_apply_duration_seconds", "Time to transform and apply one batch of edit envelopes")
+batch_size = metrics.registry.histogram(
+    "editor_batch_size", "Edit envelopes coalesced into one apply and broadcast",
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+
+# Больше конвертов в одну пачку не собираем, даже если отправитель не умолкает
+MAX_BATCH = 64
+
+def parse_envelope(raw_data: str, decoded=None) -> tuple[str | None, schemas.ChangesEnvelope]:
+    # Исходный JSON можно переслать соседям, только если он проходит строгую проверку:
+    # иначе они получили бы "5" и 0.0, а сервер применил бы приведённые 5 и 0.
+    # decoded - уже разобранный raw_data, чтобы не разбирать кадр второй раз
+    if decoded is None:
+        decoded = orjson.loads(raw_data)
+    try:
+        return raw_data, schemas.ChangesEnvelope.model_validate(decoded, strict=True)
+    except ValidationError:
+        return None, schemas.ChangesEnvelope.model_validate(decoded)
+
+
+def changes_frame(raw_data: str | None, data: schemas.ChangesEnvelope,
+                  changes: list[schemas.SingleChange], revision: int) -> str | dict:
+    # Правка легла без преобразования - пересылаем исходный кадр, лишь дописав ревизию.
+    # Кадр со своей ревизией клиента собираем заново, чтобы не было двух ключей revision.
+    # У правок в msgpack исходного JSON нет
+    if raw_data is not None and changes is data.changes and data.revision is None and not data.model_extra:
+        frame = raw_data.rstrip()
+        if frame.endswith("}"):
+            return f'{frame[:-1]},"revision":{revision}}}'
+    return {"changes": [change.model_dump() for change in changes], "revision": revision}
+
+
+async def apply_edits(project_id: int, document: Document, frames: list[tuple[str | None, schemas.ChangesEnvelope]],
+                      sender_id: str, sender_ws: WebSocket | None = None):
+    # Подряд идущие конверты одного отправителя: каждый ложится своей ревизией,
+    # но отправитель получает один ack, а комната - один кадр со всеми правками по порядку.
+    # В БД буфер запишет фоновый flusher
+    started = time.monotonic()
+    applied = []
+    stale = False
+    for raw_data, data in frames:
+        changes = document.commit(data.changes, data.revision, sender_id)
+        if changes is None:
+            # Дальше конверты опираются на то же устаревшее состояние - клиенту нужен снимок
+            stale = True
+            break
+        applied.append(changes)
+    edit_apply_duration.observe(time.monotonic() - started)
+    batch_size.observe(len(frames))
+
+    if applied:
+        if len(frames) == 1:
+            frame = changes_frame(frames[0][0], frames[0][1], applied[0], document.revision)
+        else:
+            frame = {"changes": [change.model_dump() for changes in applied for change in changes],
+                     "revision": document.revision}
+        if not stale:
+            manager.send_to(project_id, sender_id, {"type": "ack", "revision": document.revision})
+        await manager.broadcast(sender_ws, project_id, frame, sender_id=sender_id)
+    if stale:
+        manager.send_to(project_id, sender_id, document.snapshot())
+
+
+# Сообщения комнаты от других воркеров. Правки и запросы снимков обрабатывает
+# только владелец документа, у остальных registry.get вернёт None
+
+async def on_proxied_edit(project_id: int, message: dict):
+    document = registry.get(project_id)
+    if document is None:
+        # Лок у нас, а буфер ещё не загружен или уже выгружен - молча терять правку нельзя:
+        # клиент переподключится и получит текст заново. Не-владельцы просто пропускают чужие правки
+        if ownership.owns(project_id):
+            manager.publish(project_id, {"type": "reconnect", "connection": message["connection"]})
+        return
+    try:
+        frames = [parse_envelope(raw_data) for raw_data in message["frames"]]
+    except ValueError:
+        return
+    await apply_edits(project_id, document, frames, message["connection"])
+
+
+def on_join(project_id: int, message: dict):
+    document = registry.get(project_id)
+    if document is not None:
+        manager.send_to(project_id, message["connection"], document.snapshot(), resync=True)
+
+
+async def on_replace(project_id: int, message: dict):
+    document = await registry.replace(project_id, message["content"])
+    if document is not None:
+        await manager.broadcast(None, project_id, document.snapshot())
+
+
+def on_owner_ready(project_id: int, message: dict):
+    # Владелец появился позже наших клиентов - повторяем запросы снимков, которые могли потеряться
+    for websocket in manager.connections.get(project_id, []):
+        outbox = manager.outboxes[websocket]
+        if outbox.resyncing and outbox.snapshot is None:
+            manager.publish(project_id, {"type": "join", "connection": outbox.connection_id})
+
+
+def on_reconnect(project_id: int, message: dict):
+    websocket = manager.by_id.get(message["connection"])
+    if websocket is not None:
+        manager.close(project_id, websocket, code=1012)
+
+
+def on_owner_left(project_id: int, message: dict | None = None):
+    # Владельца больше нет: закрываем проксируемые соединения, переподключившись,
+    # клиенты выберут нового владельца, а он загрузит документ из БД
+    if registry.get(project_id) is not None:
+        return
+    for websocket in manager.connections.get(project_id, [])[:]:
+        manager.close(project_id, websocket, code=1012)
+    ownership.unwatch(project_id)
+
+async def on_ownership_lost(project_id: int):
+    # Соединение с advisory-локами оборвалось, и проект мог уже забрать другой воркер.
+    # Правки больше не принимаем, буфер выбрасываем, а клиенты - и наши, и проксируемые с других
+    # воркеров - переподключаются к новому владельцу
+    for websocket in manager.connections.get(project_id, [])[:]:
+        manager.close(project_id, websocket, code=1012)
+    await registry.drop(project_id)
+    manager.publish(project_id, {"type": "owner_left"})
+
+
+def on_resync(project_id: int, message: dict | None = None):
+    # Брокер переподключался, и сообщения за время разрыва могли потеряться: кэши сбрасываем,
+    # а клиенты, чьи правки идут через брокер, переподключаются и получают свежий снимок
+    if project_id == ALL_WORKERS:
+        memberships.clear()
+        principals.clear()
+    elif registry.get(project_id) is not None:
+        manager.publish(project_id, {"type": "resync"})
+    else:
+        for websocket in manager.connections.get(project_id, [])[:]:
+            manager.close(project_id, websocket, code=1012)
+
+manager.handlers.update({
+    "edit": on_proxied_edit,
+    "join": on_join,
+    "replace": on_replace,
+    "owner_ready": on_owner_ready,
+    "owner_left": on_owner_left,
+    "reconnect": on_reconnect,
+    "resync": on_resync,
+})
+
+
+async def receive(websocket: WebSocket) -> str | bytes:
+    # Текстовый кадр - JSON, двоичный - msgpack, независимо от выбранного подпротокола
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    text = message.get("text")
+    return text if text is not None else message.get("bytes", b"")
+
 
 @router.websocket('/{project_id}')
 async def partial_ws_editing(project_id: int,
     websocket: WebSocket,
     # Используем get_current_user_ws
-    current_user: models.User = Depends(get_current_user_ws),
-    db: AsyncSession = Depends(get_db)
+    current_user: schemas.Principal = Depends(get_current_user_ws),
+    session_factory: async_sessionmaker[AsyncSession] = Depends(get_session_factory)
                              ):
-    find_project_stmt = select(models.UserProject).where(models.UserProject.user_id == current_user.id, models.UserProject.project_id == project_id)
-    user_project = await db.scalar(find_project_stmt)
-    if not user_project:
-        await websocket.close(code=1008)
-        return
-    try:
+    # Соединение с БД берём только на загрузку и выгрузку документа, а не на всё время жизни сокета
+    async with session_factory() as db:
+        role = await memberships.lookup(current_user.id, project_id, db)
+        if role is None:
+            await websocket.close(code=1008)
+            return
 
-        await websocket.accept()
-        await manager.add(project_id, websocket)
-
-        while True:
+        # Документ держит только воркер-владелец, остальные пересылают ему правки через брокер
+        document = None
+        if await ownership.acquire(project_id):
             try:
-                raw_data = await websocket.receive_json()
-                data = schemas.ChangesEnvelope.model_validate(raw_data)
-            except WebSocketDisconnect:
-                # Если клиент отключился, прокидываем исключение выше, чтобы выйти из цикла
-                raise
-            except Exception as e:
-                print("Ошибка валидации или дисконнект: ", e)
-                continue
+                document = await registry.acquire(project_id, db)
+            finally:
+                # Проекта нет или загрузка упала - лок не должен остаться за нами
+                if document is None:
+                    await ownership.release(project_id)
+            if document is None:
+                await websocket.close(code=1008)
+                return
+    try:
+        # Кодировку кадров от сервера выбирает подпротокол; принимаем и текстовые, и двоичные кадры
+        protocol = wire.negotiate(websocket.scope.get("subprotocols", []))
+        binary = protocol == wire.MSGPACK
+        await websocket.accept(subprotocol=protocol)
+        if document is not None:
+            # Если клиент не успевает читать, вместо очереди правок он получит свежий снимок
+            connection_id = await manager.add(project_id, websocket, snapshot=document.snapshot, binary=binary)
+            # Новый участник получает текст вместе с ревизией, от которой дальше считает свои правки
+            manager.send(project_id, websocket, document.snapshot())
+            manager.send_presence(project_id, websocket)
+            if document.connections == 1:
+                manager.publish(project_id, {"type": "owner_ready"})
+        else:
+            connection_id = await manager.add(project_id, websocket, waiting=True, binary=binary)
+            ownership.watch(project_id)
+            manager.publish(project_id, {"type": "join", "connection": connection_id})
 
-            project = await db.get(models.Project, project_id)
+        def read(message: str | bytes) -> tuple[str | None, schemas.ChangesEnvelope] | None:
+            # Правка - (исходный JSON или None для msgpack, конверт). Курсоры идут мимо пределов,
+            # проверки роли и сессии и обрабатываются сразу; для них и для мусора - None
+            raw_data = None
+            try:
+                if isinstance(message, bytes):
+                    data = wire.unpack(message)
+                else:
+                    # Кадр разбираем один раз, вид сообщения решает поле type
+                    decoded = orjson.loads(message)
+                    if isinstance(decoded, dict) and decoded.get("type") == "presence":
+                        data = schemas.PresenceUpdate.model_validate(decoded)
+                    else:
+                        raw_data, data = parse_envelope(message, decoded)
+            except ValueError as e:
+                messages_received.inc(kind="invalid")
+                logger.debug("Invalid editor message in project %s: %s", project_id, e)
+                return None
+            if isinstance(data, schemas.PresenceUpdate):
+                messages_received.inc(kind="presence")
+                manager.update_presence(project_id, connection_id,
+                                        {"user": current_user.login, **data.model_dump(exclude={"type"})})
+                return None
+            return raw_data, data
 
-            if not project:
+        bucket = connection_bucket()
+        last_frame_at = 0.0
+        closing = False
+        while not closing:
+            frame = read(await receive(websocket))
+            if frame is None:
                 continue
+            batch = [frame]
+            started = time.monotonic()
+            # Отправитель шлёт кадры чаще окна - собираем его всплеск целиком, одиночное нажатие не ждёт
+            if started - last_frame_at < settings.EDIT_COALESCE_WINDOW:
+                deadline = started + settings.EDIT_COALESCE_WINDOW
+                while len(batch) < MAX_BATCH and (remaining := deadline - time.monotonic()) > 0:
+                    try:
+                        frame = read(await asyncio.wait_for(receive(websocket), remaining))
+                        if frame is not None:
+                            batch.append(frame)
+                    except asyncio.TimeoutError:
+                        break
+                    except WebSocketDisconnect:
+                        # Уже принятые правки применяем, потом выходим из цикла
+                        closing = True
+                        break
+            last_frame_at = time.monotonic()
 
-            current_text = project.content
-            for change in data.changes:
-                offset = change.rangeOffset
-                length = change.rangeLength
-                new_text = change.text
-                current_text = current_text[:offset] + new_text + current_text[offset + length:]
+            # Пока ждём токены, сокет не читаем - дальше клиента сдерживает TCP
+            own_wait = bucket.reserve(len(batch))
+            room_wait = project_limits.reserve(project_id, len(batch))
+            wait = max(own_wait, room_wait)
+            if wait > 0:
+                throttled_frames.inc(len(batch), scope="connection" if own_wait >= room_wait else "project")
+                manager.send(project_id, websocket, {"type": "throttle", "retry_after": round(wait, 3)})
+                await asyncio.sleep(wait)
 
-            project.content = current_text
+            # Роль проверяем на каждой пачке: её могли поменять или отозвать, пока сокет открыт.
+            # Сессия здесь не берёт соединение, пока кэш отвечает сам
+            async with session_factory() as db:
+                role = await memberships.lookup(current_user.id, project_id, db)
+            if role is None:
+                await websocket.close(code=1008)
+                break
+            if role != RoleEnum.EDITOR:
+                messages_received.inc(len(batch), kind="rejected")
+                manager.send(project_id, websocket, {"type": "error", "detail": "Read-only access to project"})
+                continue
 
-            update_time = updates.get(project_id)
-            cur_time = time.time()
-            if not update_time or cur_time - update_time > INTERVAL:
-                await db.commit()
-                updates[project_id] = cur_time
+            if document is None:
+                messages_received.inc(len(batch), kind="proxied")
+                # Между воркерами правки ходят в JSON
+                manager.publish(project_id, {"type": "edit", "connection": connection_id,
+                                             "frames": [raw_data if raw_data is not None else wire.to_json(data)
+                                                        for raw_data, data in batch]})
+                continue
 
-            await manager.broadcast(websocket, project_id, raw_data)
+            if registry.get(project_id) is not document:
+                # Лок потерян, документ выброшен - сокет уже закрывается
+                break
+            messages_received.inc(len(batch), kind="edit")
+            await apply_edits(project_id, document, batch, connection_id, websocket)
 
     except WebSocketDisconnect:
-        manager.remove(project_id, websocket)
\ No newline at end of file
+        pass
+    finally:
+        manager.remove(project_id, websocket)
+        if document is not None and registry.get(project_id) is document:
+            # Последний отключившийся сохраняет буфер и выгружает его из памяти
+            try:
+                async with session_factory() as db:
+                    await registry.release(project_id, db)
+            except Exception:
+                logger.exception("Failed to save project %s on disconnect, the flusher will retry", project_id)
+            finally:
+                # Несохранённый буфер остаётся владельцем: лок отпустит flusher, когда запишет и выгрузит его
+                if await ownership.release(project_id, keep=registry.get(project_id) is not None):
+                    manager.publish(project_id, {"type": "owner_left"})
+        elif project_id not in manager.connections:
+            ownership.unwatch(project_id)
+        if project_id not in manager.connections:
+            project_limits.discard(project_id)
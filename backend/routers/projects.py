@@ -1,38 +1,198 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select, exists, and_
-from sqlalchemy.ext.asyncio import AsyncSession
+import base64
+import logging
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import LargeBinary, select, and_, func, delete, cast
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from backend import models, schemas
-from backend.dependencies import get_db, get_current_user
+from backend.dependencies import get_db, get_current_user, get_session_factory
+from backend.documents import load_content, registry
+from backend.memberships import memberships
+from backend.socket_manager import manager
 from backend.models import RoleEnum
+from config import settings
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix='/api/projects'
 )
-@router.post('/{project_id}/share')
-async def project_share(project_id: int, project_share: schemas.ProjectShare, current_user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    check_access = select(models.UserProject).where(models.UserProject.user_id == current_user.id, models.UserProject.project_id == project_id)
-    if not await db.scalar(check_access):
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+# Курсор - непрозрачный токен с id последнего отданного проекта
+def encode_cursor(project_id: int) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps({"id": project_id})).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        project_id = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["id"]
+    except (ValueError, TypeError, KeyError):
+        # ValueError покрывает и binascii.Error, и JSONDecodeError, и не-ASCII символы в курсоре
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(project_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return project_id
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+async def require_role(project_id: int, current_user: schemas.Principal, db: AsyncSession,
+                       write: bool = False) -> RoleEnum:
+    # Роль берём из кэша; чужой проект неотличим от несуществующего
+    role = await memberships.lookup(current_user.id, project_id, db)
+    if role is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if write and role != RoleEnum.EDITOR:
+        raise HTTPException(status_code=403, detail="Read-only access to project")
+    return role
+
+
+async def publish_content(project_id: int, content: str):
+    # Открытый в редакторе буфер уже получил новый текст в registry.rewrite - рассылаем его участникам
+    document = registry.get(project_id)
+    if document is not None:
+        await manager.broadcast(None, project_id, document.snapshot())
+    else:
+        # Документ может быть открыт на другом воркере - пусть владелец подхватит новый текст
+        manager.publish(project_id, {"type": "replace", "content": content})
+
+
+async def project_version(project_id: int, db: AsyncSession):
+    # Метаданные проекта без текста и ETag его текущей версии.
+    # Открытый документ версионируется ревизией буфера, закрытый - временем последнего снимка
+    # и последней записью журнала (если документ открыт на другом воркере)
+    last_edit = (select(func.max(models.ProjectEdit.id))
+                 .where(models.ProjectEdit.project_id == project_id)
+                 .scalar_subquery())
+    find_project_stmt = (select(models.Project.id, models.Project.title, models.Project.updated_at,
+                                last_edit.label("last_edit"))
+                         .where(models.Project.id == project_id))
+    project = (await db.execute(find_project_stmt)).first()
+    if project is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    document = registry.get(project_id)
+    if document is not None:
+        etag = f'"{document.version}"'
+    elif project.updated_at is not None:
+        etag = f'"{project.updated_at.timestamp()}-{project.last_edit or 0}"'
+    else:
+        etag = None
+    return project, document, etag
+
+
+async def slice_text(content: str):
+    for start in range(0, len(content), settings.CONTENT_CHUNK_SIZE):
+        yield content[start:start + settings.CONTENT_CHUNK_SIZE].encode()
+
+
+class SnapshotChanged(Exception):
+    pass
+
+
+class SnapshotResponse(StreamingResponse):
+    async def stream_response(self, send) -> None:
+        # Заголовки уже ушли: ответ не завершаем, сервер закрывает соединение,
+        # и клиент видит оборванное тело, а не смесь двух версий
+        try:
+            await super().stream_response(send)
+        except SnapshotChanged:
+            pass
+
+
+async def read_snapshot(project_id: int, updated_at, session_factory: async_sessionmaker[AsyncSession]):
+    # Снимок из БД по кускам через substr, целиком он в память не попадает.
+    # На каждый кусок своя короткая сессия: соединение из пула не держится всю отдачу.
+    # Условие на updated_at ловит снимок, переписанный посреди отдачи
+    size = settings.CONTENT_CHUNK_SIZE
+    start = 1
+    while True:
+        async with session_factory() as db:
+            chunk = await db.scalar(select(func.substr(models.Project.content, start, size))
+                                    .where(models.Project.id == project_id, models.Project.updated_at == updated_at))
+        if chunk is None:
+            logger.warning("Project %s content changed while streaming, aborting the response", project_id)
+            raise SnapshotChanged(project_id)
+        if chunk:
+            yield chunk.encode()
+        if len(chunk) < size:
+            return
+        start += size
+
+
+def resolve_members(project_id: int, current_user_id: int, logins: list[str]):
+    # Один запрос на всё: роль текущего пользователя, число редакторов проекта, id нужных логинов и их текущие роли.
+    # Строка из CTE access приходит всегда, даже если ни один логин не найден
+    access = select(
+        select(models.UserProject.role)
+        .where(models.UserProject.user_id == current_user_id, models.UserProject.project_id == project_id)
+        .scalar_subquery().label("access_role"),
+        select(func.count())
+        .select_from(models.UserProject)
+        .where(models.UserProject.project_id == project_id, models.UserProject.role == RoleEnum.EDITOR)
+        .scalar_subquery().label("editors"),
+    ).cte("access")
+    membership = models.UserProject.__table__.alias("membership")
+    return (select(access.c.access_role, access.c.editors, models.User.id, models.User.login, membership.c.role)
+            .select_from(access)
+            .outerjoin(models.User, models.User.login.in_(logins))
+            .outerjoin(membership, and_(membership.c.user_id == models.User.id,
+                                        membership.c.project_id == project_id)))
+
+
+def require_manager(access) -> None:
+    # Состав участников меняет только редактор; роль берём из того же запроса, без кэша
+    if access.access_role is None:
         raise HTTPException(status_code=403, detail="Current user has no access to project")
+    if access.access_role != RoleEnum.EDITOR:
+        raise HTTPException(status_code=403, detail="Read-only access to project")
 
-    target_user = await db.scalar(
-        select(models.User).where(models.User.login == project_share.login)
-    )
-    if not target_user:
-        raise HTTPException(status_code=404, detail="User not found")
 
-    target_user_project_exists = await db.scalar(
-        select(models.UserProject).where(models.UserProject.project_id == project_id, models.UserProject.user_id == target_user.id)
-    )
-    if target_user_project_exists:
+def content_size(db: AsyncSession):
+    # Размер текста в байтах. В Postgres octet_length берёт его из заголовка TOAST, не распаковывая текст
+    # (length в UTF-8 пришлось бы читать целиком); в SQLite octet_length появился только в 3.43
+    if db.get_bind().dialect.name == "postgresql":
+        return func.octet_length(models.Project.content)
+    return func.length(cast(models.Project.content, LargeBinary))
+
+
+def insert_for(db: AsyncSession):
+    # INSERT ... ON CONFLICT есть в обоих диалектах, но конструкции у SQLAlchemy разные
+    return postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+
+
+@router.post('/{project_id}/share')
+async def project_share(project_id: int, project_share: schemas.ProjectShare, current_user: schemas.Principal = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    rows = (await db.execute(resolve_members(project_id, current_user.id, [project_share.login]))).all()
+    require_manager(rows[0])
+
+    target_user = rows[0]
+    if target_user.id is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if target_user.role is not None:
         raise HTTPException(status_code=400, detail="User already has access")
 
-    db.add(models.UserProject(
-        user_id=target_user.id,
-        project_id=project_id,
-        role=project_share.role
-    ))
+    # Параллельный запрос мог успеть добавить того же пользователя - тогда вставка ничего не сделает
+    stmt = (insert_for(db)(models.UserProject)
+            .values(user_id=target_user.id, project_id=project_id, role=project_share.role)
+            .on_conflict_do_nothing(index_elements=["user_id", "project_id"]))
+    result = await db.execute(stmt)
+    if result.rowcount == 0:
+        raise HTTPException(status_code=400, detail="User already has access")
     await db.commit()
+    memberships.invalidate(project_id, [target_user.id])
 
     return {
         "message": "User successfully added",
@@ -40,49 +200,205 @@ async def project_share(project_id: int, project_share: schemas.ProjectShare, cu
         "role": project_share.role
     }
 
-@router.put('/{project_id}', response_model=schemas.Project)
-async def project_put(project_id: int, project_update: schemas.ProjectCreate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    find_project_stmt = (select(models.Project)
-                         .join(models.UserProject)
+
+@router.post('/{project_id}/share/bulk', response_model=list[schemas.ShareResult])
+async def project_share_bulk(project_id: int, bulk: schemas.ProjectShareBulk, current_user: schemas.Principal = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Повторный логин в списке - побеждает последняя роль
+    requested = {member.login: member.role for member in bulk.members}
+    rows = (await db.execute(resolve_members(project_id, current_user.id, list(requested)))).all()
+    require_manager(rows[0])
+    found = {row.login: row for row in rows if row.id is not None}
+
+    results = []
+    upserts = []
+    for login, role in requested.items():
+        row = found.get(login)
+        if row is None:
+            status = "not_found"
+        elif row.id == current_user.id:
+            # Свою роль не меняем: так редактор не может случайно разжаловать последнего редактора - себя.
+            # Остальные строки пачки применяются как обычно
+            results.append(schemas.ShareResult(login=login, role=row.role, status="forbidden_self"))
+            continue
+        elif row.role is None:
+            status = "added"
+        elif row.role != role:
+            status = "updated"
+        else:
+            status = "unchanged"
+        if status in ("added", "updated"):
+            upserts.append({"user_id": row.id, "project_id": project_id, "role": role})
+        results.append(schemas.ShareResult(login=login, role=role, status=status))
+
+    if upserts:
+        stmt = insert_for(db)(models.UserProject).values(upserts)
+        stmt = stmt.on_conflict_do_update(index_elements=["user_id", "project_id"], set_={"role": stmt.excluded.role})
+        await db.execute(stmt)
+        await db.commit()
+        memberships.invalidate(project_id, [upsert["user_id"] for upsert in upserts])
+    return results
+
+
+@router.post('/{project_id}/unshare/bulk', response_model=list[schemas.ShareResult])
+async def project_unshare_bulk(project_id: int, bulk: schemas.ProjectUnshareBulk, current_user: schemas.Principal = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    logins = list(dict.fromkeys(bulk.logins))
+    rows = (await db.execute(resolve_members(project_id, current_user.id, logins))).all()
+    require_manager(rows[0])
+    found = {row.login: row for row in rows if row.id is not None}
+
+    results = []
+    for login in logins:
+        row = found.get(login)
+        if row is None:
+            results.append(schemas.ShareResult(login=login, status="not_found"))
+        elif row.role is None:
+            results.append(schemas.ShareResult(login=login, status="not_member"))
+        else:
+            results.append(schemas.ShareResult(login=login, role=row.role, status="removed"))
+
+    members = [found[result.login].id for result in results if result.status == "removed"]
+    removed_editors = sum(1 for result in results if result.status == "removed" and result.role == RoleEnum.EDITOR)
+    if removed_editors >= rows[0].editors:
+        raise HTTPException(status_code=400, detail="Project must keep at least one editor")
+    if members:
+        await db.execute(delete(models.UserProject)
                          .where(models.UserProject.project_id == project_id,
-                                models.UserProject.user_id == current_user.id))
-    project = await db.scalar(find_project_stmt)
+                                models.UserProject.user_id.in_(members)))
+        await db.commit()
+        memberships.invalidate(project_id, members)
+    return results
 
-    if not project:
+@router.put('/{project_id}', response_model=schemas.Project)
+async def project_put(project_id: int, project_update: schemas.ProjectCreate, db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(get_current_user)):
+    await require_role(project_id, current_user, db, write=True)
+    # Новый текст - это новый снимок, журнал правок старого текста больше не нужен
+    if not await registry.rewrite(project_id, project_update.content, db, title=project_update.title):
         raise HTTPException(status_code=404, detail="Project not found")
+    await publish_content(project_id, project_update.content)
+    return {"id": project_id, "title": project_update.title, "content": project_update.content}
 
-    project.title = project_update.title
-    project.content = project_update.content
 
-    await db.commit()
-    await db.refresh(project)
-    return project
+@router.get('/{project_id}', response_model=schemas.Project)
+async def project_get(project_id: int, response: Response,
+                      if_none_match: str | None = Header(default=None),
+                      db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(get_current_user)):
+    # Сначала проверяем доступ и версию, текст читаем, только если он действительно нужен клиенту
+    await require_role(project_id, current_user, db)
+    project, document, etag = await project_version(project_id, db)
 
+    if etag is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
 
-@router.get('/{project_id}', response_model=schemas.Project)
-async def project_get(project_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    find_project_stmt = (select(models.Project)
-                       .join(models.UserProject)
-                       .where(models.UserProject.project_id == project_id,
-                              models.UserProject.user_id == current_user.id))
-    project = await db.scalar(find_project_stmt)
-    if project is None:
+    if document is not None:
+        content = document.content
+    else:
+        content, _ = await load_content(project_id, db)
+    return schemas.Project(id=project.id, title=project.title, content=content)
+
+
+# Текст проекта как есть, без JSON: большой документ не собирается в памяти целиком
+# ни при отдаче, ни вместе с копиями для модели и сериализации
+@router.get('/{project_id}/content')
+async def project_content_get(project_id: int,
+                              if_none_match: str | None = Header(default=None),
+                              db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(get_current_user),
+                              session_factory: async_sessionmaker[AsyncSession] = Depends(get_session_factory)):
+    await require_role(project_id, current_user, db)
+    project, document, etag = await project_version(project_id, db)
+    headers = {"ETag": etag} if etag is not None else {}
+    if etag is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    if document is not None:
+        chunks = slice_text(document.content)
+    elif project.last_edit is not None:
+        # Хвост журнала накладывается только на весь текст сразу
+        content, _ = await load_content(project_id, db)
+        chunks = slice_text(content)
+    else:
+        chunks = read_snapshot(project_id, project.updated_at, session_factory)
+    # Сессия запроса закрывается только после отдачи тела, соединение отпускаем сразу
+    await db.close()
+    return SnapshotResponse(chunks, media_type="text/plain", headers=headers)
+
+
+@router.put('/{project_id}/content', status_code=204)
+async def project_content_put(project_id: int, request: Request,
+                              content_length: int | None = Header(default=None),
+                              db: AsyncSession = Depends(get_db), current_user: schemas.Principal = Depends(get_current_user)):
+    await require_role(project_id, current_user, db, write=True)
+    if content_length is not None and content_length > settings.MAX_CONTENT_SIZE:
+        raise HTTPException(status_code=413, detail="Content is too large")
+
+    # Тело копим в одном буфере по мере прихода; без Content-Length (chunked) предел проверяем по прочитанному.
+    # Целиком текст всё равно нужен: он пишется одним значением и заменяет буфер открытого документа
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > settings.MAX_CONTENT_SIZE:
+            raise HTTPException(status_code=413, detail="Content is too large")
+    try:
+        content = body.decode()
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Content must be UTF-8 text")
+    del body
+
+    # UPDATE без загрузки проекта: старый текст в память не читаем
+    if not await registry.rewrite(project_id, content, db):
         raise HTTPException(status_code=404, detail="Project not found")
-    return project
+    await publish_content(project_id, content)
+    return Response(status_code=204)
+
 
+@router.get('/{project_id}/changes', response_model=schemas.ProjectChanges)
+async def project_changes(project_id: int, since: str, response: Response, db: AsyncSession = Depends(get_db),
+                          current_user: schemas.Principal = Depends(get_current_user)):
+    # since - ETag, полученный клиентом раньше. Если правки с тех пор ещё в истории, отдаём только их
+    await require_role(project_id, current_user, db)
 
-@router.get('', response_model=list[schemas.Project])
-async def project_getAll(current_user: models.User = Depends(get_current_user),db: AsyncSession = Depends(get_db)):
-    stmt = (select(models.Project)
+    document = registry.get(project_id)
+    epoch, _, revision = since.strip('"').partition(".")
+    changes = None
+    if document is not None and epoch == document.epoch and revision.isdigit():
+        changes = document.changes_since(int(revision))
+    if changes is None:
+        raise HTTPException(status_code=410, detail="Changes are no longer available, fetch the project")
+
+    response.headers["ETag"] = f'"{document.version}"'
+    return schemas.ProjectChanges(
+        revision=document.revision,
+        changes=[change for revision_changes in changes for change in revision_changes],
+    )
+
+
+@router.get('', response_model=list[schemas.ProjectSummary])
+async def project_getAll(response: Response,
+                         limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         cursor: str | None = None,
+                         current_user: schemas.Principal = Depends(get_current_user),db: AsyncSession = Depends(get_db)):
+    # Текст в список не попадает: размер в байтах считает сама база, content из неё не читаем
+    stmt = (select(models.Project.id, models.Project.title,
+                   func.coalesce(content_size(db), 0).label("size"),
+                   models.UserProject.role, models.Project.updated_at)
             .join(models.UserProject)
             .where(current_user.id == models.UserProject.user_id)
-            .order_by(models.Project.id.desc()))
-    result = await db.execute(stmt)
-    return result.scalars().all()
+            .order_by(models.Project.id.desc())
+            .limit(limit + 1))
+    if cursor is not None:
+        # Keyset вместо OFFSET: следующая страница начинается сразу после последнего id
+        stmt = stmt.where(models.Project.id < decode_cursor(cursor))
+    rows = (await db.execute(stmt)).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].id)
+    return [schemas.ProjectSummary.model_validate(row) for row in rows]
 
 
 @router.post("", response_model=schemas.Project)
-async def project_create(project: schemas.ProjectCreate, current_user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+async def project_create(project: schemas.ProjectCreate, current_user: schemas.Principal = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     new_project = models.Project(title=project.title, content=project.content)
 
     db.add(new_project)
@@ -94,6 +410,7 @@ async def project_create(project: schemas.ProjectCreate, current_user: models.Us
         role = RoleEnum.EDITOR
     ))
     await db.commit()
-    await db.refresh(new_project)
+    # Раньше этот id мог попасть в кэш как чужой
+    memberships.invalidate(new_project.id, [current_user.id])
 
     return new_project
\ No newline at end of file
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional, List
+from typing import Literal, Optional, List, Tuple
 from datetime import datetime
 from backend import models
 # Создаем схемы для валидирования pydantic, для получения и отправки данных на фронт
@@ -18,10 +18,33 @@ class Project(ProjectBase):
     id: int
 
     model_config = ConfigDict(from_attributes = True)
+# Схема для СПИСКА: без текста, только то, что нужно карточке проекта
+class ProjectSummary(BaseModel):
+    id: int
+    title: str
+    size: int
+    role: models.RoleEnum
+    updated_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes = True)
+
 class ProjectShare(BaseModel):
     login: str
     role: models.RoleEnum = models.RoleEnum.VIEWER
 
+# Массовое добавление и удаление участников
+class ProjectShareBulk(BaseModel):
+    members: List[ProjectShare] = Field(min_length=1, max_length=500)
+
+class ProjectUnshareBulk(BaseModel):
+    logins: List[str] = Field(min_length=1, max_length=500)
+
+class ShareResult(BaseModel):
+    login: str
+    role: Optional[models.RoleEnum] = None
+    # added, updated, unchanged, removed, not_member, not_found, forbidden_self
+    status: str
+
 class SingleChange(BaseModel):
     rangeLength: int
     rangeOffset: int
@@ -29,11 +52,36 @@ class SingleChange(BaseModel):
 
 class ChangesEnvelope(BaseModel):
     changes: List[SingleChange]
+    # Ревизия документа, на которую опирается клиент; None - применить как есть
+    revision: Optional[int] = None
+
+    # Лишние поля не отбрасываем молча: по ним редактор решает, можно ли переслать кадр как есть
+    model_config = ConfigDict(extra="allow")
+
+# Курсор и выделения участника: смещения в тексте, выделение - [начало, конец).
+# В БД не пишется и через журнал правок не проходит
+class PresenceUpdate(BaseModel):
+    type: Literal["presence"]
+    cursor: Optional[int] = None
+    selections: List[Tuple[int, int]] = Field(default_factory=list, max_length=32)
+
+# Правки документа после известной клиенту версии, применяются по порядку
+class ProjectChanges(BaseModel):
+    revision: int
+    changes: List[SingleChange]
 
 class UserCreate(BaseModel):
     login: str = Field(min_length=4, max_length=32)
     password: str
 
+# Авторизованный пользователь: то, что зависимости отдают в роутеры и держат в кэше
+class Principal(BaseModel):
+    id: int
+    login: str
+    is_active: bool
+    is_superuser: bool
+    model_config = ConfigDict(from_attributes = True, frozen = True)
+
 class UserResponse(BaseModel):
     id: int
     login: str
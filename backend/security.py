@@ -1,14 +1,27 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import jwt
 from passlib.context import CryptContext
+from backend import metrics
 from config import settings
 
 SECRET_KEY = settings.SECRET_KEY
 ALGORITHM = settings.ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.ACCESS_TOKEN_EXPIRE_MINUTES
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# min_rounds = max_rounds = rounds: хэши с любой другой стоимостью, и слабее, и дороже текущей,
+# пересчитываются при следующем входе - иначе снижение BCRYPT_ROUNDS не ускорило бы вход старых пользователей
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=settings.BCRYPT_ROUNDS, bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=settings.BCRYPT_ROUNDS)
+
+password_queue_depth = metrics.registry.gauge(
+    "password_hash_queue_depth", "Password operations waiting for a free worker")
+password_duration = metrics.registry.histogram(
+    "password_hash_duration_seconds", "Time to hash or verify a password, including queueing", ("operation",))
 
 
 def verify_password(plain_password, hashed_password):
@@ -28,4 +41,41 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
\ No newline at end of file
+    return encoded_jwt
+
+
+# bcrypt занимает сотни миллисекунд и отпускает GIL, поэтому считаем его в отдельных потоках,
+# чтобы не останавливать event loop вместе со всеми сокетами редактора.
+# Размер пула ограничивает число одновременных операций, остальные ждут в очереди пула
+class PasswordHasher():
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.in_flight = 0
+        self._executor: ThreadPoolExecutor | None = None
+
+    async def _run(self, operation: str, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="password")
+        started = time.monotonic()
+        self.in_flight += 1
+        password_queue_depth.set(max(0, self.in_flight - self.workers))
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            password_queue_depth.set(max(0, self.in_flight - self.workers))
+            password_duration.observe(time.monotonic() - started, operation=operation)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", get_password_hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> tuple[bool, str | None]:
+        # Второй элемент - новый хэш, если параметры стоимости поменялись
+        return await self._run("verify", pwd_context.verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS)
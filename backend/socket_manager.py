@@ -1,32 +1,297 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+import orjson
 from fastapi import WebSocket
 
+from backend import metrics, wire
+from backend.broker import LocalBroker, create_broker
+
+# Сколько сообщений может ждать отправки одному клиенту, прежде чем он считается медленным
+SEND_QUEUE_SIZE = 256
+# Курсоры комнаты рассылаются не чаще раза в PRESENCE_INTERVAL секунд, только последнее состояние каждого
+PRESENCE_INTERVAL = 0.05
+
+# Без метки проекта: число рядов росло бы вместе с числом проектов
+fanout_latency = metrics.registry.histogram(
+    "ws_fanout_latency_seconds", "Time from broadcast to delivery to a peer")
+slow_consumers = metrics.registry.counter(
+    "ws_slow_consumers_total", "Peers whose send queue overflowed", ("action",))
+broadcast_duration = metrics.registry.histogram(
+    "ws_broadcast_duration_seconds", "Time to enqueue one broadcast for every local peer and the broker")
+messages_sent = metrics.registry.counter(
+    "ws_messages_sent_total", "Frames written to editor sockets")
+rooms_open = metrics.registry.gauge(
+    "ws_rooms", "Projects with at least one socket on this worker")
+connections_open = metrics.registry.gauge(
+    "ws_connections", "Editor sockets open on this worker")
+largest_room = metrics.registry.gauge(
+    "ws_largest_room_connections", "Sockets in the biggest room on this worker")
+presence_flushes = metrics.registry.counter(
+    "ws_presence_flushes_total", "Coalesced presence frames sent to rooms")
+
+# Маркер в очереди: вместо накопившихся правок отправить свежий снимок документа
+_RESYNC = object()
+
+
+def encode(data: dict | str) -> str:
+    # Сообщение кодируется один раз, дальше всем получателям уходит одна и та же строка
+    if isinstance(data, str):
+        return data
+    return orjson.dumps(data).decode()
+
+
+# Кадр в очереди отправки: JSON-строка и, если в комнате есть клиенты msgpack, её двоичный вид.
+# Один объект кладётся в очереди всех получателей, так что каждый вид кодируется не больше раза
+class Frame():
+    __slots__ = ("text", "data", "_binary")
+
+    def __init__(self, text: str, data: dict | None = None):
+        self.text = text
+        self.data = data
+        self._binary: bytes | None = None
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = wire.pack(self.data if self.data is not None else orjson.loads(self.text))
+        return self._binary
+
+
+def to_frame(data: dict | str | Frame) -> Frame:
+    if isinstance(data, Frame):
+        return data
+    return Frame(encode(data), data if isinstance(data, dict) else None)
+
+
+class Outbox:
+    def __init__(self, connection_id: str, snapshot: Callable[[], dict] | None, binary: bool = False):
+        self.connection_id = connection_id
+        # Клиент договорился о msgpack - кадры уходят ему двоичными
+        self.binary = binary
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.snapshot = snapshot
+        self.resyncing = False
+        self.task: asyncio.Task | None = None
+
+
 class ConnectionManager():
-    def __init__(self):
+    def __init__(self, broker: LocalBroker | None = None):
         self.connections: dict[int, list[WebSocket]] = {}
+        self.outboxes: dict[WebSocket, Outbox] = {}
+        self.by_id: dict[str, WebSocket] = {}
+        # Через брокер комната видит участников, подключённых к другим воркерам
+        self.broker = broker or LocalBroker()
+        # Обработчики служебных сообщений комнаты от других воркеров: тип -> функция
+        self.handlers: dict[str, Callable[[int, dict], Awaitable[None] | None]] = {}
+        # Курсоры участников комнаты, включая подключённых к другим воркерам: id соединения -> состояние
+        self.presence: dict[int, dict[str, dict]] = {}
+        # Изменения курсоров, ждущие рассылки; None - участник ушёл
+        self._presence_pending: dict[int, dict[str, dict | None]] = {}
+        self._next_id = 0
 
-    async def add(self, project_id: int, websocket: WebSocket):
+    async def add(self, project_id: int, websocket: WebSocket, snapshot: Callable[[], dict] | None = None,
+                  waiting: bool = False, binary: bool = False) -> str:
+        # У каждого соединения своя очередь и свой писатель, поэтому медленный клиент не тормозит остальных.
+        # waiting - клиент ждёт снимок от владельца документа, правки до него не нужны
+        self._next_id += 1
+        connection_id = f"{self.broker.worker_id}:{self._next_id}"
+        outbox = Outbox(connection_id, snapshot, binary)
+        outbox.resyncing = waiting
+        outbox.task = asyncio.create_task(self._writer(project_id, websocket, outbox))
+        self.outboxes[websocket] = outbox
+        self.by_id[connection_id] = websocket
+        new_room = project_id not in self.connections
         self.connections.setdefault(project_id, []).append(websocket)
+        await self.broker.subscribe(project_id)
+        if new_room:
+            # Курсоры участников с других воркеров: они пришлют их в ответ
+            self.broker.publish(project_id, {"type": "presence_sync"})
+        return connection_id
 
     def remove(self, project_id: int, websocket: WebSocket):
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            self.by_id.pop(outbox.connection_id, None)
+            if outbox.task is not asyncio.current_task():
+                outbox.task.cancel()
+            if outbox.connection_id in self.presence.get(project_id, {}):
+                self.update_presence(project_id, outbox.connection_id, None)
         if project_id in self.connections:
             try:
                 self.connections[project_id].remove(websocket)
                 if not self.connections[project_id]:
                     del self.connections[project_id]
+                    self.broker.unsubscribe(project_id)
+                    if project_id not in self._presence_pending:
+                        self.presence.pop(project_id, None)
             except ValueError:
                 pass
 
-    async def broadcast(self, sender_ws: WebSocket, project_id: int, data: dict):
-        if project_id not in self.connections:
+    def send(self, project_id: int, websocket: WebSocket, data: dict | str | Frame):
+        outbox = self.outboxes.get(websocket)
+        if outbox is None or outbox.resyncing:
             return
+        try:
+            outbox.queue.put_nowait((to_frame(data), time.monotonic()))
+        except asyncio.QueueFull:
+            self._overflow(project_id, websocket, outbox)
 
-        active_connections = self.connections[project_id][:]
+    def send_to(self, project_id: int, connection_id: str, data: dict | str, resync: bool = False):
+        # Ответ конкретному соединению, возможно живущему на другом воркере.
+        # resync - снимок в ответ на join: снимает ожидание и досылает курсоры комнаты
+        websocket = self.by_id.get(connection_id)
+        if websocket is not None:
+            self._reply(project_id, websocket, data, resync)
+        else:
+            message = {"type": "reply", "connection": connection_id, "frame": encode(data)}
+            if resync:
+                message["resync"] = True
+            self.broker.publish(project_id, message)
 
-        for connection in active_connections:
+    def _reply(self, project_id: int, websocket: WebSocket, data: dict | str, resync: bool):
+        if resync:
+            # Снимок от владельца снимает ожидание, дальше клиент получает правки как обычно
+            self.outboxes[websocket].resyncing = False
+        self.send(project_id, websocket, data)
+        if resync:
+            self.send_presence(project_id, websocket)
+
+    def publish(self, project_id: int, message: dict):
+        self.broker.publish(project_id, message)
+
+    async def broadcast(self, sender_ws: WebSocket | None, project_id: int, data: dict | str,
+                        sender_id: str | None = None):
+        # Только раскладываем сообщение по очередям и сразу возвращаемся
+        started = time.monotonic()
+        frame = to_frame(data)
+        for connection in self.connections.get(project_id, [])[:]:
             if connection != sender_ws:
-                try:
-                    await connection.send_json(data)
-                except Exception:
-                    self.remove(project_id, connection)
+                self.send(project_id, connection, frame)
+
+        if sender_id is None and sender_ws in self.outboxes:
+            sender_id = self.outboxes[sender_ws].connection_id
+        self.broker.publish(project_id, {"type": "frame", "frame": frame.text, "exclude": sender_id})
+        broadcast_duration.observe(time.monotonic() - started)
+
+    def deliver(self, project_id: int, message: dict):
+        # Сообщение от другого воркера
+        if message["type"] == "frame":
+            frame = Frame(message["frame"])
+            for connection in self.connections.get(project_id, [])[:]:
+                if self.outboxes[connection].connection_id != message["exclude"]:
+                    self.send(project_id, connection, frame)
+        elif message["type"] == "reply":
+            websocket = self.by_id.get(message["connection"])
+            if websocket is not None:
+                self._reply(project_id, websocket, message["frame"], message.get("resync", False))
+        elif message["type"] == "presence":
+            # Другой воркер уже склеил изменения - запоминаем и сразу отдаём своим сокетам
+            room = self.presence.setdefault(project_id, {})
+            for connection_id, state in message["users"].items():
+                if state is None:
+                    room.pop(connection_id, None)
+                else:
+                    room[connection_id] = state
+            frame = to_frame(message)
+            for connection in self.connections.get(project_id, [])[:]:
+                self.send(project_id, connection, frame)
+        elif message["type"] == "presence_sync":
+            local = self._local_presence(self.presence.get(project_id, {}))
+            if local:
+                self.broker.publish(project_id, {"type": "presence", "users": local})
+        else:
+            handler = self.handlers.get(message["type"])
+            if handler is not None:
+                result = handler(project_id, message)
+                if asyncio.iscoroutine(result):
+                    asyncio.create_task(result)
+
+    def update_presence(self, project_id: int, connection_id: str, state: dict | None):
+        # Курсор не сохраняется и не проходит через правки: запоминаем последнее состояние,
+        # а комнате раз в PRESENCE_INTERVAL уходит один кадр со всеми изменениями
+        room = self.presence.setdefault(project_id, {})
+        if state is None:
+            room.pop(connection_id, None)
+        else:
+            room[connection_id] = state
+        pending = self._presence_pending.get(project_id)
+        if pending is None:
+            pending = self._presence_pending[project_id] = {}
+            asyncio.get_running_loop().call_later(PRESENCE_INTERVAL, self._flush_presence, project_id)
+        pending[connection_id] = state
+
+    def send_presence(self, project_id: int, websocket: WebSocket):
+        # Новому участнику - курсоры всей комнаты одним кадром
+        room = self.presence.get(project_id)
+        if room:
+            self.send(project_id, websocket, {"type": "presence", "users": room})
+
+    def _local_presence(self, users: dict[str, dict | None]) -> dict[str, dict | None]:
+        prefix = f"{self.broker.worker_id}:"
+        return {connection_id: state for connection_id, state in users.items() if connection_id.startswith(prefix)}
+
+    def _flush_presence(self, project_id: int):
+        pending = self._presence_pending.pop(project_id, None)
+        if pending:
+            presence_flushes.inc()
+            frame = to_frame({"type": "presence", "users": pending})
+            for connection in self.connections.get(project_id, [])[:]:
+                self.send(project_id, connection, frame)
+            local = self._local_presence(pending)
+            if local:
+                self.broker.publish(project_id, {"type": "presence", "users": local})
+        if project_id not in self.connections:
+            # Комната на этом воркере закрылась, чужие курсоры больше не нужны
+            self.presence.pop(project_id, None)
+
+    def _overflow(self, project_id: int, websocket: WebSocket, outbox: Outbox):
+        if outbox.snapshot is None:
+            slow_consumers.inc(action="drop")
+            self.close(project_id, websocket, code=1013)
+            return
+
+        # Накопленные правки клиенту уже не нужны: выбрасываем их и ставим в очередь снимок
+        slow_consumers.inc(action="snapshot")
+        while not outbox.queue.empty():
+            outbox.queue.get_nowait()
+        outbox.resyncing = True
+        outbox.queue.put_nowait((_RESYNC, time.monotonic()))
+
+    async def _writer(self, project_id: int, websocket: WebSocket, outbox: Outbox):
+        while True:
+            frame, enqueued_at = await outbox.queue.get()
+            if frame is _RESYNC:
+                # Снимок берём в момент отправки; новые правки пойдут в очередь уже после него
+                frame = to_frame(outbox.snapshot())
+                outbox.resyncing = False
+            try:
+                if outbox.binary:
+                    await websocket.send_bytes(frame.binary)
+                else:
+                    await websocket.send_text(frame.text)
+            except Exception:
+                self.remove(project_id, websocket)
+                return
+            fanout_latency.observe(time.monotonic() - enqueued_at)
+            messages_sent.inc()
+
+    def close(self, project_id: int, websocket: WebSocket, code: int):
+        self.remove(project_id, websocket)
+        asyncio.create_task(self._close(websocket, code))
+
+    async def _close(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    def collect(self):
+        # Размеры комнат считаем при отдаче /metrics, а не на каждом подключении
+        rooms_open.set(len(self.connections))
+        connections_open.set(sum(len(room) for room in self.connections.values()))
+        largest_room.set(max((len(room) for room in self.connections.values()), default=0))
 
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager(create_broker())
+metrics.registry.collector(manager.collect)
@@ -9,9 +9,48 @@ class Settings(BaseSettings):
     SECRET_KEY: str
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: int
+    # Пул соединений с БД: постоянные соединения, сверх них временные,
+    # сколько ждать свободное (сек), через сколько пересоздавать (сек) и проверять ли перед выдачей
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # Шина между воркерами для редактора: local (один процесс) или postgres (LISTEN/NOTIFY)
+    BROKER: str = "local"
+    # Кэш авторизованных пользователей: сколько держать запись (сек) и сколько записей всего
+    PRINCIPAL_CACHE_TTL: float = 60.0
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    # Кэш ролей в проектах: то же для пар (пользователь, проект)
+    MEMBERSHIP_CACHE_TTL: float = 60.0
+    MEMBERSHIP_CACHE_SIZE: int = 100000
+    # Стоимость bcrypt и число потоков, в которых считаются пароли
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 4
+    # Ответы REST меньше этого размера (байт) отдаются без сжатия
+    GZIP_MINIMUM_SIZE: int = 1024
+    # Пределы правок в редакторе: конвертов в секунду и запас на всплеск для одного сокета и для проекта
+    EDIT_RATE_PER_CONNECTION: float = 30.0
+    EDIT_BURST_PER_CONNECTION: int = 60
+    EDIT_RATE_PER_PROJECT: float = 200.0
+    EDIT_BURST_PER_PROJECT: int = 400
+    # Сколько секунд собирать подряд идущие конверты одного отправителя в одно применение и одну рассылку
+    EDIT_COALESCE_WINDOW: float = 0.015
+    # Эндпоинты /content: сколько символов читать из БД за один запрос и предел загружаемого текста (байт).
+    # В базе UTF8 substr ищет позицию от начала значения, так что мелкие куски дороже для Postgres
+    CONTENT_CHUNK_SIZE: int = 1048576
+    MAX_CONTENT_SIZE: int = 33554432
+
+    # Токен для /metrics (Authorization: Bearer ...); без него эндпоинт выключен
+    METRICS_TOKEN: str | None = None
+
+    # Полный URL базы вместо DB_*, например sqlite+aiosqlite:///load.db для локальных нагрузочных прогонов
+    DB_URL: str | None = None
 
     @property
     def DATABASE_URL(self):
+        if self.DB_URL:
+            return self.DB_URL
         return f"postgresql+asyncpg://{self.DB_USER}:{self.DB_PASS}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
 
     model_config = SettingsConfigDict(
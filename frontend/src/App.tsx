@@ -2,6 +2,7 @@ import { useEffect, useState, useRef, createContext, useContext } from 'react';
 import axios from 'axios';
 import { BrowserRouter, Routes, Route, Link, useParams, useNavigate, Navigate, Outlet } from 'react-router-dom';
 import Editor, { OnMount } from '@monaco-editor/react';
+import { Change, transform } from './ot';
 
 // --- НАСТРОЙКИ AXIOS ---
 axios.defaults.baseURL = 'http://127.0.0.1:8888';
@@ -162,17 +163,29 @@ function Layout() {
 // --- ОСНОВНЫЕ КОМПОНЕНТЫ ---
 function MainList() {
   const [projects, setProjects] = useState<Project[]>([]);
+  // Курсор следующей страницы из заголовка X-Next-Cursor; null - страниц больше нет
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loading, setLoading] = useState(false);
   const { logout } = useAuth();
 
-  useEffect(() => {
-    axios.get('/api/projects')
-      .then(res => setProjects(res.data))
+  const loadPage = (cursor?: string) => {
+    setLoading(true);
+    axios.get('/api/projects', { params: cursor ? { cursor } : {} })
+      .then(res => {
+        setProjects(prev => cursor ? [...prev, ...res.data] : res.data);
+        setNextCursor(res.headers['x-next-cursor'] ?? null);
+      })
       .catch(err => {
         console.error(err);
         if (err.response?.status === 401) {
             logout(); // Защита: если кука протухла, принудительно выкидываем
         }
-      });
+      })
+      .finally(() => setLoading(false));
+  };
+
+  useEffect(() => {
+    loadPage();
   }, []);
 
   const createProject = async () => {
@@ -207,20 +220,42 @@ function MainList() {
           ))}
         </ul>
       )}
+
+      {nextCursor && (
+        <button onClick={() => loadPage(nextCursor)} disabled={loading} style={{ ...styles.button, marginTop: '20px' }}>
+          {loading ? 'Загрузка...' : 'Показать ещё'}
+        </button>
+      )}
     </div>
   );
 }
 
+// Через сколько мс переподключаться, если сервер закрыл сокет (1012 - смена владельца, 1013 - не успевали читать)
+const RECONNECT_DELAY = 1000;
+
 function Detailed() {
   const { id } = useParams();
   const navigate = useNavigate();
   const [project, setProject] = useState<Project | null>(null);
+  // Пока сервер не прислал снимок, править нельзя: правки не к чему привязать
+  const [synced, setSynced] = useState(false);
+  const [readOnly, setReadOnly] = useState(false);
+  const [notice, setNotice] = useState<string | null>(null);
+  // Сокет открываем, когда Monaco уже загружен: снимку и правкам нужна модель
+  const [editorReady, setEditorReady] = useState(false);
   const editorRef = useRef<any>(null);
   const websocket = useRef<WebSocket | null>(null);
   const isRemoteUpdate = useRef(false);
+  // Последняя ревизия документа, которую видел клиент: из снимка, подтверждения или чужой правки
+  const revision = useRef<number | null>(null);
+  // На сервере всегда не больше одного неподтверждённого конверта: правки, набранные до его ack,
+  // копятся в buffer и уходят следующим конвертом. Чужие правки проводим через оба
+  const outstanding = useRef<Change[] | null>(null);
+  const buffer = useRef<Change[]>([]);
 
   const handleEditorDidMount: OnMount = (editor) => {
     editorRef.current = editor;
+    setEditorReady(true);
   };
 
   // Замени старый handleShare на этот:
@@ -244,6 +279,47 @@ function Detailed() {
     }
   };
 
+  const applyRemote = (changes: Change[]) => {
+    const model = editorRef.current?.getModel();
+    if (!model) return;
+    isRemoteUpdate.current = true;
+    try {
+      // Правки в кадре идут по порядку (сервер склеивает подряд идущие конверты),
+      // поэтому применяем их по одной и считаем диапазон по смещению в текущем тексте
+      for (const edit of changes) {
+        const start = model.getPositionAt(edit.rangeOffset);
+        const end = model.getPositionAt(edit.rangeOffset + edit.rangeLength);
+        model.applyEdits([{
+          range: {
+            startLineNumber: start.lineNumber,
+            startColumn: start.column,
+            endLineNumber: end.lineNumber,
+            endColumn: end.column
+          },
+          text: edit.text,
+          forceMoveMarkers: true
+        }]);
+      }
+    } finally {
+      isRemoteUpdate.current = false;
+    }
+  };
+
+  const replaceContent = (content: string) => {
+    const editor = editorRef.current;
+    const model = editor?.getModel();
+    if (!model || model.getValue() === content) return;
+    isRemoteUpdate.current = true;
+    try {
+      // Текст заменяется целиком, курсор оставляем примерно там же
+      const position = editor.getPosition();
+      model.setValue(content);
+      if (position) editor.setPosition(position);
+    } finally {
+      isRemoteUpdate.current = false;
+    }
+  };
+
   useEffect(() => {
     let isMounted = true;
 
@@ -252,27 +328,6 @@ function Detailed() {
         const resp = await axios.get(`/api/projects/${id}`);
         if (!isMounted) return;
         setProject(resp.data);
-
-        const ws = new WebSocket(`ws://127.0.0.1:8888/ws/${id}`);
-
-        ws.onopen = () => console.log("WS Connected");
-
-        ws.onmessage = (event) => {
-          const data = JSON.parse(event.data);
-          const incomingChanges = data.changes || data;
-
-          if (Array.isArray(incomingChanges) && editorRef.current) {
-            isRemoteUpdate.current = true;
-            editorRef.current.getModel().applyEdits(incomingChanges.map((edit: any) => ({
-              ...edit,
-              forceMoveMarkers: true
-            })));
-            setTimeout(() => { isRemoteUpdate.current = false; }, 0);
-          }
-        };
-
-        websocket.current = ws;
-
       } catch (e: any) {
         console.error("Ошибка загрузки:", e);
         // Защита от чужих проектов
@@ -287,15 +342,124 @@ function Detailed() {
 
     return () => {
       isMounted = false;
-      websocket.current?.close();
     };
   }, [id, navigate]);
 
+  const sendChanges = (changes: Change[]) => {
+    // Ревизия говорит серверу, от какого его состояния считать смещения этих правок
+    outstanding.current = changes;
+    websocket.current?.send(JSON.stringify({ changes, revision: revision.current }));
+  };
+
+  const resetSync = (value: number | null) => {
+    revision.current = value;
+    outstanding.current = null;
+    buffer.current = [];
+  };
+
+  useEffect(() => {
+    if (!editorReady) return;
+    let isMounted = true;
+    let noticeTimer: ReturnType<typeof setTimeout> | undefined;
+
+    const showNotice = (text: string, ms?: number) => {
+      setNotice(text);
+      clearTimeout(noticeTimer);
+      if (ms !== undefined) noticeTimer = setTimeout(() => setNotice(null), ms);
+    };
+
+    const connect = () => {
+      const ws = new WebSocket(`ws://127.0.0.1:8888/ws/${id}`);
+
+      ws.onopen = () => console.log("WS Connected");
+
+      ws.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+
+        switch (data.type) {
+          case 'snapshot':
+            // Полный текст: при входе, после смены текста целиком или если клиент отстал.
+            // Неподтверждённые правки сервер отбросил, считаем дальше от ревизии снимка
+            replaceContent(data.content);
+            resetSync(data.revision);
+            setSynced(true);
+            break;
+          case 'ack':
+            revision.current = data.revision;
+            outstanding.current = null;
+            if (buffer.current.length > 0) {
+              const next = buffer.current;
+              buffer.current = [];
+              sendChanges(next);
+            }
+            break;
+          case 'throttle':
+            showNotice('Слишком много правок подряд, сервер их придерживает', data.retry_after * 1000 + 500);
+            break;
+          case 'error':
+            // Правка отклонена и у нас в тексте её быть не должно: запрещаем ввод
+            // и переподключаемся за свежим снимком
+            showNotice(`Ошибка: ${data.detail}`);
+            setReadOnly(true);
+            ws.close();
+            break;
+          case 'presence':
+            break;
+          default:
+            if (Array.isArray(data.changes)) {
+              // Сервер применил эту правку раньше наших неподтверждённых - на одинаковом месте она идёт первой
+              let incoming: Change[] = data.changes;
+              if (outstanding.current !== null) {
+                [incoming, outstanding.current] = transform(incoming, outstanding.current, true);
+              }
+              if (buffer.current.length > 0) {
+                [incoming, buffer.current] = transform(incoming, buffer.current, true);
+              }
+              applyRemote(incoming);
+              revision.current = data.revision;
+            }
+        }
+      };
+
+      ws.onclose = (event) => {
+        if (websocket.current === ws) websocket.current = null;
+        resetSync(null);
+        if (!isMounted) return;
+        setSynced(false);
+        if (event.code === 1008) {
+          alert("У вас нет доступа к этому проекту или он не существует");
+          navigate('/');
+          return;
+        }
+        setTimeout(() => { if (isMounted) connect(); }, RECONNECT_DELAY);
+      };
+
+      websocket.current = ws;
+    };
+
+    connect();
+
+    return () => {
+      isMounted = false;
+      clearTimeout(noticeTimer);
+      websocket.current?.close();
+    };
+  }, [id, editorReady, navigate]);
+
   const handleEditorChange = (value: string | undefined, event: any) => {
     if (isRemoteUpdate.current) return;
-    if (websocket.current?.readyState === WebSocket.OPEN && event.changes) {
-      const payload = JSON.stringify({ changes: event.changes });
-      websocket.current.send(payload);
+    if (revision.current !== null && websocket.current?.readyState === WebSocket.OPEN && event.changes) {
+      // Monaco отдаёт правки по убыванию смещений, поэтому их можно применять по порядку, как на сервере
+      const changes: Change[] = event.changes.map((change: any) => ({
+        rangeOffset: change.rangeOffset,
+        rangeLength: change.rangeLength,
+        text: change.text
+      }));
+      if (outstanding.current === null) {
+        sendChanges(changes);
+      } else {
+        buffer.current = [...buffer.current, ...changes];
+      }
     }
   };
 
@@ -307,6 +471,8 @@ function Detailed() {
         <div style={{ display: 'flex', alignItems: 'center', gap: '20px' }}>
           <span style={{ fontWeight: 'bold' }}>📄 {project.title}</span>
           <button onClick={handleShare} style={{...styles.smallBtn, background: '#0e639c'}}>🤝 Поделиться</button>
+          {!synced && <span style={{ color: '#aaa' }}>Подключение...</span>}
+          {notice && <span style={{ color: '#ffcc66' }}>{notice}</span>}
         </div>
         <Link to="/" style={{ color: '#aaa', textDecoration: 'none', fontSize: '1.2em' }}>✕</Link>
       </div>
@@ -321,7 +487,8 @@ function Detailed() {
           options={{
             automaticLayout: true,
             fontSize: 16,
-            minimap: { enabled: false }
+            minimap: { enabled: false },
+            readOnly: readOnly || !synced
           }}
         />
       </div>
@@ -0,0 +1,70 @@
+// Операционное преобразование, как в backend/ot.py: клиент проводит чужие правки
+// через свои ещё не подтверждённые, чтобы тексты у всех сошлись с сервером.
+// Правка - "заменить rangeLength символов с rangeOffset на text"
+
+export interface Change {
+  rangeOffset: number;
+  rangeLength: number;
+  text: string;
+}
+
+const change = (offset: number, length: number, text: string): Change =>
+  ({ rangeOffset: offset, rangeLength: length, text });
+
+export function transformChange(edit: Change, against: Change, changeFirst: boolean): Change[] {
+  const start = edit.rangeOffset;
+  const end = edit.rangeOffset + edit.rangeLength;
+  const againstStart = against.rangeOffset;
+  const againstEnd = against.rangeOffset + against.rangeLength;
+  const delta = against.text.length - against.rangeLength;
+
+  // Чужая правка целиком левее - просто сдвигаемся
+  if (start >= againstEnd && start > againstStart) {
+    return [change(start + delta, edit.rangeLength, edit.text)];
+  }
+
+  const result: Change[] = [];
+  let tail: Change | null = null;
+  // Кусок нашего диапазона правее чужой правки удаляем отдельно
+  if (end > againstEnd) {
+    const tailStart = Math.max(start, againstEnd) + delta;
+    tail = change(tailStart, end + delta - tailStart, '');
+  }
+
+  let head: Change;
+  if (start < againstStart) {
+    head = change(start, Math.min(end, againstStart) - start, edit.text);
+  } else if (start === againstStart && changeFirst) {
+    head = change(againstStart, 0, edit.text);
+  } else {
+    head = change(againstStart + against.text.length, 0, edit.text);
+  }
+
+  if (tail !== null && head.rangeLength === 0 && head.rangeOffset === tail.rangeOffset) {
+    return [change(tail.rangeOffset, tail.rangeLength, edit.text)];
+  }
+  if (tail !== null) result.push(tail);
+  if (head.rangeLength || head.text) result.push(head);
+  return result;
+}
+
+// Обе последовательности применяются к одному и тому же тексту.
+// Возвращает [changes после against, against после changes]
+export function transform(changes: Change[], against: Change[], changesFirst = false): [Change[], Change[]] {
+  if (changes.length === 0 || against.length === 0) return [changes, against];
+
+  if (changes.length === 1 && against.length === 1) {
+    return [transformChange(changes[0], against[0], changesFirst),
+            transformChange(against[0], changes[0], !changesFirst)];
+  }
+
+  if (changes.length > 1) {
+    const [first, againstAfterFirst] = transform(changes.slice(0, 1), against, changesFirst);
+    const [rest, againstAfterAll] = transform(changes.slice(1), againstAfterFirst, changesFirst);
+    return [[...first, ...rest], againstAfterAll];
+  }
+
+  const [afterFirst, first] = transform(changes, against.slice(0, 1), changesFirst);
+  const [afterAll, rest] = transform(afterFirst, against.slice(1), changesFirst);
+  return [afterAll, [...first, ...rest]];
+}
@@ -0,0 +1,62 @@
+# Сравнение применения правок: срезы строки против Rope
+# Запуск из корня репозитория: python -m tests.benchmarks.bench_edits
+import random
+import time
+
+from backend.rope import Rope
+
+DOC_SIZES = [100_000, 1_000_000, 5_000_000]
+ENVELOPES = 200
+CHANGES_PER_ENVELOPE = 5
+
+
+def make_envelopes(doc_size: int):
+    envelopes = []
+    for _ in range(ENVELOPES):
+        changes = []
+        for _ in range(CHANGES_PER_ENVELOPE):
+            offset = random.randint(0, doc_size)
+            length = random.choice([0, 0, 1, 3])
+            text = random.choice(["a", "b", "\n", "    ", "def f():"])
+            changes.append((offset, length, text))
+        envelopes.append(changes)
+    return envelopes
+
+
+def apply_slicing(text: str, envelopes) -> str:
+    for changes in envelopes:
+        for offset, length, new_text in changes:
+            text = text[:offset] + new_text + text[offset + length:]
+    return text
+
+
+def apply_rope(text: str, envelopes) -> str:
+    rope = Rope(text)
+    for changes in envelopes:
+        for offset, length, new_text in changes:
+            rope.replace(offset, length, new_text)
+    return str(rope)
+
+
+def measure(func, text, envelopes):
+    start = time.perf_counter()
+    result = func(text, envelopes)
+    return time.perf_counter() - start, result
+
+
+def main():
+    random.seed(0)
+    print(f"{'doc size':>10} {'slicing, ms':>12} {'rope, ms':>10} {'speedup':>8}")
+    for doc_size in DOC_SIZES:
+        text = "".join(random.choice("abcdefgh \n") for _ in range(doc_size))
+        envelopes = make_envelopes(doc_size)
+
+        slicing_time, expected = measure(apply_slicing, text, envelopes)
+        rope_time, result = measure(apply_rope, text, envelopes)
+        assert result == expected
+
+        print(f"{doc_size:>10} {slicing_time * 1000:>12.1f} {rope_time * 1000:>10.1f} {slicing_time / rope_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Байты на проводе для больших документов: REST с GZip и без, снимок в сокете с permessage-deflate и без
+# Запуск из корня репозитория: python -m tests.benchmarks.bench_transport
+import random
+import time
+import zlib
+
+import orjson
+from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.testclient import TestClient
+
+DOC_SIZES = [100_000, 1_000_000, 5_000_000]
+# Медленный канал, на котором считаем время до первой правки: загрузка снимка
+LINK_BITS_PER_SECOND = 2_000_000
+
+SNIPPETS = [
+    "def handler_{n}(request, db):\n    result = db.query(Model_{n}).filter(Model_{n}.id == request.id)\n    return result\n\n",
+    "class Service{n}:\n    def __init__(self, repo):\n        self.repo = repo\n        self.cache = {{}}\n\n",
+    "    for item in items_{n}:\n        if item.value > {n}:\n            total += item.value\n",
+    "# TODO: вынести настройку {n} в конфиг\nTIMEOUT_{n} = {n}\n",
+]
+
+
+def make_document(size: int) -> str:
+    parts, length = [], 0
+    while length < size:
+        part = random.choice(SNIPPETS).format(n=random.randint(0, 5000))
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)[:size]
+
+
+def make_client(document: str) -> TestClient:
+    app = FastAPI()
+    app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
+
+    @app.get("/project")
+    async def project():
+        return {"id": 1, "title": "bench", "content": document}
+
+    return TestClient(app)
+
+
+def rest_bytes(client: TestClient, encoding: str) -> tuple[int, float]:
+    start = time.perf_counter()
+    response = client.get("/project", headers={"Accept-Encoding": encoding})
+    return int(response.headers["content-length"]), time.perf_counter() - start
+
+
+def websocket_bytes(frame: bytes) -> tuple[int, float]:
+    # Так кадр сжимает permessage-deflate: raw deflate, хвост 00 00 ff ff отбрасывается
+    start = time.perf_counter()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return len(data) - 4, time.perf_counter() - start
+
+
+def transfer_ms(size: int) -> float:
+    return size * 8 / LINK_BITS_PER_SECOND * 1000
+
+
+def main():
+    random.seed(0)
+    print(f"{'doc size':>10} {'channel':>10} {'raw, KB':>10} {'compressed, KB':>15} {'ratio':>6} "
+          f"{'cpu, ms':>8} {'link raw, ms':>13} {'link compressed, ms':>20}")
+    for doc_size in DOC_SIZES:
+        document = make_document(doc_size)
+        client = make_client(document)
+
+        raw, _ = rest_bytes(client, "identity")
+        compressed, elapsed = rest_bytes(client, "gzip")
+        rows = [("rest", raw, compressed, elapsed)]
+
+        frame = orjson.dumps({"type": "snapshot", "revision": 0, "content": document})
+        compressed, elapsed = websocket_bytes(frame)
+        rows.append(("websocket", len(frame), compressed, elapsed))
+
+        for channel, raw, compressed, elapsed in rows:
+            print(f"{doc_size:>10} {channel:>10} {raw / 1024:>10.1f} {compressed / 1024:>15.1f} "
+                  f"{raw / compressed:>6.1f} {elapsed * 1000:>8.1f} {transfer_ms(raw):>13.0f} "
+                  f"{transfer_ms(compressed):>20.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# Регрессионные бенчмарки стоимости одного нажатия клавиши: валидация конверта, применение правки
+# к документу и рассылка участникам комнаты. Всё в процессе, с фейковыми сокетами.
+#
+# Запуск:                 RUN_BENCHMARKS=1 python -m pytest tests/benchmarks -q
+# Обновить baseline.json: RUN_BENCHMARKS=1 BENCHMARK_UPDATE_BASELINE=1 python -m pytest tests/benchmarks -q
+# В baseline.json для каждого случая хранится разброс раундов [худший, лучший]. Тест падает, если медиана
+# раундов опустилась ниже худшего сохранённого раунда больше чем на BENCHMARK_TOLERANCE (для операций короче
+# SHORT_OPERATION - на BENCHMARK_SHORT_TOLERANCE: их сильнее всего шатают GC и планировщик).
+# Базовые значения зависят от машины - обновляйте их там же, где запускаете проверку
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+from pathlib import Path
+
+import pytest
+
+from backend import schemas, wire
+from backend.documents import Document
+from backend.routers.editor import changes_frame
+from backend.socket_manager import ConnectionManager
+
+pytestmark = pytest.mark.skipif(not os.environ.get("RUN_BENCHMARKS"), reason="RUN_BENCHMARKS is not set")
+
+BASELINE_PATH = Path(__file__).with_name("baseline.json")
+UPDATE_BASELINE = bool(os.environ.get("BENCHMARK_UPDATE_BASELINE"))
+TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", "0.3"))
+SHORT_TOLERANCE = float(os.environ.get("BENCHMARK_SHORT_TOLERANCE", "0.5"))
+SHORT_OPERATION = 50e-6
+MIN_TIME = 0.3
+ROUNDS = 5
+PEERS = 10
+
+DOC_SIZES = {"1KB": 1_000, "100KB": 100_000, "1MB": 1_000_000, "10MB": 10_000_000}
+
+
+def single_char(size: int) -> list[dict]:
+    return [{"rangeOffset": random.randint(0, size), "rangeLength": 0, "text": "a"}]
+
+
+def paste(size: int) -> list[dict]:
+    return [{"rangeOffset": random.randint(0, size), "rangeLength": 10, "text": "def f(x):\n    return x\n" * 200}]
+
+
+def multi_cursor(size: int) -> list[dict]:
+    # 20 курсоров печатают одновременно, смещения по убыванию, как их шлёт Monaco
+    offsets = sorted(random.sample(range(size), 20), reverse=True)
+    return [{"rangeOffset": offset, "rangeLength": 0, "text": "x"} for offset in offsets]
+
+
+SHAPES = {"char": single_char, "paste": paste, "multicursor": multi_cursor}
+
+
+def make_text(size: int) -> str:
+    line = "    value = compute(item, options)  # comment\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def measure(operation, setup=None) -> list[float]:
+    # Операций в секунду процессорного времени по раундам: время, отданное соседям по машине, не засчитывается.
+    # setup перед каждым раундом возвращает состояние к исходному, иначе быстрый прогон мерил бы разросшийся документ
+    rates = []
+    for _ in range(ROUNDS):
+        if setup:
+            setup()
+        count = 0
+        started = time.process_time()
+        while True:
+            operation()
+            count += 1
+            elapsed = time.process_time() - started
+            if elapsed >= MIN_TIME:
+                break
+        rates.append(count / elapsed)
+    return rates
+
+
+async def measure_async(operation, setup=None) -> list[float]:
+    rates = []
+    for _ in range(ROUNDS):
+        if setup:
+            setup()
+        count = 0
+        started = time.process_time()
+        while True:
+            await operation()
+            count += 1
+            elapsed = time.process_time() - started
+            if elapsed >= MIN_TIME:
+                break
+        rates.append(count / elapsed)
+    return rates
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    stored = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    results = {}
+    yield stored, results
+    if UPDATE_BASELINE:
+        BASELINE_PATH.write_text(json.dumps({**stored, **results}, indent=2, sort_keys=True) + "\n")
+
+
+def check(baseline, name: str, rates: list[float]):
+    # Медиану один удачный или неудачный раунд не сдвигает
+    stored, results = baseline
+    ops_per_second = statistics.median(rates)
+    results[name] = [round(min(rates), 1), round(max(rates), 1)]
+    print(f"{name}: {ops_per_second:,.0f} ops/s (rounds {min(rates):,.0f}-{max(rates):,.0f})")
+    if UPDATE_BASELINE or name not in stored:
+        return
+    low, high = stored[name]
+    tolerance = SHORT_TOLERANCE if 1 / low < SHORT_OPERATION else TOLERANCE
+    assert ops_per_second >= low * (1 - tolerance), (
+        f"{name}: {ops_per_second:,.0f} ops/s, baseline {low:,.0f}-{high:,.0f} ops/s, tolerance {tolerance:.0%}")
+
+
+class FakeWebSocket:
+    async def send_text(self, data):
+        pass
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_validate_envelope(baseline, shape):
+    random.seed(0)
+    raw = json.dumps({"revision": 1, "changes": SHAPES[shape](10_000)})
+
+    check(baseline, f"validate-{shape}", measure(lambda: schemas.ChangesEnvelope.model_validate_json(raw)))
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_decode_msgpack_envelope(baseline, shape):
+    # Тот же конверт в подпротоколе editor.msgpack.v1: распаковка плоского массива и строгая проверка pydantic
+    random.seed(0)
+    changes = SHAPES[shape](10_000)
+    raw = json.dumps({"revision": 1, "changes": changes})
+    packed = wire.pack({"revision": 1, "changes": changes})
+    print(f"{shape}: json {len(raw)} B, msgpack {len(packed)} B")
+
+    check(baseline, f"decode-msgpack-{shape}", measure(lambda: wire.unpack(packed)))
+
+
+@pytest.mark.parametrize("size", DOC_SIZES)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_apply_edit(baseline, size, shape):
+    random.seed(0)
+    text = make_text(DOC_SIZES[size])
+    envelopes = [[schemas.SingleChange(**change) for change in SHAPES[shape](DOC_SIZES[size])] for _ in range(100)]
+    document = None
+    position = 0
+
+    def reset():
+        nonlocal document, position
+        document = Document(1, text)
+        position = 0
+
+    def apply():
+        nonlocal position
+        document.commit(envelopes[position % len(envelopes)])
+        position += 1
+
+    check(baseline, f"apply-{size}-{shape}", measure(apply, reset))
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+async def test_validate_apply_broadcast(baseline, shape):
+    # Полный путь одного сообщения: разбор, применение к 1 МБ документу, кадр для рассылки и очереди 10 участников
+    random.seed(0)
+    manager = ConnectionManager()
+    peers = [FakeWebSocket() for _ in range(PEERS)]
+    for websocket in peers:
+        await manager.add(1, websocket)
+    text = make_text(DOC_SIZES["1MB"])
+    raws = [json.dumps({"changes": SHAPES[shape](DOC_SIZES["1MB"])}) for _ in range(100)]
+    document = None
+    position = 0
+
+    def reset():
+        nonlocal document, position
+        document = Document(1, text)
+        position = 0
+
+    async def pipeline():
+        nonlocal position
+        raw = raws[position % len(raws)]
+        position += 1
+        data = schemas.ChangesEnvelope.model_validate_json(raw)
+        changes = document.commit(data.changes, data.revision)
+        await manager.broadcast(peers[0], 1, changes_frame(raw, data, changes, document.revision))
+        # Даём писателям опустошить очереди, иначе мерили бы переполнение
+        await asyncio.sleep(0)
+
+    try:
+        check(baseline, f"pipeline-1MB-{shape}", await measure_async(pipeline, reset))
+    finally:
+        for websocket in peers:
+            manager.remove(1, websocket)
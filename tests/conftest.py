@@ -1,16 +1,23 @@
 from collections.abc import AsyncGenerator
+from contextlib import contextmanager
 from pathlib import Path
 
 import pytest
 import pytest_asyncio
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlalchemy import delete
+from sqlalchemy import delete, event
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from backend import models
-from backend.dependencies import get_db
+from backend.dependencies import get_db, get_session_factory
+from backend.documents import registry
+from backend.memberships import memberships
+from backend.principals import principals
+from backend.ratelimit import project_limits
+from backend.socket_manager import manager
 from backend.routers.auth import router as auth_router
+from backend.routers.editor import router as ws_router
 from backend.routers.projects import router as projects_router
 
 TEST_DB_PATH = Path("tests") / "test_app.db"
@@ -42,10 +49,20 @@ def session_maker(engine):
 @pytest_asyncio.fixture(autouse=True)
 async def clean_db(session_maker):
     async with session_maker() as session:
+        await session.execute(delete(models.ProjectEdit))
         await session.execute(delete(models.UserProject))
         await session.execute(delete(models.Project))
         await session.execute(delete(models.User))
         await session.commit()
+    registry.documents.clear()
+    manager.connections.clear()
+    manager.outboxes.clear()
+    manager.by_id.clear()
+    manager.presence.clear()
+    manager._presence_pending.clear()
+    principals.clear()
+    memberships.clear()
+    project_limits.clear()
 
 
 @pytest.fixture(scope="session")
@@ -53,12 +70,14 @@ def app(session_maker):
     application = FastAPI()
     application.include_router(auth_router)
     application.include_router(projects_router)
+    application.include_router(ws_router)
 
     async def override_get_db() -> AsyncGenerator[AsyncSession, None]:
         async with session_maker() as session:
             yield session
 
     application.dependency_overrides[get_db] = override_get_db
+    application.dependency_overrides[get_session_factory] = lambda: session_maker
     return application
 
 
@@ -83,3 +102,22 @@ def create_authorized_client(app):
         return new_client
     return _create_user
 
+
+
+@pytest.fixture()
+def count_queries(engine):
+    # with count_queries() as statements: ... - SQL, выполненный внутри блока, без BEGIN/COMMIT
+    @contextmanager
+    def _count():
+        statements = []
+
+        def listener(conn, cursor, statement, *args):
+            if not statement.startswith(("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")):
+                statements.append(statement)
+
+        event.listen(engine.sync_engine, "before_cursor_execute", listener)
+        try:
+            yield statements
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", listener)
+    return _count
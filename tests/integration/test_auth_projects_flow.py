@@ -1,3 +1,9 @@
+from sqlalchemy import select
+from passlib.context import CryptContext
+
+from backend import models
+
+
 def test_register_login_and_create_project(client):
     register_response = client.post(
         "/api/auth/register",
@@ -103,3 +109,29 @@ def test_share_project(create_authorized_client):
 
     assert not_found_share_response.status_code == 404
 
+
+
+async def test_deactivated_user_is_rejected_despite_cached_principal(authorized_client, session_maker):
+    assert authorized_client.get('/api/projects').status_code == 200
+
+    async with session_maker() as db:
+        user = await db.scalar(select(models.User).where(models.User.login == "test_login"))
+        user.is_active = False
+        await db.commit()
+
+    assert authorized_client.get('/api/projects').status_code == 401
+
+
+async def test_login_rehashes_password_with_outdated_cost(client, session_maker):
+    weak_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("password")
+    async with session_maker() as db:
+        db.add(models.User(login="old_hash_user", hashed_password=weak_hash))
+        await db.commit()
+
+    response = client.post('/api/auth/login', json={"login": "old_hash_user", "password": "password"})
+
+    assert response.status_code == 200
+    async with session_maker() as db:
+        user = await db.scalar(select(models.User).where(models.User.login == "old_hash_user"))
+    assert user.hashed_password != weak_hash
+    assert client.post('/api/auth/login', json={"login": "old_hash_user", "password": "password"}).status_code == 200
@@ -0,0 +1,399 @@
+import json
+import time
+
+import msgpack
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from backend import schemas, wire
+from backend.documents import Document, registry
+from backend.ownership import LocalOwnership
+from backend.ratelimit import throttled_frames
+from backend.routers import editor
+from config import settings
+
+
+def create_project(client, content="hello"):
+    response = client.post('/api/projects', json={
+        "title": "editor project",
+        "content": content
+    }, headers={"X-CSRF-Token": client.cookies.get("csrf_token")})
+    return response.json()['id']
+
+
+def share_project(client, project_id, login, role="editor"):
+    client.post(f"/api/projects/{project_id}/share", json={"login": login, "role": role},
+                headers={"X-CSRF-Token": client.cookies.get("csrf_token")})
+
+
+# Сокеты открываем через один TestClient, чтобы все соединения жили в одном event loop
+def connect(client, user_client, project_id):
+    cookie = "; ".join(f"{name}={value}" for name, value in user_client.cookies.items())
+    return client.websocket_connect(f"/ws/{project_id}", headers={"cookie": cookie})
+
+
+def test_edits_are_shared_and_persisted(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client)
+    share_project(owner_client, project_id, 'guest')
+
+    with connect(client, owner_client, project_id) as owner_ws, \
+            connect(client, guest_client, project_id) as guest_ws:
+        assert owner_ws.receive_json() == {"type": "snapshot", "revision": 0, "content": "hello"}
+        guest_ws.receive_json()
+
+        owner_ws.send_json({"changes": [{"rangeOffset": 5, "rangeLength": 0, "text": " world"}]})
+        assert owner_ws.receive_json() == {"type": "ack", "revision": 1}
+        assert guest_ws.receive_json() == {
+            "changes": [{"rangeOffset": 5, "rangeLength": 0, "text": " world"}], "revision": 1
+        }
+
+        guest_ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 1, "text": "H"}]})
+        guest_ws.receive_json()
+        assert owner_ws.receive_json()["changes"][0]["text"] == "H"
+
+        live_response = owner_client.get(f"/api/projects/{project_id}")
+        assert live_response.json()['content'] == "Hello world"
+
+
+def test_stranger_cannot_connect(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    stranger_client = create_authorized_client('stranger')
+    project_id = create_project(owner_client)
+
+    with pytest.raises(WebSocketDisconnect) as exc_info:
+        with connect(client, stranger_client, project_id):
+            pass
+    assert exc_info.value.code == 1008
+
+
+def test_concurrent_edits_are_transformed(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client, content="0123456789")
+    share_project(owner_client, project_id, 'guest')
+
+    with connect(client, owner_client, project_id) as owner_ws, \
+            connect(client, guest_client, project_id) as guest_ws:
+        owner_ws.receive_json()
+        guest_ws.receive_json()
+
+        # Оба клиента правят ревизию 0, не видя правки друг друга
+        owner_ws.send_json({"revision": 0, "changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "ab"}]})
+        owner_ws.receive_json()
+        guest_ws.receive_json()
+        guest_ws.send_json({"revision": 0, "changes": [{"rangeOffset": 5, "rangeLength": 1, "text": "X"}]})
+        assert guest_ws.receive_json() == {"type": "ack", "revision": 2}
+
+        transformed = owner_ws.receive_json()
+        assert transformed["revision"] == 2
+        assert transformed["changes"] == [{"rangeOffset": 7, "rangeLength": 1, "text": "X"}]
+
+        assert owner_client.get(f"/api/projects/{project_id}").json()['content'] == "ab01234X6789"
+
+
+def test_stale_revision_gets_snapshot(client, authorized_client):
+    project_id = create_project(authorized_client)
+
+    with connect(client, authorized_client, project_id) as ws:
+        ws.receive_json()
+        ws.send_json({"revision": 5, "changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "x"}]})
+
+        assert ws.receive_json() == {"type": "snapshot", "revision": 0, "content": "hello"}
+
+
+def test_client_catches_up_with_changes_since_its_version(client, authorized_client):
+    project_id = create_project(authorized_client)
+
+    with connect(client, authorized_client, project_id) as ws:
+        ws.receive_json()
+        etag = authorized_client.get(f"/api/projects/{project_id}").headers["ETag"]
+        ws.send_json({"changes": [{"rangeOffset": 5, "rangeLength": 0, "text": "!"}]})
+        ws.receive_json()
+
+        response = authorized_client.get(f"/api/projects/{project_id}/changes", params={"since": etag})
+        assert response.json() == {"revision": 1, "changes": [{"rangeOffset": 5, "rangeLength": 0, "text": "!"}]}
+        assert response.headers["ETag"] == authorized_client.get(f"/api/projects/{project_id}").headers["ETag"]
+
+        stale = authorized_client.get(f"/api/projects/{project_id}/changes", params={"since": '"other.0"'})
+        assert stale.status_code == 410
+
+
+def test_open_socket_does_not_hold_a_pooled_connection(client, authorized_client, engine):
+    project_id = create_project(authorized_client)
+
+    with connect(client, authorized_client, project_id) as ws:
+        ws.receive_json()
+        ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "x"}]})
+        ws.receive_json()
+
+        assert engine.sync_engine.pool.checkedout() == 0
+
+
+def test_burst_from_one_sender_is_coalesced(client, create_authorized_client, monkeypatch):
+    monkeypatch.setattr(settings, "EDIT_COALESCE_WINDOW", 0.5)
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client, content="")
+    share_project(owner_client, project_id, 'guest')
+
+    with connect(client, owner_client, project_id) as owner_ws, \
+            connect(client, guest_client, project_id) as guest_ws:
+        owner_ws.receive_json()
+        guest_ws.receive_json()
+
+        # Первое нажатие уходит сразу, следующие приходят во время его обработки и склеиваются
+        for position, char in enumerate("abcde"):
+            owner_ws.send_json({"changes": [{"rangeOffset": position, "rangeLength": 0, "text": char}]})
+
+        assert owner_ws.receive_json() == {"type": "ack", "revision": 1}
+        assert owner_ws.receive_json() == {"type": "ack", "revision": 5}
+        assert guest_ws.receive_json()["revision"] == 1
+        batch = guest_ws.receive_json()
+        assert batch["revision"] == 5
+        assert [change["text"] for change in batch["changes"]] == ["b", "c", "d", "e"]
+
+        assert owner_client.get(f"/api/projects/{project_id}").json()['content'] == "abcde"
+
+
+def test_flooding_sender_is_throttled(client, authorized_client, monkeypatch):
+    monkeypatch.setattr(settings, "EDIT_COALESCE_WINDOW", 0)
+    monkeypatch.setattr(settings, "EDIT_BURST_PER_CONNECTION", 1)
+    monkeypatch.setattr(settings, "EDIT_RATE_PER_CONNECTION", 20)
+    project_id = create_project(authorized_client, content="")
+    throttled_before = throttled_frames.get(scope="connection")
+
+    with connect(client, authorized_client, project_id) as ws:
+        ws.receive_json()
+        ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "a"}]})
+        ws.send_json({"changes": [{"rangeOffset": 1, "rangeLength": 0, "text": "b"}]})
+
+        assert ws.receive_json() == {"type": "ack", "revision": 1}
+        throttle = ws.receive_json()
+        assert throttle["type"] == "throttle"
+        assert 0 < throttle["retry_after"] <= 0.05
+        # Кадр не потерян, а лишь задержан
+        assert ws.receive_json() == {"type": "ack", "revision": 2}
+
+    assert throttled_frames.get(scope="connection") == throttled_before + 1
+
+
+def test_viewer_cannot_edit_and_revoked_member_is_disconnected(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client)
+    share_project(owner_client, project_id, 'guest', role="viewer")
+
+    with connect(client, guest_client, project_id) as guest_ws:
+        guest_ws.receive_json()
+        guest_ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "x"}]})
+        assert guest_ws.receive_json() == {"type": "error", "detail": "Read-only access to project"}
+        assert owner_client.get(f"/api/projects/{project_id}").json()['content'] == "hello"
+
+        owner_client.post(f"/api/projects/{project_id}/unshare/bulk", json={"logins": ["guest"]},
+                          headers={"X-CSRF-Token": owner_client.cookies.get("csrf_token")})
+        guest_ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "x"}]})
+        with pytest.raises(WebSocketDisconnect) as exc_info:
+            guest_ws.receive_json()
+        assert exc_info.value.code == 1008
+
+
+class RecordingOwnership(LocalOwnership):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def acquire(self, project_id):
+        self.calls.append("acquire")
+        return True
+
+    async def release(self, project_id, keep=False):
+        self.calls.append(("release", keep))
+        return not keep
+
+
+def test_failed_save_on_disconnect_keeps_document_and_lock(client, authorized_client, monkeypatch):
+    ownership = RecordingOwnership()
+    monkeypatch.setattr(editor, "ownership", ownership)
+    project_id = create_project(authorized_client)
+
+    async def broken_persist(*args, **kwargs):
+        raise ConnectionError("database is down")
+
+    monkeypatch.setattr(registry, "persist", broken_persist)
+    with connect(client, authorized_client, project_id) as ws:
+        ws.receive_json()
+        ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "x"}]})
+        ws.receive_json()
+        ws.close()
+        for _ in range(200):
+            if len(ownership.calls) == 2:
+                break
+            time.sleep(0.01)
+
+    # Лок остаётся за несохранённым буфером, его отпустит flusher
+    assert ownership.calls == ["acquire", ("release", True)]
+    assert registry.get(project_id).content == "xhello"
+
+
+def test_failed_load_releases_the_lock(client, authorized_client, monkeypatch):
+    ownership = RecordingOwnership()
+    monkeypatch.setattr(editor, "ownership", ownership)
+    project_id = create_project(authorized_client)
+
+    async def broken_acquire(*args, **kwargs):
+        raise ConnectionError("database is down")
+
+    monkeypatch.setattr(registry, "acquire", broken_acquire)
+    with pytest.raises(ConnectionError):
+        with connect(client, authorized_client, project_id):
+            pass
+    assert ownership.calls == ["acquire", ("release", False)]
+
+
+async def test_owner_without_buffer_asks_sender_to_reconnect(monkeypatch):
+    published = []
+    monkeypatch.setattr(editor.manager, "publish", lambda project_id, message: published.append(message))
+
+    await editor.on_proxied_edit(1, {"connection": "worker:1", "frames": []})
+
+    assert published == [{"type": "reconnect", "connection": "worker:1"}]
+
+
+async def test_resync_after_broker_gap(monkeypatch):
+    published, closed, cleared = [], [], []
+    monkeypatch.setattr(editor.manager, "publish", lambda project_id, message: published.append((project_id, message)))
+    monkeypatch.setattr(editor.manager, "close", lambda project_id, websocket, code: closed.append((websocket, code)))
+    monkeypatch.setattr(editor.manager, "connections", {1: ["proxied"], 2: ["local"]})
+    monkeypatch.setattr(editor.registry, "get", lambda project_id: object() if project_id == 2 else None)
+    monkeypatch.setattr(editor.memberships, "clear", lambda: cleared.append("memberships"))
+    monkeypatch.setattr(editor.principals, "clear", lambda: cleared.append("principals"))
+
+    editor.on_resync(editor.ALL_WORKERS)
+    # Прокси переподключает своих клиентов, владелец просит об этом остальные воркеры
+    editor.on_resync(1)
+    editor.on_resync(2)
+
+    assert cleared == ["memberships", "principals"]
+    assert closed == [("proxied", 1012)]
+    assert published == [(2, {"type": "resync"})]
+
+
+async def test_lost_ownership_drops_the_document_and_reconnects_the_room(monkeypatch):
+    published, closed = [], []
+    monkeypatch.setattr(editor.manager, "publish", lambda project_id, message: published.append((project_id, message)))
+    monkeypatch.setattr(editor.manager, "close", lambda project_id, websocket, code: closed.append((websocket, code)))
+    monkeypatch.setattr(editor.manager, "connections", {3: ["first", "second"]})
+    document = Document(3, "text")
+    document.apply([schemas.SingleChange(rangeOffset=0, rangeLength=0, text="unsaved ")])
+    monkeypatch.setitem(registry.documents, 3, document)
+
+    await editor.on_ownership_lost(3)
+
+    assert registry.get(3) is None
+    assert closed == [("first", 1012), ("second", 1012)]
+    assert published == [(3, {"type": "owner_left"})]
+
+
+def test_peers_receive_what_the_server_applied(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client)
+    share_project(owner_client, project_id, 'guest')
+
+    def strict_pairs(pairs):
+        keys = [key for key, _ in pairs]
+        assert len(keys) == len(set(keys)), keys
+        return dict(pairs)
+
+    with connect(client, owner_client, project_id) as owner_ws, \
+            connect(client, guest_client, project_id) as guest_ws:
+        owner_ws.receive_json()
+        guest_ws.receive_json()
+
+        # Нестрогие типы сервер приводит сам, и соседям уходят приведённые значения
+        owner_ws.send_text('{"changes": [{"rangeOffset": "5", "rangeLength": 0.0, "text": "!"}]}')
+        owner_ws.receive_json()
+        frame = json.loads(guest_ws.receive_text(), object_pairs_hook=strict_pairs)
+        assert frame == {"changes": [{"rangeOffset": 5, "rangeLength": 0, "text": "!"}], "revision": 1}
+
+        # Своя ревизия клиента не дублируется серверной
+        owner_ws.send_text('{"revision": 1, "changes": [{"rangeOffset": 0, "rangeLength": 0, "text": ">"}]}')
+        owner_ws.receive_json()
+        frame = json.loads(guest_ws.receive_text(), object_pairs_hook=strict_pairs)
+        assert frame == {"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": ">"}], "revision": 2}
+
+
+def test_presence_skips_the_edit_path(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client)
+    share_project(owner_client, project_id, 'guest', role="viewer")
+
+    with connect(client, owner_client, project_id) as owner_ws, \
+            connect(client, guest_client, project_id) as guest_ws:
+        owner_ws.receive_json()
+        guest_ws.receive_json()
+
+        # Наблюдателю курсор разрешён: это не правка
+        guest_ws.send_json({"type": "presence", "cursor": 2, "selections": [[0, 2]]})
+        frame = owner_ws.receive_json()
+        assert frame["type"] == "presence"
+        assert list(frame["users"].values()) == [{"user": "guest", "cursor": 2, "selections": [[0, 2]]}]
+
+        with connect(client, owner_client, project_id) as late_ws:
+            assert late_ws.receive_json()["type"] == "snapshot"
+            assert late_ws.receive_json() == frame
+
+        assert owner_client.get(f"/api/projects/{project_id}").json()['content'] == "hello"
+
+
+def test_frame_kind_is_decided_by_its_type(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client)
+    share_project(owner_client, project_id, 'guest')
+
+    with connect(client, owner_client, project_id) as owner_ws, \
+            connect(client, guest_client, project_id) as guest_ws:
+        owner_ws.receive_json()
+        guest_ws.receive_json()
+
+        # Слово presence в тексте правки не делает её курсором
+        guest_ws.send_text('{"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "\\"presence\\""}]}')
+        assert guest_ws.receive_json()["type"] == "ack"
+        assert owner_ws.receive_json()["changes"][0]["text"] == '"presence"'
+
+        # А курсор остаётся курсором, где бы ни стояло поле type
+        guest_ws.send_text('{"selections": [[0, 1], [2, 3], [4, 5], [6, 7]], "cursor": 1, "type": "presence"}')
+        frame = owner_ws.receive_json()
+        assert frame["type"] == "presence"
+        assert list(frame["users"].values()) == [
+            {"user": "guest", "cursor": 1, "selections": [[0, 1], [2, 3], [4, 5], [6, 7]]}]
+
+
+def test_msgpack_and_json_clients_share_a_room(client, create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    project_id = create_project(owner_client)
+    share_project(owner_client, project_id, 'guest')
+    cookie = "; ".join(f"{name}={value}" for name, value in guest_client.cookies.items())
+
+    with connect(client, owner_client, project_id) as json_ws, \
+            client.websocket_connect(f"/ws/{project_id}", headers={"cookie": cookie},
+                                     subprotocols=[wire.MSGPACK, wire.JSON]) as binary_ws:
+        assert binary_ws.accepted_subprotocol == wire.MSGPACK
+        json_ws.receive_json()
+        assert msgpack.unpackb(binary_ws.receive_bytes()) == {"type": "snapshot", "revision": 0, "content": "hello"}
+
+        binary_ws.send_bytes(msgpack.packb([0, [5, 0, " world"]]))
+        assert msgpack.unpackb(binary_ws.receive_bytes()) == {"type": "ack", "revision": 1}
+        assert json_ws.receive_json() == {
+            "changes": [{"rangeOffset": 5, "rangeLength": 0, "text": " world"}], "revision": 1}
+
+        json_ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 1, "text": "H"}]})
+        json_ws.receive_json()
+        assert msgpack.unpackb(binary_ws.receive_bytes()) == [2, [0, 1, "H"]]
+
+        assert owner_client.get(f"/api/projects/{project_id}").json()['content'] == "Hello world"
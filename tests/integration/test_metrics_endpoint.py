@@ -0,0 +1,29 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.routers.metrics import router as metrics_router
+from config import settings
+
+
+def metrics_client():
+    application = FastAPI()
+    application.include_router(metrics_router)
+    return TestClient(application)
+
+
+def test_metrics_are_off_without_token(monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_TOKEN", None)
+
+    assert metrics_client().get('/metrics').status_code == 404
+
+
+def test_metrics_require_the_token(monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_TOKEN", "secret")
+    client = metrics_client()
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.get('/metrics', headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert "# TYPE ws_fanout_latency_seconds histogram" in response.text
+    assert "project_id" not in response.text
@@ -1,3 +1,12 @@
+import pytest
+from sqlalchemy import select, update
+
+from backend import models
+from backend.routers import projects
+from backend.routers.projects import SnapshotChanged, SnapshotResponse, read_snapshot
+from config import settings
+
+
 def test_new_user_gets_empty_project_list(authorized_client):
     response = authorized_client.get('api/projects')
 
@@ -16,3 +25,264 @@ def test_update_project(authorized_client):
     get_reponse = authorized_client.get(f"/api/projects/{post_response.json()['id']}")
     assert get_reponse.json()['title'] == "edited title" and get_reponse.json()['content'] == "edited content"
 
+
+
+def test_project_list_is_paginated_without_content(authorized_client):
+    headers = {"X-CSRF-Token": authorized_client.cookies.get("csrf_token")}
+    ids = [authorized_client.post('/api/projects', json={"title": f"p{n}", "content": "x" * n}, headers=headers).json()["id"]
+           for n in range(5)]
+
+    first_page = authorized_client.get('/api/projects', params={"limit": 2})
+    assert [project["id"] for project in first_page.json()] == ids[:2:-1]
+    assert first_page.json()[0] == {**first_page.json()[0], "title": "p4", "size": 4, "role": "editor"}
+    assert "content" not in first_page.json()[0]
+
+    seen = [project["id"] for project in first_page.json()]
+    cursor = first_page.headers["X-Next-Cursor"]
+    while cursor:
+        page = authorized_client.get('/api/projects', params={"limit": 2, "cursor": cursor})
+        seen += [project["id"] for project in page.json()]
+        cursor = page.headers.get("X-Next-Cursor")
+    assert seen == ids[::-1]
+
+
+def test_project_list_rejects_malformed_cursor(authorized_client):
+    for cursor in ("not a cursor", "é", "e30"):
+        assert authorized_client.get('/api/projects', params={"cursor": cursor}).status_code == 400
+
+
+def test_project_list_size_is_in_bytes(authorized_client):
+    headers = {"X-CSRF-Token": authorized_client.cookies.get("csrf_token")}
+    authorized_client.post('/api/projects', json={"title": "t", "content": "héllo"}, headers=headers)
+    assert authorized_client.get('/api/projects').json()[0]["size"] == 6
+
+
+def test_unchanged_project_returns_304(authorized_client):
+    headers = {"X-CSRF-Token": authorized_client.cookies.get("csrf_token")}
+    project_id = authorized_client.post('/api/projects', json={"title": "t", "content": "old"}, headers=headers).json()["id"]
+
+    first = authorized_client.get(f"/api/projects/{project_id}")
+    etag = first.headers["ETag"]
+    cached = authorized_client.get(f"/api/projects/{project_id}", headers={"If-None-Match": etag})
+    assert cached.status_code == 304 and cached.content == b""
+
+    authorized_client.put(f"/api/projects/{project_id}", json={"title": "t", "content": "new"}, headers=headers)
+    changed = authorized_client.get(f"/api/projects/{project_id}", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.json()["content"] == "new" and changed.headers["ETag"] != etag
+
+
+def test_bulk_share_resolves_and_upserts_in_constant_queries(create_authorized_client, count_queries):
+    owner_client = create_authorized_client('owner')
+    for login in ('guest1', 'guest2', 'guest3'):
+        create_authorized_client(login)
+    headers = {"X-CSRF-Token": owner_client.cookies.get("csrf_token")}
+    project_id = owner_client.post('/api/projects', json={"title": "t", "content": ""}, headers=headers).json()["id"]
+    owner_client.post(f"/api/projects/{project_id}/share", json={"login": "guest1", "role": "viewer"}, headers=headers)
+
+    with count_queries() as statements:
+        response = owner_client.post(f"/api/projects/{project_id}/share/bulk", json={"members": [
+            {"login": "guest1", "role": "editor"},
+            {"login": "guest2", "role": "viewer"},
+            {"login": "guest3", "role": "editor"},
+            {"login": "ghost", "role": "viewer"},
+        ]}, headers=headers)
+
+    assert [(result["login"], result["status"]) for result in response.json()] == [
+        ("guest1", "updated"), ("guest2", "added"), ("guest3", "added"), ("ghost", "not_found")]
+    # Пользователь из кэша, дальше один SELECT с CTE и один upsert
+    assert len(statements) == 2
+
+    response = owner_client.post(f"/api/projects/{project_id}/unshare/bulk",
+                                 json={"logins": ["guest2", "guest2", "ghost"]}, headers=headers)
+    assert [(result["login"], result["status"]) for result in response.json()] == [
+        ("guest2", "removed"), ("ghost", "not_found")]
+    response = owner_client.post(f"/api/projects/{project_id}/unshare/bulk", json={"logins": ["guest2"]}, headers=headers)
+    assert response.json()[0]["status"] == "not_member"
+
+
+def test_bulk_share_requires_access(create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    stranger_client = create_authorized_client('stranger')
+    project_id = owner_client.post('/api/projects', json={"title": "t", "content": ""},
+                                   headers={"X-CSRF-Token": owner_client.cookies.get("csrf_token")}).json()["id"]
+
+    response = stranger_client.post(f"/api/projects/{project_id}/share/bulk",
+                                    json={"members": [{"login": "owner", "role": "editor"}]},
+                                    headers={"X-CSRF-Token": stranger_client.cookies.get("csrf_token")})
+    assert response.status_code == 403
+
+
+def test_bulk_membership_changes_require_editor(create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    viewer_client = create_authorized_client('viewer')
+    headers = {"X-CSRF-Token": owner_client.cookies.get("csrf_token")}
+    viewer_headers = {"X-CSRF-Token": viewer_client.cookies.get("csrf_token")}
+    project_id = owner_client.post('/api/projects', json={"title": "t", "content": ""}, headers=headers).json()["id"]
+    owner_client.post(f"/api/projects/{project_id}/share", json={"login": "viewer", "role": "viewer"}, headers=headers)
+
+    response = viewer_client.post(f"/api/projects/{project_id}/share/bulk",
+                                  json={"members": [{"login": "viewer", "role": "editor"}]}, headers=viewer_headers)
+    assert response.status_code == 403
+    response = viewer_client.post(f"/api/projects/{project_id}/unshare/bulk",
+                                  json={"logins": ["owner"]}, headers=viewer_headers)
+    assert response.status_code == 403
+
+    # Ни роль наблюдателя, ни доступ владельца не изменились
+    assert owner_client.get(f"/api/projects/{project_id}").status_code == 200
+    assert viewer_client.put(f"/api/projects/{project_id}", json={"title": "x", "content": "x"},
+                             headers=viewer_headers).status_code == 403
+
+
+def test_viewer_cannot_share_upgrade_or_unshare(create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    viewer_client = create_authorized_client('viewer')
+    other_client = create_authorized_client('other')
+    headers = {"X-CSRF-Token": owner_client.cookies.get("csrf_token")}
+    viewer_headers = {"X-CSRF-Token": viewer_client.cookies.get("csrf_token")}
+    project_id = owner_client.post('/api/projects', json={"title": "t", "content": ""}, headers=headers).json()["id"]
+    owner_client.post(f"/api/projects/{project_id}/share", json={"login": "viewer", "role": "viewer"}, headers=headers)
+
+    attempts = [
+        ("/share", {"login": "other", "role": "editor"}),
+        ("/share/bulk", {"members": [{"login": "other", "role": "viewer"}]}),
+        ("/share/bulk", {"members": [{"login": "viewer", "role": "editor"}]}),
+        ("/unshare/bulk", {"logins": ["owner"]}),
+    ]
+    for path, body in attempts:
+        response = viewer_client.post(f"/api/projects/{project_id}{path}", json=body, headers=viewer_headers)
+        assert response.status_code == 403, path
+
+    # Доступ не изменился ни у кого
+    assert other_client.get(f"/api/projects/{project_id}").status_code == 404
+    assert viewer_client.put(f"/api/projects/{project_id}", json={"title": "x", "content": "x"},
+                             headers=viewer_headers).status_code == 403
+    assert owner_client.get(f"/api/projects/{project_id}").status_code == 200
+
+
+def test_bulk_changes_keep_an_editor(create_authorized_client):
+    owner_client = create_authorized_client('owner')
+    create_authorized_client('guest')
+    headers = {"X-CSRF-Token": owner_client.cookies.get("csrf_token")}
+    project_id = owner_client.post('/api/projects', json={"title": "t", "content": ""}, headers=headers).json()["id"]
+    owner_client.post(f"/api/projects/{project_id}/share", json={"login": "guest", "role": "viewer"}, headers=headers)
+
+    # Своя строка пропускается, остальные применяются
+    response = owner_client.post(f"/api/projects/{project_id}/share/bulk", json={"members": [
+        {"login": "owner", "role": "viewer"}, {"login": "guest", "role": "editor"}]}, headers=headers)
+    assert response.status_code == 200
+    assert [(result["login"], result["role"], result["status"]) for result in response.json()] == [
+        ("owner", "editor", "forbidden_self"), ("guest", "editor", "updated")]
+    owner_client.post(f"/api/projects/{project_id}/share/bulk",
+                      json={"members": [{"login": "guest", "role": "viewer"}]}, headers=headers)
+    response = owner_client.post(f"/api/projects/{project_id}/unshare/bulk",
+                                 json={"logins": ["owner", "guest"]}, headers=headers)
+    assert response.status_code == 400
+    assert owner_client.get(f"/api/projects/{project_id}").status_code == 200
+
+    # Когда есть второй редактор, можно уйти самому
+    owner_client.post(f"/api/projects/{project_id}/share/bulk",
+                      json={"members": [{"login": "guest", "role": "editor"}]}, headers=headers)
+    response = owner_client.post(f"/api/projects/{project_id}/unshare/bulk", json={"logins": ["owner"]}, headers=headers)
+    assert response.json() == [{"login": "owner", "role": "editor", "status": "removed"}]
+
+
+def test_membership_is_cached_and_invalidated_by_sharing(create_authorized_client, count_queries):
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    headers = {"X-CSRF-Token": owner_client.cookies.get("csrf_token")}
+    project_id = owner_client.post('/api/projects', json={"title": "t", "content": ""}, headers=headers).json()["id"]
+
+    # Отказ тоже кэшируется, но выдача доступа его сбрасывает
+    assert guest_client.get(f"/api/projects/{project_id}").status_code == 404
+    owner_client.post(f"/api/projects/{project_id}/share", json={"login": "guest", "role": "viewer"}, headers=headers)
+    assert guest_client.get(f"/api/projects/{project_id}").status_code == 200
+
+    with count_queries() as statements:
+        guest_client.get(f"/api/projects/{project_id}")
+    assert not [sql for sql in statements if "user_projects" in sql]
+
+    # Наблюдатель читает, но не пишет
+    response = guest_client.put(f"/api/projects/{project_id}", json={"title": "x", "content": "x"},
+                                headers={"X-CSRF-Token": guest_client.cookies.get("csrf_token")})
+    assert response.status_code == 403
+
+    owner_client.post(f"/api/projects/{project_id}/unshare/bulk", json={"logins": ["guest"]}, headers=headers)
+    assert guest_client.get(f"/api/projects/{project_id}").status_code == 404
+
+
+def test_content_streams_in_chunks_and_round_trips(authorized_client, monkeypatch, count_queries):
+    monkeypatch.setattr(settings, "CONTENT_CHUNK_SIZE", 4)
+    headers = {"X-CSRF-Token": authorized_client.cookies.get("csrf_token")}
+    project_id = authorized_client.post('/api/projects', json={"title": "t", "content": ""}, headers=headers).json()["id"]
+    text = "привет, мир\n" * 3 + "end"
+
+    response = authorized_client.put(f"/api/projects/{project_id}/content", content=text.encode(), headers=headers)
+    assert response.status_code == 204
+
+    with count_queries() as statements:
+        response = authorized_client.get(f"/api/projects/{project_id}/content")
+    assert response.text == text
+    assert response.headers["content-type"] == "text/plain; charset=utf-8"
+    # По запросу на каждые CONTENT_CHUNK_SIZE символов
+    assert len([sql for sql in statements if "substr" in sql]) == len(text) // 4 + 1
+    assert authorized_client.get(f"/api/projects/{project_id}").json()["content"] == text
+
+    etag = response.headers["ETag"]
+    assert authorized_client.get(f"/api/projects/{project_id}/content",
+                                 headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_content_upload_is_capped_and_validated(create_authorized_client, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_CONTENT_SIZE", 10)
+    owner_client = create_authorized_client('owner')
+    guest_client = create_authorized_client('guest')
+    headers = {"X-CSRF-Token": owner_client.cookies.get("csrf_token")}
+    project_id = owner_client.post('/api/projects', json={"title": "t", "content": "old"}, headers=headers).json()["id"]
+    url = f"/api/projects/{project_id}/content"
+
+    assert owner_client.put(url, content=b"x" * 11, headers=headers).status_code == 413
+    # Без Content-Length предел проверяется по мере чтения тела
+    assert owner_client.put(url, content=iter([b"x" * 6, b"x" * 6]), headers=headers).status_code == 413
+    assert owner_client.put(url, content=b"\xff\xfe", headers=headers).status_code == 400
+
+    owner_client.post(f"/api/projects/{project_id}/share", json={"login": "guest", "role": "viewer"}, headers=headers)
+    response = guest_client.put(url, content=b"x", headers={"X-CSRF-Token": guest_client.cookies.get("csrf_token")})
+    assert response.status_code == 403
+    assert owner_client.get(url).text == "old"
+
+
+async def test_snapshot_rewritten_mid_stream_aborts_response(authorized_client, session_maker, monkeypatch, caplog):
+    monkeypatch.setattr(settings, "CONTENT_CHUNK_SIZE", 2)
+    # fileConfig в миграциях отключает уже созданные логгеры
+    monkeypatch.setattr(projects.logger, "disabled", False)
+    headers = {"X-CSRF-Token": authorized_client.cookies.get("csrf_token")}
+    project_id = authorized_client.post('/api/projects', json={"title": "t", "content": "abcdef"}, headers=headers).json()["id"]
+
+    async with session_maker() as db:
+        updated_at = await db.scalar(select(models.Project.updated_at).where(models.Project.id == project_id))
+    chunks = read_snapshot(project_id, updated_at, session_maker)
+    assert await anext(chunks) == b"ab"
+    async with session_maker() as db:
+        await db.execute(update(models.Project).where(models.Project.id == project_id).values(content="xyz"))
+        await db.commit()
+    with pytest.raises(SnapshotChanged):
+        await anext(chunks)
+    assert "changed while streaming" in caplog.text
+
+
+async def test_aborted_snapshot_leaves_the_body_unfinished():
+    async def rewritten():
+        yield b"ab"
+        raise SnapshotChanged(1)
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    await SnapshotResponse(rewritten(), media_type="text/plain")(scope, None, send)
+    # Завершающего сообщения нет - сервер оборвёт соединение
+    assert [message.get("body") for message in messages[1:]] == [b"ab"]
+    assert messages[-1]["more_body"] is True
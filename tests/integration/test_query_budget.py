@@ -0,0 +1,86 @@
+# Сколько SQL выполняет каждый эндпоинт при холодных кэшах. Бюджет - потолок: если эндпоинт
+# начал ходить в базу чаще, тест падает и показывает все его запросы.
+# Уменьшили число запросов - уменьшите и бюджет, чтобы он не отставал от кода
+import time
+
+import pytest
+
+from backend.documents import registry
+from backend.memberships import memberships
+from backend.principals import principals
+
+CONTENT = "hello"
+
+
+class Room():
+    def __init__(self, client, create_authorized_client):
+        self.client = client
+        self.owner = create_authorized_client('owner')
+        self.guest = create_authorized_client('guest')
+        create_authorized_client('other')
+        self.headers = {"X-CSRF-Token": self.owner.cookies.get("csrf_token")}
+        self.project_id = self.owner.post('/api/projects', json={"title": "t", "content": CONTENT},
+                                          headers=self.headers).json()["id"]
+        self.owner.post(f"/api/projects/{self.project_id}/share", json={"login": "guest", "role": "editor"},
+                        headers=self.headers)
+        self.etag = self.owner.get(f"/api/projects/{self.project_id}").headers["ETag"]
+
+    def url(self, suffix: str = "") -> str:
+        return f"/api/projects/{self.project_id}{suffix}"
+
+
+def edit_over_socket(room: Room):
+    cookie = "; ".join(f"{name}={value}" for name, value in room.owner.cookies.items())
+    with room.client.websocket_connect(f"/ws/{room.project_id}", headers={"cookie": cookie}) as ws:
+        ws.receive_json()
+        ws.send_json({"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "x"}]})
+        ws.receive_json()
+        # Документ сохраняется и выгружается после отключения. Ждём этого внутри with:
+        # на выходе TestClient отменяет обработчик сокета
+        ws.close()
+        for _ in range(200):
+            if registry.get(room.project_id) is None:
+                break
+            time.sleep(0.01)
+    return None
+
+
+CASES = {
+    "register": (2, lambda room: room.client.post("/api/auth/register",
+                                                  json={"login": "newcomer", "password": "password"})),
+    "login": (1, lambda room: room.client.post("/api/auth/login", json={"login": "owner", "password": "password"})),
+    "create project": (3, lambda room: room.owner.post("/api/projects", json={"title": "n", "content": ""},
+                                                       headers=room.headers)),
+    "list projects": (2, lambda room: room.owner.get("/api/projects")),
+    "get project": (5, lambda room: room.owner.get(room.url())),
+    "get project, not modified": (3, lambda room: room.owner.get(room.url(), headers={"If-None-Match": room.etag})),
+    "changes since": (2, lambda room: room.owner.get(room.url("/changes"), params={"since": room.etag})),
+    "update project": (5, lambda room: room.owner.put(room.url(), json={"title": "u", "content": "u"},
+                                                      headers=room.headers)),
+    "get content": (4, lambda room: room.owner.get(room.url("/content"))),
+    "upload content": (4, lambda room: room.owner.put(room.url("/content"), content=b"u", headers=room.headers)),
+    "share": (3, lambda room: room.owner.post(room.url("/share"), json={"login": "other", "role": "viewer"},
+                                              headers=room.headers)),
+    "share bulk": (3, lambda room: room.owner.post(room.url("/share/bulk"), headers=room.headers,
+                                                   json={"members": [{"login": "other", "role": "viewer"},
+                                                                     {"login": "guest", "role": "viewer"}]})),
+    "unshare bulk": (3, lambda room: room.owner.post(room.url("/unshare/bulk"), json={"logins": ["guest"]},
+                                                     headers=room.headers)),
+    # Подключение, одна правка и отключение с сохранением документа
+    "editor session": (6, edit_over_socket),
+}
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_endpoint_stays_within_query_budget(client, create_authorized_client, count_queries, name):
+    budget, call = CASES[name]
+    room = Room(client, create_authorized_client)
+    principals.clear()
+    memberships.clear()
+
+    with count_queries() as statements:
+        response = call(room)
+
+    if response is not None:
+        assert response.status_code < 400 or response.status_code in (304, 410), response.text
+    assert len(statements) <= budget, f"{name}: {len(statements)} queries, budget {budget}:\n" + "\n".join(statements)
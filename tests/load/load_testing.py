@@ -33,4 +33,4 @@ class ApiUser(HttpUser):
             })
     @task
     def logout(self):
-        self.client.get("/api/auth/logout")
\ No newline at end of file
+        self.client.post("/api/auth/logout")
\ No newline at end of file
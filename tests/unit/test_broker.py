@@ -0,0 +1,178 @@
+import asyncio
+import json
+
+import orjson
+
+from backend import broker as broker_module
+from backend import socket_manager
+from backend.broker import LocalBroker, PostgresBroker
+from backend.socket_manager import ConnectionManager
+
+
+class MemoryBroker(LocalBroker):
+    # Общая шина в памяти, чтобы проверить два "воркера" в одном процессе
+    def __init__(self, bus):
+        super().__init__()
+        self.bus = bus
+        self.subscriptions = set()
+        bus.append(self)
+
+    async def subscribe(self, project_id):
+        self.subscriptions.add(project_id)
+
+    def unsubscribe(self, project_id):
+        self.subscriptions.discard(project_id)
+
+    def publish(self, project_id, message):
+        for broker in self.bus:
+            if broker is not self and project_id in broker.subscriptions:
+                broker.deliver(project_id, message)
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, data):
+        self.sent.append(json.loads(data))
+
+
+async def test_broadcast_reaches_peers_on_other_workers():
+    bus = []
+    first, second = ConnectionManager(MemoryBroker(bus)), ConnectionManager(MemoryBroker(bus))
+    for manager in (first, second):
+        await manager.broker.start(manager.deliver)
+    sender, local_peer, remote_peer = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    await first.add(1, sender)
+    await first.add(1, local_peer)
+    await second.add(1, remote_peer)
+
+    await first.broadcast(sender, 1, {"n": 1})
+    await asyncio.sleep(0)
+
+    assert sender.sent == []
+    assert local_peer.sent == [{"n": 1}]
+    assert remote_peer.sent == [{"n": 1}]
+
+    second.remove(1, remote_peer)
+    await first.broadcast(sender, 1, {"n": 2})
+    await asyncio.sleep(0)
+    assert remote_peer.sent == [{"n": 1}]
+    first.remove(1, sender)
+    first.remove(1, local_peer)
+
+
+async def test_reply_reaches_waiting_connection_on_other_worker():
+    bus = []
+    owner, proxy = ConnectionManager(MemoryBroker(bus)), ConnectionManager(MemoryBroker(bus))
+    for manager in (owner, proxy):
+        await manager.broker.start(manager.deliver)
+    joins = []
+    owner.handlers["join"] = lambda project_id, message: joins.append(message["connection"])
+    websocket = FakeWebSocket()
+    connection_id = await proxy.add(1, websocket, waiting=True)
+    await owner.add(1, FakeWebSocket())
+
+    # Пока снимок не пришёл, правки ожидающему клиенту не нужны
+    await owner.broadcast(None, 1, {"n": 1})
+    proxy.publish(1, {"type": "join", "connection": connection_id})
+    owner.send_to(1, joins[0], {"type": "snapshot"}, resync=True)
+    await owner.broadcast(None, 1, {"n": 2})
+    await asyncio.sleep(0)
+
+    assert joins == [connection_id]
+    assert websocket.sent == [{"type": "snapshot"}, {"n": 2}]
+    proxy.remove(1, websocket)
+    for peer in owner.connections[1][:]:
+        owner.remove(1, peer)
+
+
+async def test_only_resync_reply_ends_waiting():
+    bus = []
+    owner, proxy = ConnectionManager(MemoryBroker(bus)), ConnectionManager(MemoryBroker(bus))
+    for manager in (owner, proxy):
+        await manager.broker.start(manager.deliver)
+    websocket = FakeWebSocket()
+    connection_id = await proxy.add(1, websocket, waiting=True)
+    await owner.add(1, FakeWebSocket())
+    proxy.presence[1] = {"other": {"user": "other", "cursor": 0}}
+    presence = {"type": "presence", "users": proxy.presence[1]}
+
+    # Подтверждение правки не заменяет снимок: клиент продолжает ждать и ничего не получает
+    owner.send_to(1, connection_id, {"type": "ack", "revision": 1})
+    await owner.broadcast(None, 1, {"n": 1})
+    await asyncio.sleep(0)
+    assert websocket.sent == [] and proxy.outboxes[websocket].resyncing
+
+    owner.send_to(1, connection_id, {"type": "snapshot"}, resync=True)
+    await asyncio.sleep(0)
+    assert websocket.sent == [{"type": "snapshot"}, presence]
+
+    # Курсоры досылаются только вместе со снимком
+    owner.send_to(1, connection_id, {"type": "ack", "revision": 2})
+    await asyncio.sleep(0)
+    assert websocket.sent == [{"type": "snapshot"}, presence, {"type": "ack", "revision": 2}]
+    proxy.remove(1, websocket)
+    for peer in owner.connections[1][:]:
+        owner.remove(1, peer)
+
+
+async def test_presence_crosses_workers_and_new_room_catches_up(monkeypatch):
+    monkeypatch.setattr(socket_manager, "PRESENCE_INTERVAL", 0.01)
+    bus = []
+    first, second = ConnectionManager(MemoryBroker(bus)), ConnectionManager(MemoryBroker(bus))
+    for manager in (first, second):
+        await manager.broker.start(manager.deliver)
+    alice = FakeWebSocket()
+    alice_id = await first.add(1, alice)
+    first.update_presence(1, alice_id, {"user": "alice", "cursor": 3})
+    await asyncio.sleep(0.05)
+
+    # Второй воркер открыл комнату позже и спросил курсоры у остальных
+    bob = FakeWebSocket()
+    await second.add(1, bob)
+    await asyncio.sleep(0)
+    assert bob.sent == [{"type": "presence", "users": {alice_id: {"user": "alice", "cursor": 3}}}]
+
+    first.update_presence(1, alice_id, {"user": "alice", "cursor": 4})
+    await asyncio.sleep(0.05)
+    assert bob.sent[-1] == {"type": "presence", "users": {alice_id: {"user": "alice", "cursor": 4}}}
+    assert second.presence[1] == {alice_id: {"user": "alice", "cursor": 4}}
+    first.remove(1, alice)
+    second.remove(1, bob)
+
+
+def chunk(worker, message_id, index, count, data):
+    return f"{worker} {message_id} {index} {count} {data}"
+
+
+def test_incomplete_frames_expire_and_are_capped(monkeypatch):
+    received = []
+    broker = PostgresBroker("postgresql://unused")
+    broker.deliver = lambda project_id, message: received.append(message)
+    now = [100.0]
+    monkeypatch.setattr(broker_module.time, "monotonic", lambda: now[0])
+
+    # Отправитель упал после первого куска - кадр забывается через PARTIAL_TTL
+    broker._on_notify(None, 0, "editor_1", chunk("dead", "m1", 0, 2, '{"n":'))
+    now[0] += broker_module.PARTIAL_TTL
+    broker._on_notify(None, 0, "editor_1", chunk("live", "m2", 0, 2, '{"n":'))
+    assert list(broker._partial) == [("live", "m2")]
+    broker._on_notify(None, 0, "editor_1", chunk("live", "m2", 1, 2, '1}'))
+    assert received == [{"n": 1}] and broker._partial == {}
+
+    monkeypatch.setattr(broker_module, "PARTIAL_LIMIT", 3)
+    for n in range(10):
+        broker._on_notify(None, 0, "editor_1", chunk("live", f"x{n}", 0, 2, "{"))
+    assert list(broker._partial) == [("live", "x7"), ("live", "x8"), ("live", "x9")]
+
+
+
+def test_frames_are_split_by_bytes_without_breaking_characters(monkeypatch):
+    monkeypatch.setattr(broker_module, "NOTIFY_CHUNK_SIZE", 5)
+    frame = orjson.dumps({"d": "я" * 7 + "\x01\"" + "😀" * 3})
+    chunks = broker_module._split(frame)
+
+    assert "".join(chunks).encode() == frame
+    assert all(0 < len(chunk.encode()) <= 5 for chunk in chunks)
+    assert broker_module._split(b"") == [""]
@@ -0,0 +1,22 @@
+import pytest
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from backend.database import InstrumentedPool, pool_checkout_wait, pool_timeouts
+
+
+async def test_pool_records_checkout_wait_and_timeouts():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=InstrumentedPool,
+                                 pool_size=1, max_overflow=0, pool_timeout=0.05)
+    waits_before, timeouts_before = pool_checkout_wait.count(), pool_timeouts.get()
+    try:
+        async with engine.connect() as held:
+            await held.execute(text("SELECT 1"))
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass
+    finally:
+        await engine.dispose()
+
+    assert pool_checkout_wait.count() == waits_before + 2
+    assert pool_timeouts.get() == timeouts_before + 1
@@ -0,0 +1,193 @@
+import asyncio
+import random
+
+from backend import documents, models, schemas
+from backend.documents import Document, DocumentRegistry
+from backend.ot import transform
+
+
+def make_changes(*changes):
+    return [schemas.SingleChange(rangeOffset=offset, rangeLength=length, text=text)
+            for offset, length, text in changes]
+
+
+def test_apply_changes_in_order():
+    document = Document(1, "hello world")
+
+    document.apply(make_changes((0, 5, "goodbye"), (7, 0, ",")))
+
+    assert document.content == "goodbye, world"
+    assert document.dirty is True
+
+
+def test_replace_resets_dirty_flag():
+    document = Document(1, "text")
+    document.apply(make_changes((4, 0, "!")))
+
+    document.replace("new text")
+
+    assert document.content == "new text"
+    assert document.dirty is False
+
+
+def test_pipelined_envelopes_are_not_transformed_against_themselves():
+    document = Document(1, "hello")
+
+    document.commit(make_changes((0, 0, "a")), 0, "client")
+    # Второй конверт на той же ревизии: клиент уже видит у себя "ahello"
+    document.commit(make_changes((1, 0, "b")), 0, "client")
+
+    assert document.content == "abhello"
+
+
+def random_edit(text):
+    offset = random.randint(0, len(text))
+    return make_changes((offset, random.randint(0, min(3, len(text) - offset)), random.choice(["", "x", "yz"])))
+
+
+def apply_text(text, changes):
+    for change in changes:
+        text = text[:change.rangeOffset] + change.text + text[change.rangeOffset + change.rangeLength:]
+    return text
+
+
+def test_pipelining_client_converges_with_interleaved_peer():
+    random.seed(11)
+    for _ in range(500):
+        document = Document(1, "".join(random.choice("abc") for _ in range(random.randint(0, 8))))
+        # Клиент шлёт пачку конвертов на одной ревизии, ничего не получая; соседка всегда в курсе
+        local, pending = document.content, []
+        for _ in range(random.randint(2, 6)):
+            if random.random() < 0.5:
+                document.commit(random_edit(document.content), document.revision, "peer")
+            else:
+                changes = random_edit(local)
+                local = apply_text(local, changes)
+                pending.append(changes)
+                document.commit(changes, 0, "client")
+
+        # Потом клиент получает ревизии по порядку: свои - как ack, чужие проводит через неотвеченные
+        for changes, author, _ in document.history:
+            if author == "client":
+                pending.pop(0)
+                continue
+            incoming, transformed = changes, []
+            for own in pending:
+                own, incoming = transform(own, incoming)
+                transformed.append(own)
+            pending = transformed
+            local = apply_text(local, incoming)
+
+        assert local == document.content
+
+
+async def test_registry_shares_buffer_and_persists_on_last_release(session_maker):
+    async with session_maker() as db:
+        project = models.Project(title="title", content="hello")
+        db.add(project)
+        await db.commit()
+
+        registry = DocumentRegistry()
+        first = await registry.acquire(project.id, db)
+        second = await registry.acquire(project.id, db)
+        assert first is second
+
+        first.apply(make_changes((5, 0, " world")))
+        await registry.release(project.id, db)
+        assert registry.get(project.id) is second
+
+        await registry.release(project.id, db)
+        assert registry.get(project.id) is None
+
+    async with session_maker() as db:
+        stored = await db.get(models.Project, project.id)
+        assert stored.content == "hello world"
+
+
+async def test_registry_returns_none_for_missing_project(session_maker):
+    async with session_maker() as db:
+        assert await DocumentRegistry().acquire(404, db) is None
+
+
+async def test_slow_load_does_not_block_other_projects(session_maker, monkeypatch):
+    real_load = documents.load_content
+    slow_started, release_slow = asyncio.Event(), asyncio.Event()
+
+    async def load_content(project_id, db):
+        if project_id == 1:
+            slow_started.set()
+            await release_slow.wait()
+        return await real_load(project_id, db)
+
+    monkeypatch.setattr(documents, "load_content", load_content)
+    async with session_maker() as db_slow, session_maker() as db_fast:
+        db_slow.add_all([models.Project(id=1, title="slow", content="a"), models.Project(id=2, title="fast", content="b")])
+        await db_slow.commit()
+
+        registry = DocumentRegistry()
+        slow = asyncio.create_task(registry.acquire(1, db_slow))
+        await slow_started.wait()
+        # Пока первый проект грузится, второй открывается без ожидания, а повторный вход в первый ждёт ту же загрузку
+        fast = await asyncio.wait_for(registry.acquire(2, db_fast), 1)
+        again = asyncio.create_task(registry.acquire(1, db_fast))
+        await asyncio.sleep(0)
+        assert fast.content == "b" and not again.done()
+
+        release_slow.set()
+        assert await slow is await again
+        assert registry.get(1).connections == 2 and not registry._locks
+
+
+async def test_rewrite_waits_for_a_flush_in_flight(session_maker):
+    async with session_maker() as db:
+        db.add(models.Project(id=1, title="t", content="old"))
+        await db.commit()
+
+    registry = DocumentRegistry()
+    async with session_maker() as flush_db, session_maker() as put_db:
+        document = await registry.acquire(1, flush_db)
+        document.snapshot_due = False
+        document.apply(make_changes((3, 0, "!")))
+
+        # Запись журнала старого буфера застряла на полпути
+        gate = asyncio.Event()
+        execute = flush_db.execute
+
+        async def slow_execute(*args, **kwargs):
+            await gate.wait()
+            return await execute(*args, **kwargs)
+
+        flush_db.execute = slow_execute
+        flush = asyncio.create_task(registry.persist([document], flush_db))
+        await asyncio.sleep(0)
+        rewrite = asyncio.create_task(registry.rewrite(1, "new", put_db))
+        await asyncio.sleep(0.05)
+        assert not rewrite.done()
+
+        gate.set()
+        await flush
+        assert await rewrite is True
+        assert document.content == "new"
+
+    async with session_maker() as db:
+        assert await documents.load_content(1, db) == ("new", 0)
+
+
+async def test_dropped_document_is_never_written(session_maker):
+    async with session_maker() as db:
+        db.add(models.Project(id=1, title="t", content="old"))
+        await db.commit()
+
+    registry = DocumentRegistry()
+    async with session_maker() as db:
+        document = await registry.acquire(1, db)
+        document.apply(make_changes((3, 0, "!")))
+        dirty = registry.dirty_documents()
+
+        # Flusher собрал документ, но до записи лок владельца потерян
+        assert await registry.drop(1) is document
+        await registry.persist(dirty, db)
+        await registry.release(1, db)
+
+    async with session_maker() as db:
+        assert await documents.load_content(1, db) == ("old", 0)
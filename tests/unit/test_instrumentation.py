@@ -0,0 +1,29 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from backend.instrumentation import MetricsMiddleware, http_db_queries, http_duration
+
+
+def test_middleware_records_route_template_and_query_count(session_maker):
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        async with session_maker() as db:
+            await db.execute(text("SELECT 1"))
+            await db.execute(text("SELECT 2"))
+        return {"id": item_id}
+
+    requests_before = http_duration.count(method="GET", route="/items/{item_id}", status=200)
+    with TestClient(app) as client:
+        client.get("/items/1")
+        client.get("/items/2")
+        client.get("/missing")
+
+    assert http_duration.count(method="GET", route="/items/{item_id}", status=200) == requests_before + 2
+    assert http_duration.count(method="GET", route="unmatched", status=404) >= 1
+    state = http_db_queries.values[http_db_queries._key({"route": "/items/{item_id}"})]
+    # Оба запроса к БД посчитаны за HTTP-запросом, в котором они выполнялись
+    assert state[1] >= 4
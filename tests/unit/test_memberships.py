@@ -0,0 +1,51 @@
+from backend import broker, memberships as memberships_module
+from backend.memberships import MembershipCache, on_membership_changed
+from backend.models import RoleEnum
+
+
+def test_lookup_started_before_invalidation_is_not_cached():
+    cache = MembershipCache(maxsize=10, ttl=60)
+    generation = cache.generation
+    # Пока шёл запрос, роль поменяли на другом воркере
+    cache.discard(1, [7])
+    cache.put(7, 1, RoleEnum.EDITOR, generation)
+
+    assert cache.get(7, 1) == (False, None)
+
+
+def test_non_member_is_cached_until_invalidated():
+    cache = MembershipCache(maxsize=10, ttl=60)
+    cache.put(7, 1, None, cache.generation)
+    cache.put(8, 1, RoleEnum.VIEWER, cache.generation)
+
+    assert cache.get(7, 1) == (True, None)
+    cache.discard(1, [7])
+    assert cache.get(7, 1) == (False, None)
+    assert cache.get(8, 1) == (True, RoleEnum.VIEWER)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = MembershipCache(maxsize=2, ttl=60)
+    cache.put(1, 1, RoleEnum.EDITOR, cache.generation)
+    cache.put(2, 1, RoleEnum.EDITOR, cache.generation)
+    cache.get(1, 1)
+    cache.put(3, 1, RoleEnum.EDITOR, cache.generation)
+
+    assert cache.get(2, 1) == (False, None)
+    assert cache.get(1, 1) == (True, RoleEnum.EDITOR)
+
+
+def test_invalidation_reaches_other_workers(monkeypatch):
+    published = []
+    monkeypatch.setattr(memberships_module.manager, "publish",
+                        lambda project_id, message: published.append((project_id, message)))
+    local, remote = MembershipCache(maxsize=10, ttl=60), memberships_module.memberships
+    local.put(7, 1, RoleEnum.EDITOR, local.generation)
+    remote.put(7, 1, RoleEnum.EDITOR, remote.generation)
+
+    local.invalidate(1, [7])
+    assert local.get(7, 1) == (False, None)
+    assert published == [(broker.ALL_WORKERS, {"type": "membership", "project": 1, "users": [7]})]
+
+    on_membership_changed(*published[0])
+    assert remote.get(7, 1) == (False, None)
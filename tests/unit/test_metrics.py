@@ -0,0 +1,33 @@
+from backend.metrics import MetricsRegistry
+
+
+def test_render_counter_and_histogram():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests", ("route",))
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+
+    requests.inc(route="/a")
+    requests.inc(2, route="/a")
+    latency.observe(0.05)
+    latency.observe(0.5)
+
+    text = registry.render()
+
+    assert 'requests_total{route="/a"} 3' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in text
+    assert "latency_seconds_count 2" in text
+
+
+def test_register_same_name_returns_existing_metric():
+    registry = MetricsRegistry()
+
+    assert registry.counter("hits_total", "Hits") is registry.counter("hits_total", "Hits")
+
+
+def test_collectors_run_before_render():
+    registry = MetricsRegistry()
+    rooms = registry.gauge("rooms", "Rooms")
+    registry.collector(lambda: rooms.set(3))
+
+    assert "rooms 3" in registry.render()
@@ -0,0 +1,62 @@
+import random
+
+from backend import schemas
+from backend.ot import transform, transform_change
+
+
+def change(offset, length, text):
+    return schemas.SingleChange(rangeOffset=offset, rangeLength=length, text=text)
+
+
+def apply(text, changes):
+    for item in changes:
+        text = text[:item.rangeOffset] + item.text + text[item.rangeOffset + item.rangeLength:]
+    return text
+
+
+def random_changes(text, count):
+    changes = []
+    for _ in range(count):
+        offset = random.randint(0, len(text))
+        length = random.randint(0, min(4, len(text) - offset))
+        item = change(offset, length, random.choice(["", "x", "yy", "zzz"]))
+        changes.append(item)
+        text = apply(text, [item])
+    return changes
+
+
+def test_insert_before_shifts_offset():
+    result = transform_change(change(5, 0, "b"), change(0, 0, "aaa"), change_first=False)
+
+    assert result == [change(8, 0, "b")]
+
+
+def test_concurrent_inserts_at_same_position_keep_order():
+    text = "hello"
+    first, second = change(2, 0, "A"), change(2, 0, "B")
+
+    second_after, first_after = transform([second], [first])
+
+    assert apply(apply(text, [first]), second_after) == "heABllo"
+    assert apply(apply(text, [second]), first_after) == "heABllo"
+
+
+def test_deleting_around_insert_keeps_inserted_text():
+    text = "0123456789"
+    insert, delete = change(5, 0, "X"), change(2, 6, "")
+
+    delete_after, _ = transform([delete], [insert])
+
+    assert apply(apply(text, [insert]), delete_after) == "01X89"
+
+
+def test_random_sequences_converge():
+    random.seed(7)
+    for _ in range(2000):
+        text = "".join(random.choice("abcdef") for _ in range(random.randint(0, 12)))
+        ours = random_changes(text, random.randint(1, 3))
+        theirs = random_changes(text, random.randint(1, 3))
+
+        ours_after, theirs_after = transform(ours, theirs)
+
+        assert apply(apply(text, theirs), ours_after) == apply(apply(text, ours), theirs_after)
@@ -0,0 +1,134 @@
+import pytest
+from sqlalchemy import func, select
+
+from backend import documents as documents_module
+from backend import models, persistence, schemas
+from backend.documents import DocumentRegistry, flush_batch_size, load_content
+from backend.persistence import FlushWorker
+
+
+async def test_flush_writes_all_dirty_documents_in_one_batch(session_maker):
+    async with session_maker() as db:
+        projects = [models.Project(title=f"title {i}", content="text") for i in range(3)]
+        db.add_all(projects)
+        await db.commit()
+
+        documents = DocumentRegistry()
+        for project in projects:
+            await documents.acquire(project.id, db)
+
+    worker = FlushWorker(documents)
+    worker.session_factory = session_maker
+    documents.get(projects[0].id).apply([schemas.SingleChange(rangeOffset=4, rangeLength=0, text=" 0")])
+    documents.get(projects[2].id).apply([schemas.SingleChange(rangeOffset=0, rangeLength=4, text="two")])
+    batches_before = flush_batch_size.count()
+
+    await worker.flush()
+
+    assert flush_batch_size.count() == batches_before + 1
+    assert documents.dirty_documents() == []
+    async with session_maker() as db:
+        contents = [(await load_content(project.id, db))[0] for project in projects]
+        # Текст проектов не переписывался - правки легли в журнал
+        stored = [(await db.get(models.Project, project.id)).content for project in projects]
+    assert contents == ["text 0", "text", "two"]
+    assert stored == ["text", "text", "text"]
+
+
+async def test_stop_flushes_pending_edits(session_maker):
+    async with session_maker() as db:
+        project = models.Project(title="title", content="")
+        db.add(project)
+        await db.commit()
+        documents = DocumentRegistry()
+        document = await documents.acquire(project.id, db)
+
+    worker = FlushWorker(documents, interval=60)
+    worker.session_factory = session_maker
+    worker.start()
+    document.apply([schemas.SingleChange(rangeOffset=0, rangeLength=0, text="saved")])
+
+    await worker.stop()
+
+    async with session_maker() as db:
+        assert await load_content(project.id, db) == ("saved", 1)
+
+
+async def test_snapshot_compacts_journal(session_maker, monkeypatch):
+    monkeypatch.setattr(documents_module, "SNAPSHOT_EVERY_OPS", 3)
+    async with session_maker() as db:
+        project = models.Project(title="title", content="")
+        db.add(project)
+        await db.commit()
+        documents = DocumentRegistry()
+        document = await documents.acquire(project.id, db)
+
+        for n in range(2):
+            document.commit([schemas.SingleChange(rangeOffset=n, rangeLength=0, text=str(n))])
+            await documents.persist(documents.dirty_documents(), db)
+        assert await db.scalar(select(func.count()).select_from(models.ProjectEdit)) == 2
+
+        document.commit([schemas.SingleChange(rangeOffset=2, rangeLength=0, text="2")])
+        await documents.persist(documents.dirty_documents(), db)
+
+        assert await db.scalar(select(func.count()).select_from(models.ProjectEdit)) == 0
+        await db.refresh(project)
+        assert project.content == "012"
+
+
+async def test_document_is_recovered_from_snapshot_and_journal(session_maker):
+    async with session_maker() as db:
+        project = models.Project(title="title", content="hello")
+        db.add(project)
+        await db.commit()
+        crashed = DocumentRegistry()
+        document = await crashed.acquire(project.id, db)
+        document.commit([schemas.SingleChange(rangeOffset=5, rangeLength=0, text=" world")])
+        document.commit([schemas.SingleChange(rangeOffset=0, rangeLength=1, text="H")])
+        await crashed.persist(crashed.dirty_documents(), db)
+
+        # Воркер упал, не сделав снимок: новый владелец собирает текст из журнала
+        recovered = await DocumentRegistry().acquire(project.id, db)
+
+    assert recovered.content == "Hello world"
+    assert recovered.snapshot_due is True
+
+
+async def test_failed_release_keeps_edits_until_flusher_saves_them(session_maker, monkeypatch):
+    async with session_maker() as db:
+        project = models.Project(title="title", content="")
+        db.add(project)
+        await db.commit()
+        documents = DocumentRegistry()
+        document = await documents.acquire(project.id, db)
+    document.apply([schemas.SingleChange(rangeOffset=0, rangeLength=0, text="unsaved")])
+
+    persist = documents.persist
+
+    async def broken_persist(*args, **kwargs):
+        raise ConnectionError("database is down")
+
+    monkeypatch.setattr(documents, "persist", broken_persist)
+    async with session_maker() as db:
+        with pytest.raises(ConnectionError):
+            await documents.release(project.id, db)
+    assert documents.get(project.id) is document
+    assert document.dirty
+
+    monkeypatch.setattr(documents, "persist", persist)
+    released = []
+
+    async def release_idle(project_id):
+        released.append(project_id)
+        return True
+
+    monkeypatch.setattr(persistence.ownership, "release_idle", release_idle)
+    worker = FlushWorker(documents)
+    worker.session_factory = session_maker
+    await worker.flush()
+
+    assert documents.get(project.id) is None
+    # Лок, оставленный за несохранённым буфером, отпускается вместе с выгрузкой
+    assert released == [project.id]
+    async with session_maker() as db:
+        assert (await load_content(project.id, db))[0] == "unsaved"
@@ -0,0 +1,65 @@
+from backend import models, schemas
+from backend.broker import ALL_WORKERS
+from backend.principals import PrincipalCache, cache_requests, principals
+from backend.socket_manager import manager
+
+
+def principal(user_id):
+    return schemas.Principal(id=user_id, login=f"user{user_id}", is_active=True, is_superuser=False)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PrincipalCache(maxsize=2, ttl=60)
+    cache.put(principal(1))
+    cache.put(principal(2))
+    cache.get(1)
+    cache.put(principal(3))
+
+    assert cache.get(2) is None
+    assert cache.get(1) == principal(1)
+    assert cache.get(3) == principal(3)
+
+
+def test_expired_entry_is_a_miss():
+    cache = PrincipalCache(maxsize=10, ttl=0)
+    cache.put(principal(1))
+    misses_before = cache_requests.get(result="miss")
+
+    assert cache.get(1) is None
+    assert cache_requests.get(result="miss") == misses_before + 1
+    assert cache.entries == {}
+
+
+async def test_updated_user_is_invalidated(session_maker):
+    async with session_maker() as db:
+        user = models.User(login="cached", hashed_password="x")
+        db.add(user)
+        await db.commit()
+        principals.put(schemas.Principal.model_validate(user))
+
+        user.is_active = False
+        await db.commit()
+
+    assert principals.get(user.id) is None
+
+
+async def test_change_is_published_to_other_workers_after_commit(session_maker, monkeypatch):
+    published = []
+    monkeypatch.setattr(manager, "publish", lambda project_id, message: published.append((project_id, message)))
+    async with session_maker() as db:
+        user = models.User(login="elsewhere", hashed_password="x")
+        db.add(user)
+        await db.commit()
+
+        user.is_active = False
+        await db.flush()
+        assert published == []
+        await db.commit()
+
+    assert published == [(ALL_WORKERS, {"type": "principal", "user": user.id})]
+
+    # Другой воркер получает сообщение и сбрасывает свою запись
+    principals.put(principal(user.id))
+    manager.deliver(ALL_WORKERS, published[0][1])
+    assert principals.get(user.id) is None
+
@@ -0,0 +1,46 @@
+from backend import ratelimit
+from backend.ratelimit import ProjectLimits, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_is_free_then_frames_wait_for_refill(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    bucket = TokenBucket(rate=10, burst=3)
+
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == 0.1
+    # Долг копится: следующий ждёт за предыдущим
+    assert bucket.reserve() == 0.2
+
+    clock.now += 1.0
+    assert bucket.reserve() == 0.0
+    assert bucket.tokens == 2
+
+
+def test_refill_is_capped_by_burst(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    bucket = TokenBucket(rate=10, burst=5)
+
+    clock.now += 60
+    assert bucket.reserve(5) == 0.0
+    assert bucket.reserve() > 0
+
+
+def test_projects_have_separate_buckets():
+    limits = ProjectLimits(rate=1, burst=1)
+
+    assert limits.reserve(1) == 0.0
+    assert limits.reserve(2) == 0.0
+    assert limits.reserve(1) > 0
+
+    limits.discard(1)
+    assert limits.reserve(1) == 0.0
@@ -0,0 +1,38 @@
+import random
+
+from backend.rope import CHUNK_SIZE, Rope
+
+
+def test_build_and_materialize_large_text():
+    text = "".join(str(i % 10) for i in range(CHUNK_SIZE * 5 + 17))
+
+    rope = Rope(text)
+
+    assert len(rope) == len(text)
+    assert str(rope) == text
+
+
+def test_replace_matches_string_slicing():
+    random.seed(42)
+    text = "".join(random.choice("abc\n") for _ in range(CHUNK_SIZE * 3))
+    rope = Rope(text)
+
+    for _ in range(500):
+        offset = random.randint(0, len(text) + 3)
+        length = random.choice([0, 0, 1, 5, CHUNK_SIZE + 10])
+        new_text = random.choice(["", "x", "yz", "q" * (CHUNK_SIZE * 2)])
+
+        text = text[:offset] + new_text + text[offset + length:]
+        rope.replace(offset, length, new_text)
+
+    assert len(rope) == len(text)
+    assert str(rope) == text
+
+
+def test_replace_in_empty_rope():
+    rope = Rope()
+
+    rope.replace(0, 0, "hello")
+    rope.replace(5, 10, "!")
+
+    assert str(rope) == "hello!"
@@ -1,8 +1,11 @@
+import asyncio
 from datetime import timedelta
 
 from jose import jwt
+from passlib.context import CryptContext
 
 from backend import security
+from config import settings
 
 
 def test_password_hash_and_verify():
@@ -22,3 +25,40 @@ def test_create_access_token_contains_sub():
 
     assert payload["sub"] == "42"
     assert "exp" in payload
+
+
+async def test_hasher_keeps_event_loop_responsive():
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.001)
+
+    task = asyncio.create_task(ticker())
+    hashed = await security.hasher.hash("password")
+    task.cancel()
+
+    assert ticks > 1
+    assert await security.hasher.verify_and_update("password", hashed) == (True, None)
+    assert security.password_queue_depth.get() == 0
+
+
+async def test_weaker_hash_is_upgraded_on_verify():
+    weak = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("password")
+
+    verified, new_hash = await security.hasher.verify_and_update("password", weak)
+
+    assert verified is True
+    assert new_hash is not None and security.pwd_context.identify(new_hash) == "bcrypt"
+    assert security.pwd_context.needs_update(new_hash) is False
+
+
+async def test_costlier_hash_is_rehashed_after_rounds_are_lowered():
+    costly = CryptContext(schemes=["bcrypt"], bcrypt__rounds=settings.BCRYPT_ROUNDS + 1).hash("password")
+
+    verified, new_hash = await security.hasher.verify_and_update("password", costly)
+
+    assert verified is True
+    assert new_hash is not None and security.pwd_context.needs_update(new_hash) is False
@@ -0,0 +1,146 @@
+import asyncio
+import json
+
+import msgpack
+
+from backend import socket_manager
+from backend.socket_manager import ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def send_text(self, data):
+        await self.unblocked.wait()
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+async def test_broadcast_does_not_wait_for_slow_peer():
+    manager = ConnectionManager()
+    sender, fast, slow = FakeWebSocket(), FakeWebSocket(), FakeWebSocket(blocked=True)
+    for websocket in (sender, fast, slow):
+        await manager.add(1, websocket)
+
+    await manager.broadcast(sender, 1, {"n": 1})
+    await asyncio.sleep(0)
+
+    assert fast.sent == [{"n": 1}]
+    assert slow.sent == [] and sender.sent == []
+    slow.unblocked.set()
+    await asyncio.sleep(0)
+    assert slow.sent == [{"n": 1}]
+    manager.remove(1, fast)
+    manager.remove(1, slow)
+    manager.remove(1, sender)
+
+
+async def test_overflowed_peer_gets_snapshot_instead_of_backlog(monkeypatch):
+    monkeypatch.setattr(socket_manager, "SEND_QUEUE_SIZE", 2)
+    manager = ConnectionManager()
+    slow = FakeWebSocket(blocked=True)
+    await manager.add(1, slow, snapshot=lambda: {"type": "snapshot"})
+
+    for n in range(5):
+        await manager.broadcast(None, 1, {"n": n})
+    await manager.broadcast(None, 1, {"n": "ignored while resyncing"})
+    slow.unblocked.set()
+    await asyncio.sleep(0.01)
+
+    assert slow.sent == [{"type": "snapshot"}]
+    manager.remove(1, slow)
+
+
+async def test_overflowed_peer_without_snapshot_is_dropped(monkeypatch):
+    monkeypatch.setattr(socket_manager, "SEND_QUEUE_SIZE", 1)
+    manager = ConnectionManager()
+    slow = FakeWebSocket(blocked=True)
+    await manager.add(1, slow)
+
+    for n in range(3):
+        await manager.broadcast(None, 1, {"n": n})
+    await asyncio.sleep(0)
+
+    assert 1 not in manager.connections
+    assert slow.closed == 1013
+
+
+async def test_broadcast_encodes_frame_once(monkeypatch):
+    manager = ConnectionManager()
+    peers = [FakeWebSocket() for _ in range(3)]
+    for websocket in peers:
+        await manager.add(1, websocket)
+    encoded = []
+    original_encode = socket_manager.encode
+    monkeypatch.setattr(socket_manager, "encode", lambda data: encoded.append(data) or original_encode(data))
+
+    await manager.broadcast(None, 1, {"n": 1})
+    await asyncio.sleep(0)
+
+    assert len([data for data in encoded if isinstance(data, dict)]) == 1
+    assert all(websocket.sent == [{"n": 1}] for websocket in peers)
+    for websocket in peers:
+        manager.remove(1, websocket)
+
+
+async def test_presence_is_coalesced_to_latest_state(monkeypatch):
+    monkeypatch.setattr(socket_manager, "PRESENCE_INTERVAL", 0.01)
+    manager = ConnectionManager()
+    alice, bob = FakeWebSocket(), FakeWebSocket()
+    alice_id = await manager.add(1, alice)
+    await manager.add(1, bob)
+
+    for cursor in range(10):
+        manager.update_presence(1, alice_id, {"user": "alice", "cursor": cursor})
+    await asyncio.sleep(0.05)
+
+    assert bob.sent == [{"type": "presence", "users": {alice_id: {"user": "alice", "cursor": 9}}}]
+
+    # Опоздавший получает курсоры всей комнаты одним кадром
+    late = FakeWebSocket()
+    await manager.add(1, late)
+    manager.send_presence(1, late)
+    await asyncio.sleep(0)
+    assert late.sent == [{"type": "presence", "users": {alice_id: {"user": "alice", "cursor": 9}}}]
+
+    manager.remove(1, alice)
+    await asyncio.sleep(0.05)
+    assert bob.sent[-1] == {"type": "presence", "users": {alice_id: None}}
+    assert manager.presence[1] == {}
+    manager.remove(1, bob)
+    manager.remove(1, late)
+    assert 1 not in manager.presence
+
+
+class FakeBinaryWebSocket(FakeWebSocket):
+    async def send_bytes(self, data):
+        self.sent.append(msgpack.unpackb(data))
+
+
+async def test_mixed_room_encodes_each_format_once(monkeypatch):
+    manager = ConnectionManager()
+    text_peers = [FakeWebSocket() for _ in range(2)]
+    binary_peers = [FakeBinaryWebSocket() for _ in range(2)]
+    for websocket in text_peers:
+        await manager.add(1, websocket)
+    for websocket in binary_peers:
+        await manager.add(1, websocket, binary=True)
+    packed = []
+    original_pack = socket_manager.wire.pack
+    monkeypatch.setattr(socket_manager.wire, "pack", lambda data: packed.append(data) or original_pack(data))
+
+    await manager.broadcast(None, 1, {"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "a"}], "revision": 2})
+    await asyncio.sleep(0)
+
+    assert len(packed) == 1
+    assert all(websocket.sent == [{"changes": [{"rangeOffset": 0, "rangeLength": 0, "text": "a"}], "revision": 2}]
+               for websocket in text_peers)
+    assert all(websocket.sent == [[2, [0, 0, "a"]]] for websocket in binary_peers)
+    for websocket in text_peers + binary_peers:
+        manager.remove(1, websocket)
@@ -0,0 +1,45 @@
+import msgpack
+import pytest
+
+from backend import schemas, wire
+
+
+def test_edit_round_trip_is_flat():
+    frame = {"changes": [{"rangeOffset": 5, "rangeLength": 0, "text": "!"},
+                         {"rangeOffset": 0, "rangeLength": 2, "text": ""}], "revision": 3}
+
+    packed = wire.pack(frame)
+    assert msgpack.unpackb(packed) == [3, [5, 0, "!", 0, 2, ""]]
+
+    envelope = wire.unpack(packed)
+    assert envelope.revision == 3
+    assert [change.model_dump() for change in envelope.changes] == frame["changes"]
+    assert wire.unpack(msgpack.packb([None, []])).revision is None
+
+
+def test_control_frames_stay_maps():
+    assert msgpack.unpackb(wire.pack({"type": "ack", "revision": 1})) == {"type": "ack", "revision": 1}
+
+    update = wire.unpack(msgpack.packb({"type": "presence", "cursor": 4}))
+    assert isinstance(update, schemas.PresenceUpdate) and update.cursor == 4
+
+
+@pytest.mark.parametrize("payload", [
+    b"\xc1",
+    msgpack.packb([1]),
+    msgpack.packb(["1", []]),
+    msgpack.packb([True, []]),
+    msgpack.packb([1, [0, 0]]),
+    msgpack.packb([1, [0, "0", "x"]]),
+    msgpack.packb([1, [0, 0, 1]]),
+    msgpack.packb({"type": "other"}),
+])
+def test_malformed_frames_are_rejected(payload):
+    with pytest.raises(ValueError):
+        wire.unpack(payload)
+
+
+def test_client_preference_wins_among_supported_protocols():
+    assert wire.negotiate(["chat", wire.MSGPACK, wire.JSON]) == wire.MSGPACK
+    assert wire.negotiate([wire.JSON, wire.MSGPACK]) == wire.JSON
+    assert wire.negotiate(["chat"]) is None